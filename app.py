@@ -5,25 +5,162 @@
 مطور بواسطة: MiniMax Agent
 """
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, flash, stream_with_context, g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, date
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import DDL, event, inspect
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, date, timedelta
+from functools import lru_cache, wraps
+import base64
+import click
+import csv
+import hashlib
+import io
 import json
 import os
+import queue
+import re
+import statistics
+import threading
+import time
+
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from config import BRANCH_BIND_PREFIX, READ_BIND_PREFIX, database_config
+
+# numpy و orjson ولهجات SQLAlchemy تُستورد عند أول استخدام لا عند بدء التشغيل
+
+# الإعدادات الافتراضية؛ create_app() (يُستدعى عند الاستيراد) يضيف قاعدة البيانات من DATABASE_URL وأي مفتاح من FLASK_<المفتاح>
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'accounting_system_secret_key_2025'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///accounting.db'
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'accounting_system_secret_key_2025')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# حجم الصفحة الافتراضي لقوائم API دون limit (الصفحة التالية بـ after=X-Next-Cursor)، وأقصى limit
+app.config['API_PAGE_SIZE'] = 100
+app.config['API_MAX_PAGE_SIZE'] = 1000
+# عدد الصفوف المقروءة من قاعدة البيانات في كل دفعة أثناء التصدير
+app.config['EXPORT_CHUNK_SIZE'] = 1000
+# الإدخال المجمّع: عدد الفواتير في كل commit والحد الأقصى للطلب الواحد
+app.config['BULK_CHUNK_SIZE'] = 200
+app.config['BULK_MAX_INVOICES'] = 5000
+# استلام المدفوعات المجمّع (ملفات البنك): عدد الإيصالات في كل commit والحد الأقصى للطلب الواحد
+app.config['PAYMENT_CHUNK_SIZE'] = 1000
+app.config['BULK_MAX_PAYMENTS'] = 50000
+# رفض فواتير البيع التي تتجاوز المخزون المتاح بدلاً من جعل الكمية سالبة
+app.config['PREVENT_NEGATIVE_STOCK'] = False
+# عدد الاستجابات المحفوظة في ذاكرة كل عملية (0 لتعطيل الحفظ)
+app.config['RESPONSE_CACHE_SIZE'] = 256
+# طريقة تكلفة البضاعة المباعة: fifo (الوارد أولاً صادر أولاً) أو average (المتوسط المرجح المتحرك)
+app.config['COST_METHOD'] = os.environ.get('COST_METHOD', 'fifo')
+# ترميز قوائم API بـ orjson إن كانت مثبتة (نفس المفاتيح والقيم، لكن النص العربي بـ UTF-8 بدل \uXXXX)
+app.config['FAST_JSON'] = os.environ.get('FAST_JSON') == '1'
+# أقصى عدد تغييرات في استجابة /api/sync؛ العميل الأبعد من ذلك يعيد التحميل الكامل
+app.config['SYNC_MAX_CHANGES'] = 5000
+# بث الأحداث (/api/events): مفاتيح طابور كل مشترك، أقصى عدد مشتركين في العملية، ونبضة الاتصال بالثواني
+app.config['EVENTS_QUEUE_SIZE'] = 100
+app.config['EVENTS_MAX_SUBSCRIBERS'] = 500
+app.config['EVENTS_HEARTBEAT_SECONDS'] = 15
+# كل كم ثانية تُقرأ أرقام إصدار الجداول لاكتشاف كتابات العمليات الأخرى (عمال gunicorn و flask CLI)
+app.config['EVENTS_POLL_SECONDS'] = 1
+# الترحيل المجمّع لطلبات POST /api/sales المتزامنة (GROUP_COMMIT=1): commit واحد لكل دفعة.
+# أقصى انتظار إضافي لتجميع الدفعة، أقصى عدد فواتير فيها، وحجم الطابور قبل الرجوع للترحيل المباشر
+app.config['GROUP_COMMIT'] = os.environ.get('GROUP_COMMIT') == '1'
+app.config['GROUP_COMMIT_WINDOW_MS'] = 2
+app.config['GROUP_COMMIT_MAX_BATCH'] = 64
+app.config['GROUP_COMMIT_MAX_PENDING'] = 1000
+# أقصى انتظار لنتيجة الكاتب المجمّع؛ بعده يُسحب الطلب من الطابور ويُرحَّل مباشرة
+app.config['GROUP_COMMIT_TIMEOUT_MS'] = 5000
+# أرشفة الفواتير المكتملة القديمة (flask archive-invoices): عدد الفواتير المنقولة في كل معاملة قصيرة
+app.config['ARCHIVE_BATCH_SIZE'] = 500
+# عدد خيوط التقارير الموحدة على قواعد الفروع (BRANCH_DATABASES)
+app.config['BRANCH_WORKERS'] = 16
+# قراءة طلبات GET من قواعد القراءة (READ_DATABASE_URL أو SQLITE_READ_ONLY=1 - راجع config.py):
+# عدد الثواني التي تُقرأ فيها طلبات العميل من القاعدة الرئيسية بعد كتابته (read-your-writes)
+app.config['READ_YOUR_WRITES_SECONDS'] = 5
+
+
+def current_branch():
+    """فرع سياق التطبيق الحالي (g.branch) أو DEFAULT_BRANCH؛ None = القاعدة الرئيسية"""
+    if not has_app_context():
+        return app.config['DEFAULT_BRANCH']
+    return g.get('branch', app.config['DEFAULT_BRANCH'])
+
+
+def reads_from_replica():
+    """هل يقرأ سياق التطبيق الحالي من قاعدة القراءة (g.read_only لطلبات GET)"""
+    return has_app_context() and g.get('read_only', False)
+
+
+class BranchSession(FlaskSession):
+    """
+    جلسة توجّه كل الاستعلامات إلى قاعدة فرع السياق الحالي، وإلا إلى القاعدة الرئيسية،
+    وإلى قاعدة القراءة المقابلة لها (إن وُجدت) في طلبات القراءة
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            branch = current_branch()
+            key = BRANCH_BIND_PREFIX + branch if branch is not None else None
+            if reads_from_replica():
+                engine = self._db.engines.get(READ_BIND_PREFIX + (key or ''))
+                if engine is not None:
+                    return engine
+            if key is not None:
+                return self._db.engines[key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': BranchSession})
+
+# ===========================================
+# إصدارات الصفوف (المزامنة التزايدية)
+# ===========================================
+
+# اسم عداد إصدارات الصفوف في جدول TableVersion
+ROW_VERSION_COUNTER = 'sync'
 
-db = SQLAlchemy(app)
+
+def next_row_version(context):
+    """
+    قيمة row_version لكل صف يُضاف أو يُعدَّل: رقم واحد لكل معاملة كتابة يُحجز من العداد
+    عند أول صف يتغير فيها. صف العداد يبقى مقفلاً حتى commit، فترتيب الأرقام هو ترتيب
+    الـ commit ولا يفوت العميلَ صفٌّ رقمه أقل من رمز المزامنة الذي معه.
+    """
+    connection = context.root_connection
+    transaction = connection.get_transaction()
+    cached = connection.info.get('row_version')
+    if cached is not None and cached[0] is transaction:
+        return cached[1]
+    table = TableVersion.__table__
+    # القيمة الأولى مشتقة من الوقت (كما في bump_versions) حتى لا تتكرر الرموز إذا أُعيد إنشاء القاعدة
+    initial = time.time_ns() // 1000
+    insert = upsert_insert(connection)
+    if insert is not None:
+        version = connection.execute(
+            insert(table).values(name=ROW_VERSION_COUNTER, version=initial)
+            .on_conflict_do_update(index_elements=[table.c.name], set_={'version': table.c.version + 1})
+            .returning(table.c.version)
+        ).scalar_one()
+    else:
+        counter = table.c.name == ROW_VERSION_COUNTER
+        if not connection.execute(table.update().where(counter).values(version=table.c.version + 1)).rowcount:
+            connection.execute(table.insert().values(name=ROW_VERSION_COUNTER, version=initial))
+        version = connection.execute(db.select(table.c.version).where(counter)).scalar_one()
+    connection.info['row_version'] = (transaction, version)
+    return version
 
 # ===========================================
 # نماذج قاعدة البيانات
 # ===========================================
 
 class Customer(db.Model):
+    __table_args__ = (
+        db.Index('ix_customer_status_id', 'status', 'id'),
+        db.Index('ix_customer_row_version', 'row_version'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     phone = db.Column(db.String(20))
@@ -31,6 +168,8 @@ class Customer(db.Model):
     balance = db.Column(db.Float, default=0.0)
     status = db.Column(db.String(20), default='active')
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    # رقم معاملة آخر إضافة/تعديل للصف (/api/sync)
+    row_version = db.Column(db.BigInteger, default=next_row_version, onupdate=next_row_version)
     
     def to_dict(self):
         return {
@@ -44,6 +183,11 @@ class Customer(db.Model):
         }
 
 class Supplier(db.Model):
+    __table_args__ = (
+        db.Index('ix_supplier_status_id', 'status', 'id'),
+        db.Index('ix_supplier_row_version', 'row_version'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     phone = db.Column(db.String(20))
@@ -52,6 +196,8 @@ class Supplier(db.Model):
     balance = db.Column(db.Float, default=0.0)
     status = db.Column(db.String(20), default='active')
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    # رقم معاملة آخر إضافة/تعديل للصف (/api/sync)
+    row_version = db.Column(db.BigInteger, default=next_row_version, onupdate=next_row_version)
     
     def to_dict(self):
         return {
@@ -66,6 +212,13 @@ class Supplier(db.Model):
         }
 
 class Product(db.Model):
+    __table_args__ = (
+        db.Index('ix_product_category_id', 'category', 'id'),
+        db.Index('ix_product_row_version', 'row_version'),
+        # فهرس مغطٍّ لعدّ المنتجات تحت الحد الأدنى دون قراءة الجدول
+        db.Index('ix_product_quantity_min_stock', 'quantity', 'min_stock'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     code = db.Column(db.String(50), unique=True)
@@ -76,6 +229,8 @@ class Product(db.Model):
     min_stock = db.Column(db.Integer, default=5)
     category = db.Column(db.String(50))
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    # رقم معاملة آخر إضافة/تعديل للصف (/api/sync)
+    row_version = db.Column(db.BigInteger, default=next_row_version, onupdate=next_row_version)
     
     def to_dict(self):
         return {
@@ -92,6 +247,17 @@ class Product(db.Model):
         }
 
 class SaleInvoice(db.Model):
+    __table_args__ = (
+        db.Index('ix_sale_invoice_date_id', 'date', 'id'),
+        db.Index('ix_sale_invoice_customer_date', 'customer_id', 'date'),
+        db.Index('ix_sale_invoice_status_id', 'status', 'id'),
+        db.Index('ix_sale_invoice_created_date', 'created_date'),
+        db.Index('ix_sale_invoice_row_version', 'row_version'),
+        # فهرس جزئي مغطٍّ للفواتير المفتوحة فقط: كشف الحساب وأعمار الديون
+        db.Index('ix_sale_invoice_open', 'customer_id', 'date', 'remaining',
+                 sqlite_where=db.text('remaining > 0'), postgresql_where=db.text('remaining > 0')),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'))
     invoice_number = db.Column(db.String(50), unique=True)
@@ -104,6 +270,8 @@ class SaleInvoice(db.Model):
     remaining = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(20), default='partial')
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    # رقم معاملة آخر إضافة/تعديل للصف (/api/sync)
+    row_version = db.Column(db.BigInteger, default=next_row_version, onupdate=next_row_version)
     
     customer = db.relationship('Customer')
     items = db.relationship('SaleItem', backref='invoice', cascade="all, delete-orphan")
@@ -126,6 +294,11 @@ class SaleInvoice(db.Model):
         }
 
 class SaleItem(db.Model):
+    __table_args__ = (
+        db.Index('ix_sale_item_invoice_id', 'invoice_id'),
+        db.Index('ix_sale_item_product_id', 'product_id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     invoice_id = db.Column(db.Integer, db.ForeignKey('sale_invoice.id'))
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'))
@@ -133,6 +306,8 @@ class SaleItem(db.Model):
     price = db.Column(db.Float, nullable=False)
     discount = db.Column(db.Float, default=0.0)
     total = db.Column(db.Float, nullable=False)
+    # تكلفة البضاعة المباعة للبند من طبقات التكلفة وقت الترحيل
+    cost = db.Column(db.Float)
     
     product = db.relationship('Product')
     
@@ -148,6 +323,17 @@ class SaleItem(db.Model):
         }
 
 class PurchaseInvoice(db.Model):
+    __table_args__ = (
+        db.Index('ix_purchase_invoice_date_id', 'date', 'id'),
+        db.Index('ix_purchase_invoice_supplier_date', 'supplier_id', 'date'),
+        db.Index('ix_purchase_invoice_status_id', 'status', 'id'),
+        db.Index('ix_purchase_invoice_created_date', 'created_date'),
+        db.Index('ix_purchase_invoice_row_version', 'row_version'),
+        # فهرس جزئي مغطٍّ للفواتير المفتوحة فقط: كشف الحساب وأعمار الديون
+        db.Index('ix_purchase_invoice_open', 'supplier_id', 'date', 'remaining',
+                 sqlite_where=db.text('remaining > 0'), postgresql_where=db.text('remaining > 0')),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'))
     invoice_number = db.Column(db.String(50), unique=True)
@@ -160,6 +346,8 @@ class PurchaseInvoice(db.Model):
     remaining = db.Column(db.Float, nullable=False)
     status = db.Column(db.String(20), default='partial')
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    # رقم معاملة آخر إضافة/تعديل للصف (/api/sync)
+    row_version = db.Column(db.BigInteger, default=next_row_version, onupdate=next_row_version)
     
     supplier = db.relationship('Supplier')
     items = db.relationship('PurchaseItem', backref='invoice', cascade="all, delete-orphan")
@@ -182,6 +370,11 @@ class PurchaseInvoice(db.Model):
         }
 
 class PurchaseItem(db.Model):
+    __table_args__ = (
+        db.Index('ix_purchase_item_invoice_id', 'invoice_id'),
+        db.Index('ix_purchase_item_product_id', 'product_id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     invoice_id = db.Column(db.Integer, db.ForeignKey('purchase_invoice.id'))
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'))
@@ -203,357 +396,3980 @@ class PurchaseItem(db.Model):
             'total': self.total
         }
 
-# ===========================================
-#Routes - الصفحة الرئيسية
-# ===========================================
-
-@app.route('/')
-def index():
-    return render_template('index.html')
+class DashboardSummary(db.Model):
+    """ملخص لوحة التحكم: قيم تراكمية تُحدَّث في نفس معاملة كل عملية كتابة"""
+    # '' = الإجمالي الكلي، 'YYYY-MM' = إجمالي الشهر (أول المفتاح لتخدم قراءة لوحة التحكم)
+    period = db.Column(db.String(7), primary_key=True, default='')
+    metric = db.Column(db.String(30), primary_key=True)
+    value = db.Column(db.Float, nullable=False, default=0.0)
 
-@app.route('/dashboard')
-def dashboard():
-    return render_template('dashboard.html')
+class TableVersion(db.Model):
+    """رقم إصدار لكل جدول يزداد مع كل عملية كتابة عليه (يُستخدم في ETag)"""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
 
-# ===========================================
-# API - العملاء
-# ===========================================
+class ProductDailyRollup(db.Model):
+    """تجميع يومي لحركة كل منتج (kind = sale/purchase) يُحدَّث مع ترحيل الفواتير"""
+    __table_args__ = (
+        db.Index('ix_product_daily_rollup_product', 'kind', 'product_id', 'day'),
+    )
+    
+    kind = db.Column(db.String(10), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+    cost = db.Column(db.Float, nullable=False, default=0.0)
+    discount = db.Column(db.Float, nullable=False, default=0.0)
+    lines = db.Column(db.Integer, nullable=False, default=0)
 
-@app.route('/api/customers', methods=['GET'])
-def get_customers():
-    customers = Customer.query.all()
-    return jsonify([customer.to_dict() for customer in customers])
+class PartyDailyRollup(db.Model):
+    """تجميع يومي لفواتير كل عميل (sale) أو مورد (purchase)"""
+    __table_args__ = (
+        db.Index('ix_party_daily_rollup_party', 'kind', 'party_id', 'day'),
+    )
+    
+    kind = db.Column(db.String(10), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    party_id = db.Column(db.Integer, primary_key=True)
+    invoices = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+    cost = db.Column(db.Float, nullable=False, default=0.0)
+    discount = db.Column(db.Float, nullable=False, default=0.0)
+    paid = db.Column(db.Float, nullable=False, default=0.0)
+    remaining = db.Column(db.Float, nullable=False, default=0.0)
 
-@app.route('/api/customers', methods=['POST'])
-def add_customer():
-    data = request.get_json()
+class CostLayer(db.Model):
+    """
+    طبقة تكلفة مخزون: كمية واردة بتكلفة وحدة، يُستهلك المتبقي منها عند البيع.
+    source: opening (رصيد أول المدة) / purchase / adjustment، أو average (طبقة واحدة لكل منتج بالمتوسط المرجح)
+    """
+    __table_args__ = (
+        # الطبقات المفتوحة فقط، بترتيب الاستهلاك لكل منتج
+        db.Index('ix_cost_layer_open', 'product_id', 'id',
+                 sqlite_where=db.text('remaining > 0'), postgresql_where=db.text('remaining > 0')),
+        db.Index('uq_cost_layer_average', 'product_id', unique=True,
+                 sqlite_where=db.text("source = 'average'"), postgresql_where=db.text("source = 'average'")),
+    )
     
-    customer = Customer(
-        name=data['name'],
-        phone=data.get('phone', ''),
-        address=data.get('address', ''),
-        balance=data.get('balance', 0.0),
-        status=data.get('status', 'active')
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    source = db.Column(db.String(20), nullable=False)
+    purchase_item_id = db.Column(db.Integer)
+    date = db.Column(db.Date, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    remaining = db.Column(db.Integer, nullable=False)
+    unit_cost = db.Column(db.Float, nullable=False)
+
+class Payment(db.Model):
+    """دفعة مستلمة من عميل (kind = sale) أو مدفوعة لمورد (kind = purchase)، تُخصَّص على الفواتير المفتوحة"""
+    __table_args__ = (
+        db.Index('ix_payment_party_date', 'kind', 'party_id', 'date'),
+        # مرجع البنك لا يتكرر، فإعادة رفع نفس الملف لا تسجل الدفعات مرتين
+        db.Index('uq_payment_reference', 'kind', 'reference', unique=True),
     )
     
-    db.session.add(customer)
-    db.session.commit()
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)
+    party_id = db.Column(db.Integer, nullable=False)
+    date = db.Column(db.Date, nullable=False, default=date.today)
+    amount = db.Column(db.Float, nullable=False)
+    unallocated = db.Column(db.Float, nullable=False, default=0.0)
+    reference = db.Column(db.String(100))
+    method = db.Column(db.String(20), default='bank')
+    notes = db.Column(db.Text)
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
     
-    return jsonify({'success': True, 'customer': customer.to_dict()})
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'party_id': self.party_id,
+            'date': self.date.strftime('%Y-%m-%d'),
+            'amount': self.amount,
+            'unallocated': self.unallocated,
+            'reference': self.reference,
+            'method': self.method,
+            'notes': self.notes,
+        }
 
-@app.route('/api/customers/<int:customer_id>', methods=['PUT'])
-def update_customer(customer_id):
-    customer = Customer.query.get_or_404(customer_id)
-    data = request.get_json()
-    
-    customer.name = data['name']
-    customer.phone = data.get('phone', '')
-    customer.address = data.get('address', '')
-    customer.balance = data.get('balance', 0.0)
-    customer.status = data.get('status', 'active')
+class PaymentAllocation(db.Model):
+    """الجزء من دفعة المخصص لفاتورة مبيعات/مشتريات (حسب نوع الدفعة)"""
+    __table_args__ = (
+        db.Index('ix_payment_allocation_payment', 'payment_id'),
+        db.Index('ix_payment_allocation_invoice', 'kind', 'invoice_id'),
+    )
     
-    db.session.commit()
+    id = db.Column(db.Integer, primary_key=True)
+    payment_id = db.Column(db.Integer, db.ForeignKey('payment.id'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+    invoice_id = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+
+class StockMovement(db.Model):
+    """
+    سجل حركات المخزون (إضافة فقط): كمية وقيمة بالتكلفة موجبة للوارد وسالبة للصادر.
+    source: sale / purchase (reference_id = معرف الفاتورة) أو opening / adjustment / removal
+    """
+    __table_args__ = (
+        db.Index('ix_stock_movement_date_product', 'date', 'product_id'),
+        db.Index('ix_stock_movement_product_date', 'product_id', 'date'),
+    )
     
-    return jsonify({'success': True, 'customer': customer.to_dict()})
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    value = db.Column(db.Float, nullable=False, default=0.0)
+    source = db.Column(db.String(20), nullable=False)
+    reference_id = db.Column(db.Integer)
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
 
-@app.route('/api/customers/<int:customer_id>', methods=['DELETE'])
-def delete_customer(customer_id):
-    customer = Customer.query.get_or_404(customer_id)
-    db.session.delete(customer)
-    db.session.commit()
+class StockSnapshot(db.Model):
+    """رصيد كل منتج (كمية وقيمة) في نهاية يوم اللقطة؛ المنتج غير الموجود في اللقطة رصيده صفر"""
+    date = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    value = db.Column(db.Float, nullable=False, default=0.0)
+
+class SyncTombstone(db.Model):
+    """صف محذوف من الجداول المتزامنة (entity = اسم الكيان في /api/sync) حتى يحذفه العملاء أيضاً"""
+    __table_args__ = (
+        db.Index('ix_sync_tombstone_row_version', 'row_version'),
+    )
     
-    return jsonify({'success': True})
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    row_version = db.Column(db.BigInteger, nullable=False, default=next_row_version)
+    deleted_date = db.Column(db.DateTime, default=datetime.utcnow)
+
+# وصف نوعي الفواتير (مبيعات/مشتريات) للدوال المشتركة بينهما
+InvoiceKind = namedtuple('InvoiceKind', [
+    'invoice', 'item', 'party', 'party_field', 'amount_field', 'prefix', 'stock_sign', 'name'
+])
+
+SALE_KIND = InvoiceKind(SaleInvoice, SaleItem, Customer, 'customer_id', 'price', 'S', -1, 'sale')
+PURCHASE_KIND = InvoiceKind(PurchaseInvoice, PurchaseItem, Supplier, 'supplier_id', 'cost', 'P', 1, 'purchase')
+
+
+def archive_table(model, *indexes):
+    """جدول أرشيف بنفس أعمدة جدول النموذج (بلا قيود أو قيم افتراضية) وفهارس القراءة بالفترة فقط"""
+    name = f'{model.__tablename__}_archive'
+    columns = [
+        db.Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+        for column in model.__table__.columns
+    ]
+    return db.Table(name, db.metadata, *columns, *[
+        db.Index(f'ix_{name}_{"_".join(names)}', *names) for names in indexes
+    ])
+
+
+# الفواتير المكتملة القديمة وعناصرها تُنقل إلى هذه الجداول (flask archive-invoices)
+ARCHIVE_TABLES = {
+    SaleInvoice: archive_table(SaleInvoice, ('date', 'id'), ('customer_id', 'date')),
+    SaleItem: archive_table(SaleItem, ('invoice_id',), ('product_id',)),
+    PurchaseInvoice: archive_table(PurchaseInvoice, ('date', 'id'), ('supplier_id', 'date')),
+    PurchaseItem: archive_table(PurchaseItem, ('invoice_id',), ('product_id',)),
+}
+
+
+@lru_cache(maxsize=None)
+def invoice_history(kind):
+    """
+    نوع الفواتير على كامل السجل: invoice و item كيانان (aliased) على UNION ALL
+    للجدول الحالي وجدول أرشيفه، بنفس أسماء الأعمدة فتعمل عليهما نفس الاستعلامات.
+    """
+    def combined(model):
+        table = model.__table__
+        history = db.union_all(db.select(table), db.select(ARCHIVE_TABLES[model]))
+        return db.aliased(model, history.subquery(f'{table.name}_history'))
+    return kind._replace(invoice=combined(kind.invoice), item=combined(kind.item))
 
 # ===========================================
-# API - الموردين
+# ملخص لوحة التحكم (تحديث تدريجي)
 # ===========================================
 
-@app.route('/api/suppliers', methods=['GET'])
-def get_suppliers():
-    suppliers = Supplier.query.all()
-    return jsonify([supplier.to_dict() for supplier in suppliers])
+# اسم مؤشر إجمالي الفواتير لكل نوع
+TOTAL_METRICS = {SALE_KIND: 'sales_total', PURCHASE_KIND: 'purchases_total'}
+# مؤشر تكلفة البضاعة المباعة (مجموع SaleItem.cost)
+COGS_METRIC = 'cogs_total'
+# اسم مؤشر عدد السجلات لكل جدول
+COUNT_METRICS = {Customer: 'customers', Supplier: 'suppliers', Product: 'products'}
 
-@app.route('/api/suppliers', methods=['POST'])
-def add_supplier():
-    data = request.get_json()
-    
-    supplier = Supplier(
-        name=data['name'],
-        phone=data.get('phone', ''),
-        address=data.get('address', ''),
-        contact_person=data.get('contact_person', ''),
-        balance=data.get('balance', 0.0),
-        status=data.get('status', 'active')
+
+def upsert_insert(bind=None):
+    """دالة insert التي تدعم ON CONFLICT لقاعدة الاتصال bind أو الجلسة الحالية (SQLite/PostgreSQL) أو None"""
+    dialect = (bind or db.session.get_bind()).dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    return None
+
+
+def upsert_increment(table, key, column, delta, initial=None):
+    """
+    زيادة عمود عددي في الصف ذي المفتاح key بمقدار delta (ذرياً داخل المعاملة الحالية).
+    إن لم يكن الصف موجوداً يُنشأ بالقيمة initial (أو delta).
+    """
+    initial = delta if initial is None else initial
+    insert = upsert_insert()
+    if insert is not None:
+        statement = insert(table).values(**key, **{column: initial})
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c[name] for name in key],
+            set_={column: table.c[column] + delta},
+        )
+        db.session.execute(statement)
+        return
+    updated = db.session.execute(
+        table.update()
+        .where(*[table.c[name] == value for name, value in key.items()])
+        .values({column: table.c[column] + delta})
     )
-    
-    db.session.add(supplier)
-    db.session.commit()
-    
-    return jsonify({'success': True, 'supplier': supplier.to_dict()})
+    if updated.rowcount == 0:
+        db.session.execute(table.insert().values(**key, **{column: initial}))
 
-@app.route('/api/suppliers/<int:supplier_id>', methods=['PUT'])
-def update_supplier(supplier_id):
-    supplier = Supplier.query.get_or_404(supplier_id)
-    data = request.get_json()
-    
-    supplier.name = data['name']
-    supplier.phone = data.get('phone', '')
-    supplier.address = data.get('address', '')
-    supplier.contact_person = data.get('contact_person', '')
-    supplier.balance = data.get('balance', 0.0)
-    supplier.status = data.get('status', 'active')
-    
-    db.session.commit()
-    
-    return jsonify({'success': True, 'supplier': supplier.to_dict()})
 
-@app.route('/api/suppliers/<int:supplier_id>', methods=['DELETE'])
-def delete_supplier(supplier_id):
-    supplier = Supplier.query.get_or_404(supplier_id)
-    db.session.delete(supplier)
-    db.session.commit()
-    
-    return jsonify({'success': True})
+def bump_summary(metric, delta, period=''):
+    """إضافة delta إلى مؤشر في الملخص"""
+    if delta:
+        upsert_increment(DashboardSummary.__table__, {'period': period, 'metric': metric}, 'value', delta)
+
+
+def bump_period_total(metric, invoice_date, amount):
+    """إضافة مبلغ إلى مؤشر إجمالي الكلي والشهري"""
+    bump_summary(metric, amount)
+    bump_summary(metric, amount, invoice_date.strftime('%Y-%m'))
+
+
+def bump_invoice_totals(kind, invoice_date, total):
+    """تحديث إجمالي المبيعات/المشتريات الكلي والشهري لفاتورة جديدة"""
+    bump_period_total(TOTAL_METRICS[kind], invoice_date, total)
+
+
+def low_stock_count(product_ids):
+    """عدد المنتجات تحت الحد الأدنى للمخزون من بين المنتجات المحددة"""
+    if not product_ids:
+        return 0
+    return db.session.scalar(
+        db.select(db.func.count(Product.id)).where(
+            Product.id.in_(set(product_ids)),
+            Product.quantity <= Product.min_stock,
+        )
+    )
+
+
+def stock_levels(product_ids):
+    """{product_id: (quantity, min_stock)} للمنتجات المحددة كما تراها المعاملة الحالية"""
+    if not product_ids:
+        return {}
+    rows = db.session.execute(
+        db.select(Product.id, Product.quantity, Product.min_stock).where(Product.id.in_(set(product_ids)))
+    )
+    return {product_id: (quantity, min_stock) for product_id, quantity, min_stock in rows}
+
+
+def is_low_stock(level):
+    """هل المستوى (quantity, min_stock) عند الحد الأدنى أو تحته (نفس شرط low_stock_count)"""
+    quantity, min_stock = level
+    return quantity is not None and min_stock is not None and quantity <= min_stock
+
+
+def low_stock_delta(before, after):
+    """التغير في عدد المنتجات تحت الحد الأدنى بين مستويين من stock_levels"""
+    return sum(map(is_low_stock, after.values())) - sum(map(is_low_stock, before.values()))
+
+
+def compute_dashboard_summary():
+    """حساب الملخص من الصفر من الجداول الأصلية والأرشيف: {(metric, period): value}"""
+    values = {}
+    for kind, metric in TOTAL_METRICS.items():
+        invoice_model = invoice_history(kind).invoice
+        values[(metric, '')] = db.session.scalar(db.select(db.func.sum(invoice_model.total))) or 0.0
+        year = db.extract('year', invoice_model.date)
+        month = db.extract('month', invoice_model.date)
+        monthly = db.session.execute(
+            db.select(year, month, db.func.sum(invoice_model.total)).group_by(year, month)
+        )
+        for row_year, row_month, total in monthly:
+            values[(metric, f'{int(row_year):04d}-{int(row_month):02d}')] = total
+    sales = invoice_history(SALE_KIND)
+    line_cost = sale_line_cost(sales.item)
+    year = db.extract('year', sales.invoice.date)
+    month = db.extract('month', sales.invoice.date)
+    monthly = db.session.execute(
+        db.select(year, month, db.func.sum(line_cost)).select_from(sales.item)
+        .join(sales.invoice, sales.item.invoice_id == sales.invoice.id)
+        .outerjoin(Product, sales.item.product_id == Product.id)
+        .group_by(year, month)
+    )
+    values[(COGS_METRIC, '')] = 0.0
+    for row_year, row_month, total in monthly:
+        values[(COGS_METRIC, f'{int(row_year):04d}-{int(row_month):02d}')] = total or 0.0
+        values[(COGS_METRIC, '')] += total or 0.0
+    for model, metric in COUNT_METRICS.items():
+        values[(metric, '')] = db.session.scalar(db.select(db.func.count(model.id)))
+    values[('low_stock', '')] = db.session.scalar(
+        db.select(db.func.count(Product.id)).where(Product.quantity <= Product.min_stock)
+    )
+    return values
+
+
+def rebuild_dashboard_summary(write=True):
+    """
+    إعادة بناء الملخص ومقارنته بالقيم المخزنة.
+    يرجع قائمة الفروقات [(metric, period, stored, actual)].
+    """
+    actual = compute_dashboard_summary()
+    stored = {(row.metric, row.period): row.value for row in DashboardSummary.query.all()}
+    drift = []
+    for key in sorted(set(actual) | set(stored)):
+        stored_value, actual_value = stored.get(key, 0.0), actual.get(key, 0.0)
+        if abs(stored_value - actual_value) > 0.005:
+            drift.append((key[0], key[1], stored_value, actual_value))
+    if write:
+        DashboardSummary.query.delete()
+        db.session.add_all(
+            DashboardSummary(metric=metric, period=period, value=value)
+            for (metric, period), value in actual.items()
+        )
+        # إبطال ETag لوحة التحكم حتى لا تبقى القيم المنحرفة في ذاكرة العملاء والعملية
+        bump_versions(DashboardSummary)
+        db.session.commit()
+    return drift
+
+
+@app.cli.command('rebuild-summary')
+@click.option('--check', is_flag=True, help='عرض الفروقات فقط دون إعادة الكتابة')
+def rebuild_summary_command(check):
+    """إعادة حساب جدول ملخص لوحة التحكم من الصفر"""
+    drift = rebuild_dashboard_summary(write=not check)
+    for metric, period, stored_value, actual_value in drift:
+        click.echo(f'{metric} [{period or "الكل"}]: المخزن={stored_value} الفعلي={actual_value}')
+    if not drift:
+        click.echo('✅ الملخص مطابق للبيانات')
+    elif check:
+        raise SystemExit(1)
+    else:
+        click.echo(f'✅ تم تصحيح {len(drift)} قيمة')
 
 # ===========================================
-# API - المنتجات
+# ترقيم الفواتير (عداد لكل بادئة ويوم)
 # ===========================================
 
-@app.route('/api/products', methods=['GET'])
-def get_products():
-    products = Product.query.all()
-    return jsonify([product.to_dict() for product in products])
+class InvoiceSequence(db.Model):
+    """آخر رقم مستخدم لكل بادئة فواتير (S/P) في كل يوم"""
+    prefix = db.Column(db.String(10), primary_key=True)
+    day = db.Column(db.String(8), primary_key=True)
+    last_value = db.Column(db.Integer, nullable=False, default=0)
 
-@app.route('/api/products', methods=['POST'])
-def add_product():
-    data = request.get_json()
-    
-    product = Product(
-        name=data['name'],
-        code=data.get('code', ''),
-        price=float(data['price']),
-        cost=float(data['cost']),
-        unit=data.get('unit', 'قطعة'),
-        quantity=int(data.get('quantity', 0)),
-        min_stock=int(data.get('min_stock', 5)),
-        category=data.get('category', '')
-    )
-    
-    db.session.add(product)
-    db.session.commit()
-    
-    return jsonify({'success': True, 'product': product.to_dict()})
 
-@app.route('/api/products/<int:product_id>', methods=['PUT'])
-def update_product(product_id):
-    product = Product.query.get_or_404(product_id)
-    data = request.get_json()
-    
-    product.name = data['name']
-    product.code = data.get('code', '')
-    product.price = float(data['price'])
-    product.cost = float(data['cost'])
-    product.unit = data.get('unit', 'قطعة')
-    product.quantity = int(data.get('quantity', 0))
-    product.min_stock = int(data.get('min_stock', 5))
-    product.category = data.get('category', '')
-    
-    db.session.commit()
-    
-    return jsonify({'success': True, 'product': product.to_dict()})
+def seed_invoice_sequence(kind, day):
+    """
+    إنشاء عداد اليوم إن لم يكن موجوداً، بادئاً من أكبر رقم مستخدم اليوم
+    (للتوافق مع الفواتير المرقمة قبل إضافة العداد).
+    """
+    number_prefix = f'{kind.prefix}-{day}-'
+    number = kind.invoice.invoice_number
+    last_value = db.session.scalar(
+        db.select(db.func.max(db.cast(db.func.substr(number, len(number_prefix) + 1), db.Integer)))
+        .where(number >= number_prefix, number < f'{kind.prefix}-{day}.')
+    ) or 0
+    table = InvoiceSequence.__table__
+    values = {'prefix': kind.prefix, 'day': day, 'last_value': last_value}
+    insert = upsert_insert()
+    if insert is not None:
+        db.session.execute(insert(table).values(**values).on_conflict_do_nothing())
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(table.insert().values(**values))
+    except IntegrityError:
+        pass
 
-@app.route('/api/products/<int:product_id>', methods=['DELETE'])
-def delete_product(product_id):
-    product = Product.query.get_or_404(product_id)
-    db.session.delete(product)
-    db.session.commit()
-    
-    return jsonify({'success': True})
+
+def allocate_invoice_numbers(kind, count=1):
+    """
+    حجز count رقماً متتالياً لفواتير اليوم بعبارة UPDATE ... RETURNING واحدة.
+    الحجز ذري داخل المعاملة الحالية، فلا تتكرر الأرقام بين العمليات المتزامنة
+    ولا حاجة لإعادة المحاولة عند تعارض القيد unique.
+    """
+    day = datetime.now().strftime('%Y%m%d')
+    table = InvoiceSequence.__table__
+    bump = table.update() \
+        .where(table.c.prefix == kind.prefix, table.c.day == day) \
+        .values(last_value=table.c.last_value + count)
+    for _ in range(2):
+        if db.session.get_bind().dialect.update_returning:
+            last_value = db.session.scalar(bump.returning(table.c.last_value))
+        elif db.session.execute(bump).rowcount:
+            last_value = db.session.scalar(
+                db.select(table.c.last_value).where(table.c.prefix == kind.prefix, table.c.day == day)
+            )
+        else:
+            last_value = None
+        if last_value is not None:
+            first_value = last_value - count + 1
+            return [f'{kind.prefix}-{day}-{value:04d}' for value in range(first_value, last_value + 1)]
+        # أول فاتورة في اليوم: إنشاء العداد ثم إعادة الحجز
+        seed_invoice_sequence(kind, day)
+    raise RuntimeError('تعذر حجز أرقام الفواتير')
 
 # ===========================================
-# API - فواتير المبيعات
+# ترحيل أثر الفواتير على المخزون والأرصدة
 # ===========================================
 
-@app.route('/api/sales', methods=['GET'])
-def get_sales():
-    sales = SaleInvoice.query.all()
-    return jsonify([sale.to_dict() for sale in sales])
+class InsufficientStockError(ValueError):
+    """الكمية المباعة أكبر من المخزون المتاح (عند تفعيل PREVENT_NEGATIVE_STOCK)"""
 
-@app.route('/api/sales', methods=['POST'])
-def add_sale():
-    data = request.get_json()
-    
-    # إنشاء رقم الفاتورة تلقائياً
-    last_invoice = SaleInvoice.query.order_by(SaleInvoice.id.desc()).first()
-    invoice_number = f"S-{datetime.now().strftime('%Y%m%d')}-{last_invoice.id + 1 if last_invoice else 1:04d}"
-    
-    sale_invoice = SaleInvoice(
-        customer_id=data['customer_id'],
-        invoice_number=invoice_number,
-        date=datetime.strptime(data['date'], '%Y-%m-%d').date(),
-        subtotal=float(data['subtotal']),
-        discount_total=float(data.get('discount_total', 0.0)),
-        tax_total=float(data.get('tax_total', 0.0)),
-        total=float(data['total']),
-        paid=float(data.get('paid', 0.0)),
-        remaining=float(data['remaining']),
-        status=data.get('status', 'partial')
+    def __init__(self, deltas):
+        self.deltas = dict(deltas)
+        super().__init__('المخزون غير كافٍ لبعض المنتجات')
+
+    def short_products(self):
+        """المنتجات التي لا يكفي مخزونها (تُستدعى بعد التراجع عن المعاملة)"""
+        available = dict(db.session.execute(
+            db.select(Product.id, Product.quantity).where(Product.id.in_(self.deltas))
+        ).all())
+        return sorted(
+            product_id for product_id, delta in self.deltas.items()
+            if available.get(product_id, 0) < delta
+        )
+
+
+def apply_stock_deltas(kind, deltas):
+    """
+    ترحيل الكميات {product_id: quantity} إلى المخزون بعبارة UPDATE واحدة
+    (quantity = quantity ± :delta) بدلاً من قراءة المنتج وتعديله في Python،
+    فلا تضيع تحديثات العمليات المتزامنة.
+    """
+    if not deltas:
+        return
+    table = Product.__table__
+    statement = table.update() \
+        .where(table.c.id == db.bindparam('product_key')) \
+        .values(quantity=table.c.quantity + kind.stock_sign * db.bindparam('delta'))
+    guarded = kind.stock_sign < 0 and app.config['PREVENT_NEGATIVE_STOCK']
+    if guarded:
+        statement = statement.where(table.c.quantity >= db.bindparam('delta'))
+    parameters = [{'product_key': product_id, 'delta': delta} for product_id, delta in deltas.items()]
+    result = db.session.execute(statement, parameters)
+    if guarded and result.rowcount != len(parameters):
+        raise InsufficientStockError(deltas)
+
+
+def apply_balance_deltas(kind, deltas):
+    """ترحيل المبالغ المتبقية {party_id: amount} إلى أرصدة العملاء/الموردين بعبارة واحدة"""
+    if not deltas:
+        return
+    table = kind.party.__table__
+    db.session.execute(
+        table.update()
+        .where(table.c.id == db.bindparam('party_key'))
+        .values(balance=table.c.balance + db.bindparam('delta')),
+        [{'party_key': party_id, 'delta': delta} for party_id, delta in deltas.items()],
     )
-    
+
+
+@app.errorhandler(InsufficientStockError)
+def handle_insufficient_stock(error):
+    db.session.rollback()
+    return jsonify({'success': False, 'error': str(error), 'product_ids': error.short_products()}), 409
+
+# ===========================================
+# تكلفة البضاعة المباعة (طبقات التكلفة)
+# ===========================================
+
+COST_METHODS = ('fifo', 'average')
+
+
+def cost_method():
+    """طريقة التكلفة المفعّلة (fifo أو average)"""
+    method = app.config['COST_METHOD']
+    if method not in COST_METHODS:
+        raise ValueError(f'COST_METHOD غير مدعوم: {method}')
+    return method
+
+
+def sale_line_cost(item=SaleItem):
+    """تكلفة بند البيع: المسجلة وقت الترحيل، أو تكلفة المنتج الحالية للبنود القديمة قبل تسجيلها"""
+    return db.func.coalesce(item.cost, item.quantity * db.func.coalesce(Product.cost, 0.0))
+
+
+def cost_layer_row(product_id, quantity, unit_cost, layer_date, source, purchase_item_id=None):
+    """صف طبقة تكلفة جديدة (بنفس المفاتيح دائماً للإدخال المجمّع)"""
+    return {
+        'product_id': product_id,
+        'source': source,
+        'purchase_item_id': purchase_item_id,
+        'date': layer_date,
+        'quantity': quantity,
+        'remaining': quantity,
+        'unit_cost': unit_cost,
+    }
+
+
+def purchase_layer_rows(items):
+    """طبقات بنود شراء [(purchase_item_id, product_id, quantity, total, date)] بتكلفة الوحدة بعد الخصم"""
+    return [
+        cost_layer_row(product_id, quantity, total / quantity, layer_date, 'purchase', item_id)
+        for item_id, product_id, quantity, total, layer_date in items if quantity > 0
+    ]
+
+
+def add_cost_layers(rows):
+    """
+    إضافة كميات واردة إلى طبقات التكلفة:
+    طبقة لكل وارد (fifo)، أو دمجها في طبقة المتوسط الوحيدة للمنتج (average) بعبارة upsert واحدة.
+    """
+    rows = [row for row in rows if row['quantity'] > 0]
+    if not rows:
+        return
+    table = CostLayer.__table__
+    if cost_method() == 'fifo':
+        db.session.execute(table.insert(), rows)
+        return
+    rows = [dict(row, source='average', purchase_item_id=None) for row in rows]
+    insert = upsert_insert()
+    if insert is None:
+        for row in rows:
+            merge_average_layer(table, row)
+        return
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=['product_id'],
+        index_where=db.text("source = 'average'"),
+        set_={
+            'quantity': table.c.quantity + statement.excluded.quantity,
+            'remaining': table.c.remaining + statement.excluded.remaining,
+            'unit_cost': averaged_unit_cost(table, statement.excluded.remaining, statement.excluded.unit_cost),
+            'date': statement.excluded.date,
+        },
+    )
+    db.session.execute(statement, rows)
+
+
+def averaged_unit_cost(table, quantity, unit_cost):
+    """المتوسط المرجح لتكلفة الوحدة بعد إضافة quantity بتكلفة unit_cost"""
+    return db.case(
+        (table.c.remaining > 0,
+         (table.c.remaining * table.c.unit_cost + quantity * unit_cost) / (table.c.remaining + quantity)),
+        else_=unit_cost,
+    )
+
+
+def merge_average_layer(table, row):
+    """دمج وارد في طبقة المتوسط لقواعد بيانات لا تدعم ON CONFLICT"""
+    updated = db.session.execute(
+        table.update()
+        .where(table.c.product_id == row['product_id'], table.c.source == 'average')
+        .values(
+            quantity=table.c.quantity + row['quantity'],
+            remaining=table.c.remaining + row['quantity'],
+            unit_cost=averaged_unit_cost(table, row['quantity'], row['unit_cost']),
+            date=row['date'],
+        )
+    )
+    if updated.rowcount == 0:
+        db.session.execute(table.insert().values(**row))
+
+
+def take_from_layers(layers, quantity, touched=None):
+    """
+    استهلاك quantity من طبقات مفتوحة مرتبة [[id, remaining, unit_cost], ...] (تُعدَّل في مكانها).
+    يرجع (التكلفة، الكمية التي لم تغطها الطبقات). touched: {id: remaining} للطبقات المعدّلة.
+    """
+    cost = 0.0
+    while quantity > 0 and layers:
+        layer = layers[0]
+        taken = min(quantity, layer[1])
+        layer[1] -= taken
+        quantity -= taken
+        cost += taken * layer[2]
+        if touched is not None:
+            touched[layer[0]] = layer[1]
+        if not layer[1]:
+            layers.popleft()
+    return cost, quantity
+
+
+def above_zero(column):
+    """
+    الشرط column > 0 بقيمة ثابتة في نص الاستعلام وليس معاملاً،
+    حتى يستخدم SQLite الفهارس الجزئية المعرّفة بالشرط remaining > 0.
+    """
+    return column > db.literal_column('0')
+
+
+def consume_cost_layers(lines):
+    """
+    استهلاك طبقات التكلفة لبنود بيع [(product_id, quantity)] بترتيبها، ويرجع تكلفة كل بند.
+    الطبقات المفتوحة للمنتجات تُقرأ باستعلام واحد (مقفلة في PostgreSQL) وتُحدَّث بعبارة واحدة.
+    الكمية التي لا تغطيها الطبقات (بيع بمخزون سالب) تُحسب بتكلفة المنتج الحالية.
+    """
+    product_ids = {product_id for product_id, _ in lines}
+    if not product_ids:
+        return []
+    open_layers = {}
+    rows = db.session.execute(
+        db.select(CostLayer.id, CostLayer.product_id, CostLayer.remaining, CostLayer.unit_cost)
+        .where(CostLayer.product_id.in_(product_ids), above_zero(CostLayer.remaining))
+        .order_by(CostLayer.product_id, CostLayer.id)
+        .with_for_update()
+    )
+    for layer_id, product_id, remaining, unit_cost in rows:
+        open_layers.setdefault(product_id, deque()).append([layer_id, remaining, unit_cost])
+
+    costs, touched, fallback = [], {}, None
+    for product_id, quantity in lines:
+        cost, uncovered = take_from_layers(open_layers.get(product_id, deque()), quantity, touched)
+        if uncovered > 0:
+            if fallback is None:
+                fallback = dict(db.session.execute(
+                    db.select(Product.id, Product.cost).where(Product.id.in_(product_ids))
+                ).all())
+            cost += uncovered * (fallback.get(product_id) or 0.0)
+        costs.append(cost)
+
+    if touched:
+        table = CostLayer.__table__
+        db.session.execute(
+            table.update().where(table.c.id == db.bindparam('layer_key')).values(remaining=db.bindparam('left')),
+            [{'layer_key': layer_id, 'left': remaining} for layer_id, remaining in touched.items()],
+        )
+    return costs
+
+
+def adjust_cost_layers(product, delta):
+    """
+    أثر تعديل كمية المنتج يدوياً: طبقة جديدة بتكلفة المنتج عند الزيادة، أو استهلاك عند النقص.
+    يرجع التغير في قيمة المخزون.
+    """
+    if delta > 0:
+        add_cost_layers([cost_layer_row(product.id, delta, product.cost, date.today(), 'adjustment')])
+        return delta * product.cost
+    if delta < 0:
+        return -consume_cost_layers([(product.id, -delta)])[0]
+    return 0.0
+
+
+def cost_history_select():
+    """كل بنود الشراء والبيع (مع الأرشيف) بترتيب تاريخ الفاتورة ثم وقت ترحيلها"""
+    movements = [
+        db.select(
+            db.literal(kind.name).label('kind'),
+            kind.invoice.date.label('date'),
+            kind.invoice.created_date.label('created_date'),
+            kind.item.id.label('id'),
+            kind.item.product_id.label('product_id'),
+            kind.item.quantity.label('quantity'),
+            kind.item.total.label('total'),
+        ).join(kind.invoice, kind.item.invoice_id == kind.invoice.id)
+        for kind in map(invoice_history, (PURCHASE_KIND, SALE_KIND))
+    ]
+    history = db.union_all(*movements).subquery()
+    return db.select(history).order_by(
+        history.c.date, history.c.created_date, history.c.kind, history.c.id
+    )
+
+
+def rebuild_cost_layers():
+    """
+    إعادة بناء طبقات التكلفة وتكلفة كل بند بيع في مرور واحد متدفق على سجل الفواتير.
+    رصيد أول المدة لكل منتج = الكمية الحالية - المشتريات + المبيعات، بتكلفة المنتج الحالية.
+    يرجع عدد بنود البيع التي أعيد تسعيرها.
+    """
+    method = cost_method()
+    products = {
+        product_id: (quantity or 0, cost or 0.0)
+        for product_id, quantity, cost in db.session.execute(db.select(Product.id, Product.quantity, Product.cost))
+    }
+    opening = {product_id: quantity for product_id, (quantity, _) in products.items()}
+    for kind in map(invoice_history, (PURCHASE_KIND, SALE_KIND)):
+        moved = db.session.execute(
+            db.select(kind.item.product_id, db.func.sum(kind.item.quantity)).group_by(kind.item.product_id)
+        )
+        for product_id, quantity in moved:
+            if product_id in opening:
+                opening[product_id] -= kind.stock_sign * (quantity or 0)
+
+    first_day = db.session.scalar(
+        db.select(db.func.min(invoice_history(SALE_KIND).invoice.date))
+    ) or date.today()
+    layers = {}
+    for product_id, quantity in opening.items():
+        if quantity > 0:
+            layers[product_id] = deque([[
+                None, quantity, products[product_id][1],
+                cost_layer_row(product_id, quantity, products[product_id][1], first_day, 'opening'),
+            ]])
+
+    # البند في أحد الجدولين فقط (المعرفات لا تتكرر بينهما)
+    set_costs = [
+        table.update().where(table.c.id == db.bindparam('item_key')).values(cost=db.bindparam('line_cost'))
+        for table in (SaleItem.__table__, ARCHIVE_TABLES[SaleItem])
+    ]
+    pending, repriced = [], 0
+    history = db.session.execute(
+        cost_history_select().execution_options(yield_per=app.config['EXPORT_CHUNK_SIZE'])
+    )
+    for row in history:
+        product_layers = layers.setdefault(row.product_id, deque())
+        if row.kind == PURCHASE_KIND.name:
+            if row.quantity <= 0:
+                continue
+            unit_cost = row.total / row.quantity
+            if method == 'average' and product_layers:
+                layer = product_layers[0]
+                layer[2] = (layer[1] * layer[2] + row.quantity * unit_cost) / (layer[1] + row.quantity)
+                layer[1] += row.quantity
+                layer[3]['quantity'] += row.quantity
+                layer[3]['date'] = row.date
+            else:
+                product_layers.append([
+                    None, row.quantity, unit_cost,
+                    cost_layer_row(row.product_id, row.quantity, unit_cost, row.date, 'purchase', row.id),
+                ])
+            continue
+        cost, uncovered = take_from_layers(product_layers, row.quantity)
+        cost += uncovered * products.get(row.product_id, (0, 0.0))[1]
+        pending.append({'item_key': row.id, 'line_cost': cost})
+        if len(pending) >= app.config['EXPORT_CHUNK_SIZE']:
+            for set_cost in set_costs:
+                db.session.execute(set_cost, pending)
+            repriced += len(pending)
+            pending = []
+    if pending:
+        for set_cost in set_costs:
+            db.session.execute(set_cost, pending)
+        repriced += len(pending)
+
+    db.session.execute(CostLayer.__table__.delete())
+    rows = []
+    for product_layers in layers.values():
+        for _, remaining, unit_cost, row in product_layers:
+            row = dict(row, remaining=remaining, unit_cost=unit_cost)
+            if method == 'average':
+                row.update(source='average', purchase_item_id=None)
+            rows.append(row)
+    if rows:
+        db.session.execute(CostLayer.__table__.insert(), rows)
+    db.session.commit()
+    return repriced
+
+
+@app.cli.command('rebuild-cost-layers')
+def rebuild_cost_layers_command():
+    """إعادة حساب طبقات التكلفة وتكلفة البضاعة المباعة من سجل الفواتير"""
+    repriced = rebuild_cost_layers()
+    rebuild_rollups()
+    rebuild_dashboard_summary()
+    click.echo(f'✅ تم إعادة بناء طبقات التكلفة ({cost_method()}) وتسعير {repriced} بند بيع')
+
+# ===========================================
+# سجل حركات المخزون واللقطات الدورية
+# ===========================================
+
+def stock_movement_row(product_id, quantity, value, movement_date, source, reference_id=None):
+    """صف حركة مخزون (بنفس المفاتيح دائماً للإدخال المجمّع)"""
+    return {
+        'product_id': product_id,
+        'date': movement_date,
+        'quantity': quantity,
+        'value': value,
+        'source': source,
+        'reference_id': reference_id,
+    }
+
+
+def record_stock_movements(rows, close_months=True):
+    """
+    إضافة حركات إلى السجل بعبارة واحدة. الحركات المؤرخة في يوم لقطة سابقة أو قبله
+    (فواتير بتاريخ قديم) تُضاف أيضاً إلى اللقطات التالية لها، فتبقى اللقطات صحيحة دائماً.
+    أول حركة بعد انتهاء شهر تأخذ لقطات الأشهر المنتهية في نفس المعاملة (close_months).
+    """
+    rows = [row for row in rows if row['quantity'] or row['value']]
+    if not rows:
+        return
+    latest = db.session.scalar(db.select(db.func.max(StockSnapshot.date)))
+    if close_months and (latest is None or latest < last_closed_month_end()):
+        insert_stock_snapshots()
+        latest = db.session.scalar(db.select(db.func.max(StockSnapshot.date)))
+    db.session.execute(db.insert(StockMovement), rows)
+    if latest is None:
+        return
+    backdated = {}
+    for row in rows:
+        if row['date'] <= latest:
+            key = (row['product_id'], row['date'])
+            quantity, value = backdated.get(key, (0, 0.0))
+            backdated[key] = (quantity + row['quantity'], value + row['value'])
+    for (product_id, movement_date), (quantity, value) in backdated.items():
+        merge_rollup_rows(StockSnapshot.__table__, db.select(
+            StockSnapshot.date.label('date'),
+            db.literal(product_id).label('product_id'),
+            db.literal(quantity).label('quantity'),
+            db.literal(value).label('value'),
+        ).where(StockSnapshot.date >= movement_date).group_by(StockSnapshot.date), ('date', 'product_id'))
+
+
+def invoice_movement_rows(kind, invoice_id, invoice_date, lines):
+    """حركات بنود فاتورة [(product_id, quantity, value)] مجمعة لكل منتج"""
+    totals = {}
+    for product_id, quantity, value in lines:
+        total_quantity, total_value = totals.get(product_id, (0, 0.0))
+        totals[product_id] = (total_quantity + quantity, total_value + value)
+    return [
+        stock_movement_row(product_id, kind.stock_sign * quantity, value, invoice_date, kind.name, invoice_id)
+        for product_id, (quantity, value) in totals.items()
+    ]
+
+
+def month_end(day):
+    """آخر يوم في شهر التاريخ"""
+    next_month = day.replace(day=28) + timedelta(days=4)
+    return next_month - timedelta(days=next_month.day)
+
+
+def stock_balances_select(day, snapshot_date=None):
+    """
+    رصيد كل منتج في نهاية اليوم day: صفوف أقرب لقطة سابقة + حركات ما بعدها حتى day فقط،
+    فحجم المسح محدود بفترة اللقطات مهما طال السجل.
+    """
+    movements = db.select(StockMovement.product_id, StockMovement.quantity, StockMovement.value) \
+        .where(StockMovement.date <= day)
+    parts = [movements]
+    if snapshot_date is not None:
+        parts[0] = movements.where(StockMovement.date > snapshot_date)
+        parts.append(
+            db.select(StockSnapshot.product_id, StockSnapshot.quantity, StockSnapshot.value)
+            .where(StockSnapshot.date == snapshot_date)
+        )
+    combined = db.union_all(*parts).subquery()
+    return db.select(
+        combined.c.product_id,
+        db.func.sum(combined.c.quantity).label('quantity'),
+        db.func.sum(combined.c.value).label('value'),
+    ).group_by(combined.c.product_id)
+
+
+def latest_snapshot_date(day):
+    """تاريخ آخر لقطة في يوم day أو قبله"""
+    return db.session.scalar(db.select(db.func.max(StockSnapshot.date)).where(StockSnapshot.date <= day))
+
+
+def last_closed_month_end():
+    """آخر يوم في الشهر الماضي"""
+    return date.today().replace(day=1) - timedelta(days=1)
+
+
+def take_stock_snapshots(until=None):
+    """إضافة لقطات نهاية الشهر الناقصة حتى until ثم commit. يرجع عدد اللقطات المضافة."""
+    taken = insert_stock_snapshots(until)
+    db.session.commit()
+    return taken
+
+
+def insert_stock_snapshots(until=None):
+    """
+    إضافة لقطات نهاية الشهر الناقصة حتى until (افتراضياً نهاية الشهر الماضي) في المعاملة الحالية،
+    كل لقطة من اللقطة السابقة وحركات شهرها فقط. يرجع عدد اللقطات المضافة.
+    """
+    until = until or last_closed_month_end()
+    latest = db.session.scalar(db.select(db.func.max(StockSnapshot.date)))
+    if latest is not None:
+        period_end = month_end(latest + timedelta(days=1))
+    else:
+        first_day = db.session.scalar(db.select(db.func.min(StockMovement.date)))
+        if first_day is None:
+            return 0
+        period_end = month_end(first_day)
+    taken = 0
+    while period_end <= until:
+        balances = stock_balances_select(period_end, latest).subquery()
+        statement = (upsert_insert() or db.insert)(StockSnapshot).from_select(
+            ['date', 'product_id', 'quantity', 'value'],
+            db.select(db.literal(period_end), balances.c.product_id, balances.c.quantity, balances.c.value)
+            .where(db.or_(balances.c.quantity != 0, db.func.abs(balances.c.value) > MONEY_EPSILON)),
+        )
+        if hasattr(statement, 'on_conflict_do_nothing'):
+            # كاتبان متزامنان في أول الشهر يأخذان نفس اللقطة
+            statement = statement.on_conflict_do_nothing()
+        db.session.execute(statement)
+        latest, period_end = period_end, month_end(period_end + timedelta(days=1))
+        taken += 1
+    return taken
+
+
+def rebuild_stock_ledger():
+    """
+    إعادة بناء سجل الحركات من الفواتير والأرشيف (لقواعد البيانات السابقة للسجل) ثم اللقطات.
+    رصيد أول المدة = الكمية الحالية - المشتريات + المبيعات، بتكلفة المنتج الحالية.
+    """
+    db.session.execute(db.delete(StockSnapshot))
+    db.session.execute(db.delete(StockMovement))
+    kinds = [invoice_history(kind) for kind in (PURCHASE_KIND, SALE_KIND)]
+    first_days = [db.session.scalar(db.select(db.func.min(kind.invoice.date))) for kind in kinds]
+    opening_day = min([day for day in first_days if day is not None], default=date.today())
+
+    opening = {
+        product_id: (quantity or 0, cost or 0.0)
+        for product_id, quantity, cost in db.session.execute(db.select(Product.id, Product.quantity, Product.cost))
+    }
+    for kind in kinds:
+        moved = db.session.execute(
+            db.select(kind.item.product_id, db.func.sum(kind.item.quantity)).group_by(kind.item.product_id)
+        )
+        for product_id, quantity in moved:
+            if product_id in opening:
+                current, cost = opening[product_id]
+                opening[product_id] = (current - kind.stock_sign * (quantity or 0), cost)
+    # اللقطات تؤخذ بعد إضافة كل الحركات لا بعد أرصدة أول المدة وحدها
+    record_stock_movements([
+        stock_movement_row(product_id, quantity, quantity * cost, opening_day, 'opening')
+        for product_id, (quantity, cost) in opening.items() if quantity
+    ], close_months=False)
+
+    for kind in kinds:
+        invoice_model, item_model = kind.invoice, kind.item
+        value = item_model.total if kind.name == PURCHASE_KIND.name else -sale_line_cost(item_model)
+        db.session.execute(db.insert(StockMovement).from_select(
+            ['product_id', 'date', 'quantity', 'value', 'source', 'reference_id'],
+            db.select(
+                item_model.product_id, invoice_model.date, kind.stock_sign * db.func.sum(item_model.quantity),
+                db.func.sum(value), db.literal(kind.name), invoice_model.id,
+            ).select_from(item_model)
+            .join(invoice_model, item_model.invoice_id == invoice_model.id)
+            .outerjoin(Product, item_model.product_id == Product.id)
+            .group_by(invoice_model.id, invoice_model.date, item_model.product_id),
+        ))
+    db.session.commit()
+    take_stock_snapshots()
+
+
+@app.cli.command('snapshot-stock')
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']), help='آخر تاريخ للقطات (افتراضياً نهاية الشهر الماضي)')
+def snapshot_stock_command(until):
+    """إضافة لقطات المخزون الشهرية الناقصة (تؤخذ تلقائياً مع أول حركة في الشهر؛ ويمكن جدولتها عبر cron)"""
+    taken = take_stock_snapshots(until.date() if until else None)
+    click.echo(f'✅ تمت إضافة {taken} لقطة')
+
+
+@app.cli.command('rebuild-stock-ledger')
+def rebuild_stock_ledger_command():
+    """إعادة بناء سجل حركات المخزون ولقطاته من سجل الفواتير"""
+    rebuild_stock_ledger()
+    click.echo('✅ تم إعادة بناء سجل حركات المخزون')
+
+# ===========================================
+# التجميعات اليومية (Rollups)
+# ===========================================
+
+def product_rollup_select(kind, invoice_ids=None):
+    """تجميع عناصر الفواتير حسب (اليوم، المنتج)؛ لكل الفواتير أو لفواتير محددة"""
+    invoice_model, item_model = kind.invoice, kind.item
+    if kind.name == SALE_KIND.name:
+        revenue = item_model.total
+        cost = sale_line_cost(item_model)
+    else:
+        revenue = db.literal(0.0)
+        cost = item_model.total
+    statement = db.select(
+        db.literal(kind.name).label('kind'),
+        invoice_model.date.label('day'),
+        item_model.product_id.label('product_id'),
+        db.func.sum(item_model.quantity).label('quantity'),
+        db.func.sum(revenue).label('revenue'),
+        db.func.sum(cost).label('cost'),
+        db.func.sum(db.func.coalesce(item_model.discount, 0.0)).label('discount'),
+        db.func.count(item_model.id).label('lines'),
+    ).select_from(item_model) \
+        .join(invoice_model, item_model.invoice_id == invoice_model.id) \
+        .outerjoin(Product, item_model.product_id == Product.id) \
+        .group_by(invoice_model.date, item_model.product_id)
+    if invoice_ids is not None:
+        statement = statement.where(item_model.invoice_id.in_(invoice_ids))
+    return statement
+
+
+def party_rollup_select(kind, invoice_ids=None):
+    """تجميع الفواتير حسب (اليوم، العميل/المورد)"""
+    invoice_model, item_model = kind.invoice, kind.item
+    party_column = getattr(invoice_model, kind.party_field)
+    if kind.name == SALE_KIND.name:
+        line_costs = db.select(
+            item_model.invoice_id.label('invoice_id'),
+            db.func.sum(sale_line_cost(item_model)).label('cost'),
+        ).outerjoin(Product, item_model.product_id == Product.id).group_by(item_model.invoice_id)
+        if invoice_ids is not None:
+            line_costs = line_costs.where(item_model.invoice_id.in_(invoice_ids))
+        line_costs = line_costs.subquery()
+        revenue = invoice_model.total
+        cost = db.func.coalesce(line_costs.c.cost, 0.0)
+    else:
+        line_costs = None
+        revenue = db.literal(0.0)
+        cost = invoice_model.total
+    statement = db.select(
+        db.literal(kind.name).label('kind'),
+        invoice_model.date.label('day'),
+        party_column.label('party_id'),
+        db.func.count(invoice_model.id).label('invoices'),
+        db.func.sum(revenue).label('revenue'),
+        db.func.sum(cost).label('cost'),
+        db.func.sum(db.func.coalesce(invoice_model.discount_total, 0.0)).label('discount'),
+        db.func.sum(db.func.coalesce(invoice_model.paid, 0.0)).label('paid'),
+        db.func.sum(invoice_model.remaining).label('remaining'),
+    ).select_from(invoice_model)
+    if line_costs is not None:
+        statement = statement.outerjoin(line_costs, line_costs.c.invoice_id == invoice_model.id)
+    statement = statement.where(party_column.isnot(None)).group_by(invoice_model.date, party_column)
+    if invoice_ids is not None:
+        statement = statement.where(invoice_model.id.in_(invoice_ids))
+    return statement
+
+
+ROLLUPS = (
+    (ProductDailyRollup, product_rollup_select, ('kind', 'day', 'product_id')),
+    (PartyDailyRollup, party_rollup_select, ('kind', 'day', 'party_id')),
+)
+
+
+def merge_rollup_rows(table, statement, key_columns):
+    """إضافة نتيجة استعلام التجميع إلى جدول التجميع (INSERT ... SELECT ... ON CONFLICT)"""
+    columns = [column.name for column in statement.selected_columns]
+    value_columns = [column for column in columns if column not in key_columns]
+    insert = upsert_insert()
+    if insert is not None:
+        merge = insert(table).from_select(columns, statement)
+        merge = merge.on_conflict_do_update(
+            index_elements=list(key_columns),
+            set_={column: table.c[column] + merge.excluded[column] for column in value_columns},
+        )
+        db.session.execute(merge)
+        return
+    for row in db.session.execute(statement).mappings().all():
+        key = {column: row[column] for column in key_columns}
+        updated = db.session.execute(
+            table.update()
+            .where(*[table.c[column] == value for column, value in key.items()])
+            .values({column: table.c[column] + row[column] for column in value_columns})
+        )
+        if updated.rowcount == 0:
+            db.session.execute(table.insert().values(**row))
+
+
+def record_invoice_rollups(kind, invoice_ids):
+    """تحديث التجميعات اليومية لفواتير جديدة في نفس معاملة الترحيل"""
+    if not invoice_ids:
+        return
+    for model, build_select, key_columns in ROLLUPS:
+        merge_rollup_rows(model.__table__, build_select(kind, invoice_ids), key_columns)
+
+
+def rebuild_rollups():
+    """إعادة بناء جداول التجميع اليومي من كامل سجل الفواتير (مع الأرشيف)"""
+    for model, build_select, _ in ROLLUPS:
+        table = model.__table__
+        db.session.execute(table.delete())
+        for kind in (SALE_KIND, PURCHASE_KIND):
+            statement = build_select(invoice_history(kind))
+            columns = [column.name for column in statement.selected_columns]
+            db.session.execute(table.insert().from_select(columns, statement))
+    bump_versions(SaleInvoice, PurchaseInvoice)
+    db.session.commit()
+
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """إعادة حساب جداول التجميع اليومي للتقارير من سجل الفواتير"""
+    rebuild_rollups()
+    click.echo('✅ تم إعادة بناء التجميعات اليومية')
+
+# ===========================================
+# التقسيم إلى صفحات (Keyset Pagination)
+# ===========================================
+
+class QueryArgumentError(ValueError):
+    """خطأ في معاملات الطلب (التقسيم، التصفية، الصيغة)"""
+
+
+def encode_cursor(values):
+    """تحويل قيم مفتاح آخر صف إلى رمز نصي آمن للروابط"""
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """فك رمز المؤشر إلى قائمة القيم"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, TypeError):
+        raise QueryArgumentError('مؤشر الصفحة غير صالح')
+    if not isinstance(values, list):
+        raise QueryArgumentError('مؤشر الصفحة غير صالح')
+    return values
+
+
+def parse_date_arg(name):
+    """قراءة تاريخ اختياري بصيغة YYYY-MM-DD من معاملات الطلب"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise QueryArgumentError(f'صيغة التاريخ غير صحيحة: {name}')
+
+
+def parse_int_arg(name):
+    """قراءة رقم صحيح اختياري من معاملات الطلب"""
+    value = request.args.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise QueryArgumentError(f'قيمة غير صحيحة: {name}')
+
+
+def parse_float_arg(name):
+    """قراءة رقم عشري اختياري من معاملات الطلب"""
+    value = request.args.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise QueryArgumentError(f'قيمة غير صحيحة: {name}')
+
+
+def keyset_page(query, model, sort_fields=('id',), fetch=lambda query: query.all()):
+    """
+    تطبيق التقسيم بمفتاح الصف (keyset) على الاستعلام.
+
+    المعاملات المقبولة: limit و after و sort (من sort_fields) و order (asc/desc).
+    fetch تنفذ الاستعلام (Query أو select) وترجع قائمة صفوف لها الخاصيتان id و sort.
+    يرجع (الصفوف، مؤشر الصفحة التالية أو None).
+    """
+    sort = request.args.get('sort', sort_fields[0])
+    if sort not in sort_fields:
+        raise QueryArgumentError(f'حقل الترتيب غير مدعوم: {sort}')
+    order = request.args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise QueryArgumentError('اتجاه الترتيب يجب أن يكون asc أو desc')
+
+    after = request.args.get('after')
+    limit = parse_int_arg('limit')
+    if limit is None:
+        limit = app.config['API_PAGE_SIZE']
+    if limit is None and after:
+        limit = app.config['API_MAX_PAGE_SIZE']
+    if limit is not None and not 1 <= limit <= app.config['API_MAX_PAGE_SIZE']:
+        raise QueryArgumentError(f"limit يجب أن يكون بين 1 و {app.config['API_MAX_PAGE_SIZE']}")
+
+    # الترتيب دائماً ينتهي بالمعرف لضمان ترتيب ثابت وفريد
+    id_column = model.id
+    columns = [id_column] if sort == 'id' else [getattr(model, sort), id_column]
+    descending = order == 'desc'
+
+    if after:
+        values = decode_cursor(after)
+        if len(values) != len(columns):
+            raise QueryArgumentError('مؤشر الصفحة لا يطابق حقل الترتيب')
+        if sort == 'date':
+            try:
+                values[0] = date.fromisoformat(values[0])
+            except (TypeError, ValueError):
+                raise QueryArgumentError('مؤشر الصفحة غير صالح')
+        key = db.tuple_(*columns) if len(columns) > 1 else columns[0]
+        bound = tuple(values) if len(columns) > 1 else values[0]
+        query = query.filter(key < bound if descending else key > bound)
+
+    query = query.order_by(*[column.desc() if descending else column.asc() for column in columns])
+    if limit is None:
+        return fetch(query), None
+
+    rows = fetch(query.limit(limit + 1))
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    if sort == 'id':
+        values = [last.id]
+    else:
+        value = getattr(last, sort)
+        values = [value if isinstance(value, str) else value.isoformat(), last.id]
+    return rows, encode_cursor(values)
+
+
+def sale_invoices_query():
+    """استعلام فواتير المبيعات مع تحميل العميل والعناصر ومنتجاتها مسبقاً (بدون N+1)"""
+    return SaleInvoice.query.options(
+        db.joinedload(SaleInvoice.customer),
+        db.selectinload(SaleInvoice.items).joinedload(SaleItem.product),
+    )
+
+
+def filter_invoices(query, model, party_field):
+    """تصفية الفواتير حسب الحالة والفترة الزمنية والعميل/المورد"""
+    if request.args.get('status'):
+        query = query.filter(model.status == request.args['status'])
+    party_id = parse_int_arg(party_field)
+    if party_id is not None:
+        query = query.filter(getattr(model, party_field) == party_id)
+    date_from = parse_date_arg('date_from')
+    if date_from:
+        query = query.filter(model.date >= date_from)
+    date_to = parse_date_arg('date_to')
+    if date_to:
+        # نطاق نصف مفتوح [date_from, date_to + يوم) ليستخدم فهرس التاريخ
+        query = query.filter(model.date < date_to + timedelta(days=1))
+    return query
+
+
+@app.errorhandler(QueryArgumentError)
+def handle_query_argument_error(error):
+    return jsonify({'success': False, 'error': str(error)}), 400
+
+# ===========================================
+# القراءة الخفيفة للقوائم (SQLAlchemy Core بدون كائنات ORM)
+# ===========================================
+
+def date_text(column):
+    """التاريخ كنص YYYY-MM-DD من قاعدة البيانات مباشرة بدل strftime لكل صف"""
+    return db.func.substr(db.cast(column, db.String), 1, 10)
+
+
+def model_columns(model, names):
+    """أعمدة النموذج بأسماء حقول to_dict (التواريخ كنص)"""
+    columns = {}
+    for name in names:
+        column = getattr(model, name)
+        if isinstance(column.type, (db.Date, db.DateTime)):
+            column = date_text(column).label(name)
+        columns[name] = column
+    return columns
+
+
+def invoice_columns(kind):
+    """أعمدة رأس الفاتورة بأسماء حقول to_dict؛ items تُقرأ باستعلام منفصل لكل صفحة"""
+    party_name = kind.party_field.replace('_id', '_name')
+    columns = model_columns(kind.invoice, ('id', 'invoice_number', kind.party_field))
+    columns[party_name] = db.func.coalesce(kind.party.name, '').label(party_name)
+    columns.update(model_columns(kind.invoice, (
+        'date', 'subtotal', 'discount_total', 'tax_total', 'total', 'paid', 'remaining', 'status',
+    )))
+    columns['items'] = None
+    return columns
+
+
+# حقول to_dict لكل قائمة والعمود الذي يُقرأ منه كل حقل
+LIGHT_COLUMNS = {
+    Customer: model_columns(Customer, ('id', 'name', 'phone', 'address', 'balance', 'status', 'created_date')),
+    Supplier: model_columns(Supplier, (
+        'id', 'name', 'phone', 'address', 'contact_person', 'balance', 'status', 'created_date',
+    )),
+    Product: model_columns(Product, (
+        'id', 'name', 'code', 'price', 'cost', 'unit', 'quantity', 'min_stock', 'category', 'created_date',
+    )),
+    SaleInvoice: invoice_columns(SALE_KIND),
+    PurchaseInvoice: invoice_columns(PURCHASE_KIND),
+}
+# نفس الحقول على كامل السجل (مع الأرشيف) لقوائم الفترات المؤرشفة
+for kind in (SALE_KIND, PURCHASE_KIND):
+    LIGHT_COLUMNS[invoice_history(kind).invoice] = invoice_columns(invoice_history(kind))
+
+
+def requested_fields(model):
+    """حقول الاستجابة من ?fields=a,b (افتراضياً كل حقول to_dict)"""
+    columns = LIGHT_COLUMNS[model]
+    value = request.args.get('fields')
+    if value is None:
+        return list(columns)
+    fields = list(dict.fromkeys(name.strip() for name in value.split(',') if name.strip()))
+    unknown = [name for name in fields if name not in columns]
+    if unknown:
+        raise QueryArgumentError(f"حقول غير معروفة: {', '.join(unknown)}")
+    if not fields:
+        raise QueryArgumentError('fields لا يحتوي على أي حقل')
+    return fields
+
+
+def light_select(model, fields, keys=('id',)):
+    """استعلام أعمدة الحقول المطلوبة فقط، ثم أعمدة مفاتيح الترتيب غير المطلوبة في النهاية"""
+    columns = LIGHT_COLUMNS[model]
+    names = [name for name in fields if columns[name] is not None]
+    names += [name for name in keys if name not in names]
+    return db.select(*[columns[name] for name in names]).select_from(model)
+
+
+def invoice_light_select(kind, fields):
+    """استعلام رؤوس الفواتير مع اسم الطرف (LEFT JOIN) عند طلبه"""
+    statement = light_select(kind.invoice, fields, keys=('id', 'date'))
+    if kind.party_field.replace('_id', '_name') in fields:
+        party_column = getattr(kind.invoice, kind.party_field)
+        statement = statement.outerjoin(kind.party, party_column == kind.party.id)
+    return statement
+
+
+@lru_cache(maxsize=64)
+def light_row_type(names):
+    """صنف الصف المضغوط (namedtuple بلا قاموس لكل كائن) لمجموعة أعمدة"""
+    return namedtuple('LightRow', names)
+
+
+def light_fetch(statement):
+    """تنفيذ الاستعلام وإرجاع الصفوف كـ namedtuple دون المرور بخريطة الهوية في الجلسة"""
+    result = db.session.execute(statement)
+    row_type = light_row_type(tuple(result.keys()))
+    return list(map(row_type._make, result))
+
+
+def invoice_items(kind, invoice_ids, chunk_size=500):
+    """عناصر الفواتير بأسماء حقول to_dict مجمعة حسب الفاتورة (استعلام لكل 500 فاتورة)"""
+    item = kind.item
+    names = ('id', 'product_id', 'product_name', 'quantity', kind.amount_field, 'discount', 'total')
+    statement = db.select(
+        item.invoice_id, item.id, item.product_id, db.func.coalesce(Product.name, ''),
+        item.quantity, getattr(item, kind.amount_field), item.discount, item.total,
+    ).outerjoin(Product, item.product_id == Product.id)
+    grouped = {}
+    for start in range(0, len(invoice_ids), chunk_size):
+        rows = db.session.execute(
+            statement.where(item.invoice_id.in_(invoice_ids[start:start + chunk_size]))
+            .order_by(item.invoice_id, item.id)
+        )
+        for row in rows:
+            grouped.setdefault(row[0], []).append(dict(zip(names, row[1:])))
+    return grouped
+
+
+@lru_cache(maxsize=None)
+def fast_json_module():
+    """orjson عند أول استخدام، أو None إن لم تكن مثبتة (اختيارية)"""
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson
+
+
+def json_response(data):
+    """استجابة JSON بـ jsonify (مطابقة للسابق بايتاً ببايت) أو بـ orjson عند تفعيل FAST_JSON"""
+    orjson = fast_json_module() if app.config['FAST_JSON'] else None
+    if orjson is not None:
+        return Response(orjson.dumps(data, option=orjson.OPT_SORT_KEYS) + b'\n', mimetype='application/json')
+    return jsonify(data)
+
+
+def light_dicts(rows, fields, items=None):
+    """تحويل الصفوف المضغوطة إلى قواميس بنفس شكل to_dict (أو الحقول المطلوبة فقط)"""
+    names = [name for name in fields if name != 'items']
+    data = [dict(zip(names, row)) for row in rows]
+    if items is not None:
+        for entry, row in zip(data, rows):
+            entry['items'] = items.get(row.id, [])
+    return data
+
+
+def page_response(rows, next_cursor, fields, items=None):
+    """قائمة الصفوف كـ JSON مع مؤشر الصفحة التالية في الترويسة X-Next-Cursor"""
+    response = json_response(light_dicts(rows, fields, items))
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+
+def invoice_page(kind):
+    """قائمة فواتير المبيعات أو المشتريات بالتصفية والتقسيم وعناصر كل فاتورة"""
+    kind = invoices_for_range(kind, parse_date_arg('date_from'), parse_date_arg('date_to'))
+    fields = requested_fields(kind.invoice)
+    statement = filter_invoices(invoice_light_select(kind, fields), kind.invoice, kind.party_field)
+    rows, next_cursor = keyset_page(statement, kind.invoice, sort_fields=('id', 'date'), fetch=light_fetch)
+    items = invoice_items(kind, [row.id for row in rows]) if 'items' in fields else None
+    return page_response(rows, next_cursor, fields, items)
+
+# ===========================================
+# GET الشرطي (ETag) وذاكرة الاستجابات
+# ===========================================
+
+def bump_versions(*models):
+    """زيادة رقم إصدار الجداول المعدّلة في نفس معاملة الكتابة"""
+    # القيمة الأولى مشتقة من الوقت حتى لا تتكرر الأرقام إذا أُعيد إنشاء قاعدة البيانات
+    initial = time.time_ns() // 1000
+    # تُحسب عند commit كتابات محلية حتى لا يعيد event_poller بثها للمشتركين في هذه العملية
+    db.session.info.setdefault('bumped_versions', []).extend((current_branch(), model.__tablename__) for model in models)
+    for model in models:
+        upsert_increment(TableVersion.__table__, {'name': model.__tablename__}, 'version', 1, initial=initial)
+
+
+def table_versions(models):
+    """أرقام إصدار الجداول المطلوبة بقراءة واحدة من جدول الإصدارات فقط"""
+    names = [model.__tablename__ for model in models]
+    stored = dict(db.session.execute(
+        db.select(TableVersion.name, TableVersion.version).where(TableVersion.name.in_(names))
+    ).all())
+    return tuple(stored.get(name, 0) for name in names)
+
+
+class ResponseCache:
+    """ذاكرة LRU محدودة للاستجابات المسلسلة، مفتاحها (المسار، المعاملات، الإصدارات)"""
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry, max_size):
+        if max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+response_cache = ResponseCache()
+
+
+def conditional_get(*models):
+    """
+    مزخرف لمسارات القراءة: ETag قوي من إصدارات الجداول التي تعتمد عليها الاستجابة.
+    If-None-Match المطابق يرجع 304 دون قراءة جداول البيانات، والاستجابات المتكررة
+    تُقدَّم من الذاكرة دون إعادة التسلسل.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # التاريخ جزء من المفتاح لأن لوحة التحكم تعتمد على الشهر الحالي
+            key = (current_branch(), request.path, request.query_string, table_versions(models),
+                   date.today().isoformat())
+            etag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            entry = response_cache.get(key)
+            if entry is None:
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                entry = (response.get_data(), response.mimetype, response.headers.get('X-Next-Cursor'))
+                response_cache.put(key, entry, app.config['RESPONSE_CACHE_SIZE'])
+            body, mimetype, next_cursor = entry
+            response = Response(body, mimetype=mimetype)
+            if next_cursor:
+                response.headers['X-Next-Cursor'] = next_cursor
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+# ===========================================
+# البحث في المنتجات والعملاء (SQLite FTS5)
+# ===========================================
+
+# التشكيل والتطويل، وتوحيد أشكال الألف والتاء المربوطة والألف المقصورة والأرقام العربية
+ARABIC_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+ARABIC_LETTER_MAP = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ة': 'ه', 'ى': 'ي',
+    '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4',
+    '٥': '5', '٦': '6', '٧': '7', '٨': '8', '٩': '9',
+})
+
+# جدول الفهرس والأعمدة المفهرسة لكل نموذج
+SEARCH_INDEXES = {
+    Product: ('product_search', ('name', 'code', 'category')),
+    Customer: ('customer_search', ('name', 'phone')),
+}
+
+for _model, (_table, _columns) in SEARCH_INDEXES.items():
+    event.listen(db.metadata, 'after_create', DDL(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {_table} USING fts5("
+        f"{', '.join(_columns)}, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    ).execute_if(dialect='sqlite'))
+    event.listen(db.metadata, 'before_drop', DDL(
+        f'DROP TABLE IF EXISTS {_table}'
+    ).execute_if(dialect='sqlite'))
+
+
+def normalize_arabic(text):
+    """توحيد النص العربي للبحث: إزالة التشكيل وتوحيد الألف والتاء المربوطة والأرقام"""
+    if not text:
+        return ''
+    return ARABIC_DIACRITICS.sub('', text).translate(ARABIC_LETTER_MAP).lower()
+
+
+def search_enabled():
+    """فهرس FTS5 متاح فقط على SQLite"""
+    return db.session.get_bind().dialect.name == 'sqlite'
+
+
+def update_search_index(model, rows=(), deleted_ids=()):
+    """تحديث فهرس البحث لصفوف مضافة/معدلة أو محذوفة في نفس معاملة الكتابة"""
+    if not search_enabled():
+        return
+    table, columns = SEARCH_INDEXES[model]
+    stale_ids = [row.id for row in rows] + list(deleted_ids)
+    if stale_ids:
+        db.session.execute(
+            db.text(f'DELETE FROM {table} WHERE rowid = :rowid'),
+            [{'rowid': row_id} for row_id in stale_ids],
+        )
+    if rows:
+        db.session.execute(
+            db.text(f"INSERT INTO {table} (rowid, {', '.join(columns)}) "
+                    f"VALUES (:rowid, {', '.join(':' + column for column in columns)})"),
+            [
+                dict({column: normalize_arabic(getattr(row, column)) for column in columns}, rowid=row.id)
+                for row in rows
+            ],
+        )
+
+
+def rebuild_search_index(models=None, batch_size=1000):
+    """إعادة بناء فهارس البحث من جداول المنتجات والعملاء (أو النماذج models فقط)"""
+    if not search_enabled():
+        return
+    for model in models or SEARCH_INDEXES:
+        table, _ = SEARCH_INDEXES[model]
+        db.session.execute(db.text(f'DELETE FROM {table}'))
+        last_id = 0
+        while True:
+            rows = model.query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            update_search_index(model, rows)
+            last_id = rows[-1].id
+    db.session.commit()
+
+
+def stale_search_indexes():
+    """النماذج التي لا يطابق عدد صفوف فهرس بحثها عدد صفوف جدولها (مثل قواعد أقدم من الفهرس)"""
+    return [
+        model for model, (table, _) in SEARCH_INDEXES.items()
+        if db.session.scalar(db.text(f'SELECT COUNT(*) FROM {table}'))
+        != db.session.scalar(db.select(db.func.count()).select_from(model))
+    ]
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """إعادة بناء فهرس البحث في المنتجات والعملاء"""
+    rebuild_search_index()
+    click.echo('✅ تم إعادة بناء فهرس البحث')
+
+
+def search_rows(model, text, limit):
+    """البحث في النموذج بالنص وإرجاع الصفوف مرتبة حسب الصلة"""
+    terms = normalize_arabic(text).split()
+    if not terms:
+        return []
+    table, columns = SEARCH_INDEXES[model]
+    if not search_enabled():
+        # بدون FTS5: مطابقة جزئية غير مفهرسة على الأعمدة الأصلية
+        conditions = [
+            db.or_(*[getattr(model, column).ilike(f'%{term}%') for column in columns])
+            for term in terms
+        ]
+        return model.query.filter(*conditions).order_by(model.id).limit(limit).all()
+    # كل كلمة كبادئة: "كمبيوتر"* "محم"*
+    match = ' '.join('"' + term.replace('"', '""') + '"*' for term in terms)
+    ids = db.session.scalars(
+        db.text(f'SELECT rowid FROM {table} WHERE {table} MATCH :match ORDER BY rank LIMIT :limit'),
+        {'match': match, 'limit': limit},
+    ).all()
+    rows = {row.id: row for row in model.query.filter(model.id.in_(ids))}
+    return [rows[row_id] for row_id in ids if row_id in rows]
+
+
+def search_limit():
+    """عدد نتائج البحث المطلوب (افتراضياً 20 وبحد أقصى 100)"""
+    limit = parse_int_arg('limit') or 20
+    if not 1 <= limit <= 100:
+        raise QueryArgumentError('limit يجب أن يكون بين 1 و 100')
+    return limit
+
+# ===========================================
+#Routes - الصفحة الرئيسية
+# ===========================================
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+@app.route('/dashboard')
+def dashboard():
+    return render_template('dashboard.html')
+
+# ===========================================
+# API - العملاء
+# ===========================================
+
+@app.route('/api/customers', methods=['GET'])
+@conditional_get(Customer)
+def get_customers():
+    fields = requested_fields(Customer)
+    statement = light_select(Customer, fields)
+    if request.args.get('status'):
+        statement = statement.where(Customer.status == request.args['status'])
+    customers, next_cursor = keyset_page(statement, Customer, fetch=light_fetch)
+    return page_response(customers, next_cursor, fields)
+
+@app.route('/api/customers/search', methods=['GET'])
+@conditional_get(Customer)
+def search_customers():
+    customers = search_rows(Customer, request.args.get('q', ''), search_limit())
+    return jsonify([customer.to_dict() for customer in customers])
+
+@app.route('/api/customers', methods=['POST'])
+def add_customer():
+    data = request.get_json()
+    
+    customer = Customer(
+        name=data['name'],
+        phone=data.get('phone', ''),
+        address=data.get('address', ''),
+        balance=data.get('balance', 0.0),
+        status=data.get('status', 'active')
+    )
+    
+    db.session.add(customer)
+    db.session.flush()
+    update_search_index(Customer, [customer])
+    bump_summary('customers', 1)
+    bump_versions(Customer)
+    db.session.commit()
+    
+    return jsonify({'success': True, 'customer': customer.to_dict()})
+
+@app.route('/api/customers/<int:customer_id>', methods=['PUT'])
+def update_customer(customer_id):
+    customer = Customer.query.get_or_404(customer_id)
+    data = request.get_json()
+    
+    customer.name = data['name']
+    customer.phone = data.get('phone', '')
+    customer.address = data.get('address', '')
+    customer.balance = data.get('balance', 0.0)
+    customer.status = data.get('status', 'active')
+    
+    update_search_index(Customer, [customer])
+    bump_versions(Customer)
+    db.session.commit()
+    
+    return jsonify({'success': True, 'customer': customer.to_dict()})
+
+@app.route('/api/customers/<int:customer_id>', methods=['DELETE'])
+def delete_customer(customer_id):
+    customer = Customer.query.get_or_404(customer_id)
+    db.session.delete(customer)
+    update_search_index(Customer, deleted_ids=[customer_id])
+    record_tombstones(Customer, [customer_id])
+    bump_summary('customers', -1)
+    bump_versions(Customer)
+    db.session.commit()
+    
+    return jsonify({'success': True})
+
+# ===========================================
+# API - الموردين
+# ===========================================
+
+@app.route('/api/suppliers', methods=['GET'])
+@conditional_get(Supplier)
+def get_suppliers():
+    fields = requested_fields(Supplier)
+    statement = light_select(Supplier, fields)
+    if request.args.get('status'):
+        statement = statement.where(Supplier.status == request.args['status'])
+    suppliers, next_cursor = keyset_page(statement, Supplier, fetch=light_fetch)
+    return page_response(suppliers, next_cursor, fields)
+
+@app.route('/api/suppliers', methods=['POST'])
+def add_supplier():
+    data = request.get_json()
+    
+    supplier = Supplier(
+        name=data['name'],
+        phone=data.get('phone', ''),
+        address=data.get('address', ''),
+        contact_person=data.get('contact_person', ''),
+        balance=data.get('balance', 0.0),
+        status=data.get('status', 'active')
+    )
+    
+    db.session.add(supplier)
+    bump_summary('suppliers', 1)
+    bump_versions(Supplier)
+    db.session.commit()
+    
+    return jsonify({'success': True, 'supplier': supplier.to_dict()})
+
+@app.route('/api/suppliers/<int:supplier_id>', methods=['PUT'])
+def update_supplier(supplier_id):
+    supplier = Supplier.query.get_or_404(supplier_id)
+    data = request.get_json()
+    
+    supplier.name = data['name']
+    supplier.phone = data.get('phone', '')
+    supplier.address = data.get('address', '')
+    supplier.contact_person = data.get('contact_person', '')
+    supplier.balance = data.get('balance', 0.0)
+    supplier.status = data.get('status', 'active')
+    
+    bump_versions(Supplier)
+    db.session.commit()
+    
+    return jsonify({'success': True, 'supplier': supplier.to_dict()})
+
+@app.route('/api/suppliers/<int:supplier_id>', methods=['DELETE'])
+def delete_supplier(supplier_id):
+    supplier = Supplier.query.get_or_404(supplier_id)
+    db.session.delete(supplier)
+    record_tombstones(Supplier, [supplier_id])
+    bump_summary('suppliers', -1)
+    bump_versions(Supplier)
+    db.session.commit()
+    
+    return jsonify({'success': True})
+
+# ===========================================
+# API - المنتجات
+# ===========================================
+
+@app.route('/api/products', methods=['GET'])
+@conditional_get(Product)
+def get_products():
+    fields = requested_fields(Product)
+    statement = light_select(Product, fields)
+    if request.args.get('category'):
+        statement = statement.where(Product.category == request.args['category'])
+    products, next_cursor = keyset_page(statement, Product, fetch=light_fetch)
+    return page_response(products, next_cursor, fields)
+
+@app.route('/api/products/search', methods=['GET'])
+@conditional_get(Product)
+def search_products():
+    # البحث بالكود (مثل قارئ الباركود) عبر الفهرس الفريد مباشرة
+    code = request.args.get('code')
+    if code:
+        product = Product.query.filter_by(code=code).first()
+        return jsonify([product.to_dict()] if product else [])
+    
+    query_text = request.args.get('q', '')
+    limit = search_limit()
+    products = search_rows(Product, query_text, limit)
+    exact = Product.query.filter_by(code=query_text.strip()).first() if query_text.strip() else None
+    if exact:
+        products = [exact] + [product for product in products if product.id != exact.id][:limit - 1]
+    return jsonify([product.to_dict() for product in products])
+
+@app.route('/api/products', methods=['POST'])
+def add_product():
+    data = request.get_json()
+    
+    product = Product(
+        name=data['name'],
+        code=data.get('code', ''),
+        price=float(data['price']),
+        cost=float(data['cost']),
+        unit=data.get('unit', 'قطعة'),
+        quantity=int(data.get('quantity', 0)),
+        min_stock=int(data.get('min_stock', 5)),
+        category=data.get('category', '')
+    )
+    
+    db.session.add(product)
+    db.session.flush()
+    # رصيد أول المدة كطبقة تكلفة بسعر تكلفة المنتج
+    add_cost_layers([cost_layer_row(product.id, product.quantity, product.cost, date.today(), 'opening')])
+    record_stock_movements([
+        stock_movement_row(product.id, product.quantity, product.quantity * product.cost, date.today(), 'opening')
+    ])
+    update_search_index(Product, [product])
+    bump_summary('products', 1)
+    bump_summary('low_stock', low_stock_count([product.id]))
+    bump_versions(Product)
+    db.session.commit()
+    
+    return jsonify({'success': True, 'product': product.to_dict()})
+
+@app.route('/api/products/<int:product_id>', methods=['PUT'])
+def update_product(product_id):
+    data = request.get_json()
+    # قفل صف المنتج (UPDATE بلا تغيير) قبل قراءة الكمية السابقة: لا تُرحَّل فاتورة بين القراءة
+    # والكتابة فيسجل السجل وطبقات التكلفة فرقاً خاطئاً (وفي SQLite تبدأ المعاملة كاتبة لا قارئة)
+    db.session.execute(db.update(Product).where(Product.id == product_id).values(quantity=Product.quantity))
+    product = Product.query.populate_existing().get_or_404(product_id)
+    levels_before = stock_levels([product_id])
+    
+    product.name = data['name']
+    product.code = data.get('code', '')
+    product.price = float(data['price'])
+    product.cost = float(data['cost'])
+    product.unit = data.get('unit', 'قطعة')
+    quantity_before = product.quantity or 0
+    product.quantity = int(data.get('quantity', 0))
+    product.min_stock = int(data.get('min_stock', 5))
+    product.category = data.get('category', '')
+    
+    quantity_delta = product.quantity - quantity_before
+    value_delta = adjust_cost_layers(product, quantity_delta)
+    record_stock_movements([
+        stock_movement_row(product_id, quantity_delta, value_delta, date.today(), 'adjustment')
+    ])
+    update_search_index(Product, [product])
+    levels_after = stock_levels([product_id])
+    bump_summary('low_stock', low_stock_delta(levels_before, levels_after))
+    bump_versions(Product)
+    db.session.commit()
+    publish_write_events(stock_events(levels_before, levels_after))
+    
+    return jsonify({'success': True, 'product': product.to_dict()})
+
+@app.route('/api/products/<int:product_id>', methods=['DELETE'])
+def delete_product(product_id):
+    product = Product.query.get_or_404(product_id)
+    low_stock_before = low_stock_count([product_id])
+    # إخراج الرصيد المتبقي من السجل ثم حذف طبقات التكلفة
+    stock_value = db.session.scalar(
+        db.select(db.func.sum(CostLayer.remaining * CostLayer.unit_cost))
+        .where(CostLayer.product_id == product_id, above_zero(CostLayer.remaining))
+    ) or 0.0
+    record_stock_movements([
+        stock_movement_row(product_id, -(product.quantity or 0), -stock_value, date.today(), 'removal')
+    ])
+    db.session.delete(product)
+    db.session.execute(db.delete(CostLayer).where(CostLayer.product_id == product_id))
+    update_search_index(Product, deleted_ids=[product_id])
+    record_tombstones(Product, [product_id])
+    bump_summary('products', -1)
+    bump_summary('low_stock', -low_stock_before)
+    bump_versions(Product)
+    db.session.commit()
+    
+    return jsonify({'success': True})
+
+# ===========================================
+# API - فواتير المبيعات
+# ===========================================
+
+@app.route('/api/sales', methods=['GET'])
+@conditional_get(SaleInvoice, Customer, Product)
+def get_sales():
+    return invoice_page(SALE_KIND)
+
+@app.route('/api/sales', methods=['POST'])
+def add_sale():
+    data = request.get_json()
+    if app.config['GROUP_COMMIT']:
+        response = group_commit_post(SALE_KIND, data)
+        if response is not None:
+            return response
+    
+    # إنشاء رقم الفاتورة تلقائياً
+    invoice_number = allocate_invoice_numbers(SALE_KIND)[0]
+    
+    sale_invoice = SaleInvoice(
+        customer_id=data['customer_id'],
+        invoice_number=invoice_number,
+        date=datetime.strptime(data['date'], '%Y-%m-%d').date(),
+        subtotal=float(data['subtotal']),
+        discount_total=float(data.get('discount_total', 0.0)),
+        tax_total=float(data.get('tax_total', 0.0)),
+        total=float(data['total']),
+        paid=float(data.get('paid', 0.0)),
+        remaining=float(data['remaining']),
+        status=data.get('status', 'partial')
+    )
+    
+    product_ids = [item_data['product_id'] for item_data in data['items']]
+    levels_before = stock_levels(product_ids)
+    
     db.session.add(sale_invoice)
     db.session.flush()  # للحصول على ID الفاتورة
     
+    # تكلفة كل بند من طبقات التكلفة (FIFO أو المتوسط المرجح)
+    line_costs = consume_cost_layers([
+        (int(item_data['product_id']), int(item_data['quantity'])) for item_data in data['items']
+    ])
+    
     # إضافة عناصر الفاتورة
-    for item_data in data['items']:
+    stock_deltas = {}
+    for item_data, line_cost in zip(data['items'], line_costs):
         sale_item = SaleItem(
             invoice_id=sale_invoice.id,
             product_id=item_data['product_id'],
             quantity=int(item_data['quantity']),
             price=float(item_data['price']),
             discount=float(item_data.get('discount', 0.0)),
-            total=float(item_data['total'])
+            total=float(item_data['total']),
+            cost=line_cost
         )
         db.session.add(sale_item)
-        
-        # تحديث كمية المنتج
-        product = Product.query.get(item_data['product_id'])
-        if product:
-            product.quantity -= int(item_data['quantity'])
+        stock_deltas[sale_item.product_id] = stock_deltas.get(sale_item.product_id, 0) + sale_item.quantity
+    
+    # تحديث كمية المنتج ورصيد العميل بعبارات UPDATE ذرية
+    apply_stock_deltas(SALE_KIND, stock_deltas)
+    apply_balance_deltas(SALE_KIND, {sale_invoice.customer_id: sale_invoice.remaining})
+    record_stock_movements(invoice_movement_rows(SALE_KIND, sale_invoice.id, sale_invoice.date, [
+        (int(item_data['product_id']), int(item_data['quantity']), -line_cost)
+        for item_data, line_cost in zip(data['items'], line_costs)
+    ]))
     
-    # تحديث رصيد العميل
-    customer = Customer.query.get(data['customer_id'])
-    if customer:
-        customer.balance += float(data['remaining'])
+    # تحديث ملخص لوحة التحكم في نفس المعاملة
+    bump_invoice_totals(SALE_KIND, sale_invoice.date, sale_invoice.total)
+    bump_period_total(COGS_METRIC, sale_invoice.date, sum(line_costs))
+    levels_after = stock_levels(product_ids)
+    bump_summary('low_stock', low_stock_delta(levels_before, levels_after))
+    record_invoice_rollups(SALE_KIND, [sale_invoice.id])
+    bump_versions(SaleInvoice, Customer, Product)
     
     db.session.commit()
+    publish_write_events([invoice_event(SALE_KIND, sale_invoice), *stock_events(levels_before, levels_after)])
     
     return jsonify({'success': True, 'invoice': sale_invoice.to_dict()})
 
 # ===========================================
-# API - فواتير المشتريات (الجديدة)
+# API - فواتير المشتريات (الجديدة)
+# ===========================================
+
+@app.route('/api/purchases', methods=['GET'])
+@conditional_get(PurchaseInvoice, Supplier, Product)
+def get_purchases():
+    return invoice_page(PURCHASE_KIND)
+
+@app.route('/api/purchases', methods=['POST'])
+def add_purchase():
+    data = request.get_json()
+    
+    # إنشاء رقم الفاتورة تلقائياً
+    invoice_number = allocate_invoice_numbers(PURCHASE_KIND)[0]
+    
+    purchase_invoice = PurchaseInvoice(
+        supplier_id=data['supplier_id'],
+        invoice_number=invoice_number,
+        date=datetime.strptime(data['date'], '%Y-%m-%d').date(),
+        subtotal=float(data['subtotal']),
+        discount_total=float(data.get('discount_total', 0.0)),
+        tax_total=float(data.get('tax_total', 0.0)),
+        total=float(data['total']),
+        paid=float(data.get('paid', 0.0)),
+        remaining=float(data['remaining']),
+        status=data.get('status', 'partial')
+    )
+    
+    product_ids = [item_data['product_id'] for item_data in data['items']]
+    levels_before = stock_levels(product_ids)
+    
+    db.session.add(purchase_invoice)
+    db.session.flush()  # للحصول على ID الفاتورة
+    
+    # إضافة عناصر الفاتورة
+    stock_deltas = {}
+    purchase_items = []
+    for item_data in data['items']:
+        purchase_item = PurchaseItem(
+            invoice_id=purchase_invoice.id,
+            product_id=item_data['product_id'],
+            quantity=int(item_data['quantity']),
+            cost=float(item_data['cost']),
+            discount=float(item_data.get('discount', 0.0)),
+            total=float(item_data['total'])
+        )
+        db.session.add(purchase_item)
+        purchase_items.append(purchase_item)
+        stock_deltas[purchase_item.product_id] = stock_deltas.get(purchase_item.product_id, 0) + purchase_item.quantity
+    
+    # طبقة تكلفة لكل بند (تحتاج معرفات البنود)
+    db.session.flush()
+    add_cost_layers(purchase_layer_rows(
+        (item.id, item.product_id, item.quantity, item.total, purchase_invoice.date) for item in purchase_items
+    ))
+    
+    # تحديث كمية المنتج (زيادة المخزون) ورصيد المورد بعبارات UPDATE ذرية
+    apply_stock_deltas(PURCHASE_KIND, stock_deltas)
+    apply_balance_deltas(PURCHASE_KIND, {purchase_invoice.supplier_id: purchase_invoice.remaining})
+    record_stock_movements(invoice_movement_rows(PURCHASE_KIND, purchase_invoice.id, purchase_invoice.date, [
+        (item.product_id, item.quantity, item.total) for item in purchase_items
+    ]))
+    
+    # تحديث ملخص لوحة التحكم في نفس المعاملة
+    bump_invoice_totals(PURCHASE_KIND, purchase_invoice.date, purchase_invoice.total)
+    levels_after = stock_levels(product_ids)
+    bump_summary('low_stock', low_stock_delta(levels_before, levels_after))
+    record_invoice_rollups(PURCHASE_KIND, [purchase_invoice.id])
+    bump_versions(PurchaseInvoice, Supplier, Product)
+    
+    db.session.commit()
+    publish_write_events([invoice_event(PURCHASE_KIND, purchase_invoice), *stock_events(levels_before, levels_after)])
+    
+    return jsonify({'success': True, 'invoice': purchase_invoice.to_dict()})
+
+# ===========================================
+# API - الإدخال المجمّع للفواتير
+# ===========================================
+
+class InvoiceDataError(ValueError):
+    """بيانات فاتورة غير صالحة في الإدخال المجمّع"""
+
+
+def parse_invoice_payload(kind, data):
+    """تحويل بيانات فاتورة واحدة إلى صف رأس وقائمة عناصر (بنفس قواعد add_sale/add_purchase)"""
+    try:
+        header = {
+            kind.party_field: int(data[kind.party_field]),
+            'date': datetime.strptime(data['date'], '%Y-%m-%d').date(),
+            'subtotal': float(data['subtotal']),
+            'discount_total': float(data.get('discount_total', 0.0)),
+            'tax_total': float(data.get('tax_total', 0.0)),
+            'total': float(data['total']),
+            'paid': float(data.get('paid', 0.0)),
+            'remaining': float(data['remaining']),
+            'status': data.get('status', 'partial'),
+        }
+        items = [{
+            'product_id': int(item_data['product_id']),
+            'quantity': int(item_data['quantity']),
+            kind.amount_field: float(item_data[kind.amount_field]),
+            'discount': float(item_data.get('discount', 0.0)),
+            'total': float(item_data['total']),
+        } for item_data in data['items']]
+    except KeyError as error:
+        raise InvoiceDataError(f'حقل مطلوب غير موجود: {error.args[0]}')
+    except (TypeError, ValueError, AttributeError) as error:
+        raise InvoiceDataError(f'بيانات الفاتورة غير صالحة: {error}')
+    return header, items
+
+
+def ingest_invoice_chunk(kind, chunk):
+    """
+    إدخال دفعة من الفواتير الصالحة في معاملة واحدة:
+    إدخال الرؤوس والعناصر دفعة واحدة (executemany) ثم تحديث المخزون والأرصدة.
+    chunk: قائمة من (رقم الفاتورة في الطلب، الرأس، العناصر).
+    يرجع (قائمة (المعرف، رقم الفاتورة) بنفس ترتيب الدفعة، أحداث البث بعد commit).
+    """
+    invoice_model, item_model = kind.invoice, kind.item
+    product_ids = {item['product_id'] for _, _, items in chunk for item in items}
+    levels_before = stock_levels(product_ids)
+
+    # حجز كتلة أرقام للدفعة كاملة بعبارة واحدة
+    numbers = allocate_invoice_numbers(kind, len(chunk))
+    headers = [
+        dict(header, invoice_number=number)
+        for number, (_, header, _) in zip(numbers, chunk)
+    ]
+
+    created = db.session.execute(
+        db.insert(invoice_model).returning(
+            invoice_model.id, invoice_model.invoice_number, sort_by_parameter_order=True
+        ),
+        headers,
+    ).all()
+
+    item_rows = []
+    item_dates = []
+    stock_deltas = {}
+    balance_deltas = {}
+    for (invoice_id, _), (_, header, items) in zip(created, chunk):
+        for item in items:
+            item_rows.append(dict(item, invoice_id=invoice_id))
+            item_dates.append(header['date'])
+            stock_deltas[item['product_id']] = stock_deltas.get(item['product_id'], 0) + item['quantity']
+        party_id = header[kind.party_field]
+        balance_deltas[party_id] = balance_deltas.get(party_id, 0.0) + header['remaining']
+
+    if kind is SALE_KIND:
+        line_costs = consume_cost_layers([(row['product_id'], row['quantity']) for row in item_rows])
+        monthly_costs = {}
+        for row, line_cost, item_date in zip(item_rows, line_costs, item_dates):
+            row['cost'] = line_cost
+            month = item_date.strftime('%Y-%m')
+            monthly_costs[month] = monthly_costs.get(month, 0.0) + line_cost
+        bump_summary(COGS_METRIC, sum(line_costs))
+        for month, amount in monthly_costs.items():
+            bump_summary(COGS_METRIC, amount, month)
+        if item_rows:
+            db.session.execute(db.insert(item_model), item_rows)
+    elif item_rows:
+        item_ids = db.session.scalars(
+            db.insert(item_model).returning(item_model.id, sort_by_parameter_order=True), item_rows
+        ).all()
+        add_cost_layers(purchase_layer_rows(
+            (item_id, row['product_id'], row['quantity'], row['total'], item_date)
+            for item_id, row, item_date in zip(item_ids, item_rows, item_dates)
+        ))
+
+    apply_stock_deltas(kind, stock_deltas)
+    apply_balance_deltas(kind, balance_deltas)
+    invoice_lines = {}
+    for row, item_date in zip(item_rows, item_dates):
+        value = -row['cost'] if kind is SALE_KIND else row['total']
+        invoice_lines.setdefault((row['invoice_id'], item_date), []).append((row['product_id'], row['quantity'], value))
+    record_stock_movements([
+        movement
+        for (invoice_id, invoice_date), lines in invoice_lines.items()
+        for movement in invoice_movement_rows(kind, invoice_id, invoice_date, lines)
+    ])
+
+    for _, header, _ in chunk:
+        bump_invoice_totals(kind, header['date'], header['total'])
+    levels_after = stock_levels(product_ids)
+    bump_summary('low_stock', low_stock_delta(levels_before, levels_after))
+    record_invoice_rollups(kind, [invoice_id for invoice_id, _ in created])
+    bump_versions(kind.invoice, kind.party, Product)
+    events = [
+        invoice_event(kind, invoice_model(id=invoice_id, invoice_number=invoice_number, **header))
+        for (invoice_id, invoice_number), (_, header, _) in zip(created, chunk)
+    ]
+    return created, events + stock_events(levels_before, levels_after)
+
+
+def commit_invoice_chunk(kind, chunk, results):
+    """
+    ترحيل دفعة في معاملة واحدة وتسجيل نتيجة كل فاتورة في results. إذا فشلت الدفعة
+    تُعاد فواتيرها واحدة واحدة حتى تفشل الفاتورة المخالفة وحدها (كما في GroupCommitWriter)
+    """
+    try:
+        created, events = ingest_invoice_chunk(kind, chunk)
+        db.session.commit()
+    except (InsufficientStockError, SQLAlchemyError) as error:
+        db.session.rollback()
+        if len(chunk) > 1:
+            for entry in chunk:
+                commit_invoice_chunk(kind, [entry], results)
+            return
+        if isinstance(error, InsufficientStockError):
+            message = f'{error}: {error.short_products()}'
+        else:
+            message = f'فشل حفظ الفاتورة: {error.__class__.__name__}'
+        index = chunk[0][0]
+        results[index] = {'index': index, 'success': False, 'error': message}
+        return
+    publish_write_events(events)
+    for (invoice_id, invoice_number), (index, _, _) in zip(created, chunk):
+        results[index] = {'index': index, 'success': True, 'id': invoice_id, 'invoice_number': invoice_number}
+
+
+def bulk_ingest(kind):
+    """معالجة طلب إدخال مجمّع وإرجاع نتيجة كل فاتورة على حدة"""
+    data = request.get_json(silent=True) or {}
+    payloads = data.get('invoices')
+    if not isinstance(payloads, list):
+        raise QueryArgumentError('يجب إرسال قائمة الفواتير في الحقل invoices')
+    if len(payloads) > app.config['BULK_MAX_INVOICES']:
+        raise QueryArgumentError(f"الحد الأقصى للفواتير في الطلب الواحد {app.config['BULK_MAX_INVOICES']}")
+    chunk_size = parse_int_arg('chunk_size') or app.config['BULK_CHUNK_SIZE']
+    if chunk_size < 1:
+        raise QueryArgumentError('chunk_size يجب أن يكون أكبر من صفر')
+
+    results = [None] * len(payloads)
+    parsed = []
+    for index, payload in enumerate(payloads):
+        try:
+            header, items = parse_invoice_payload(kind, payload)
+        except InvoiceDataError as error:
+            results[index] = {'index': index, 'success': False, 'error': str(error)}
+        else:
+            parsed.append((index, header, items))
+
+    # استعلام واحد لكل من المنتجات والعملاء/الموردين المشار إليهم
+    product_ids = {item['product_id'] for _, _, items in parsed for item in items}
+    party_ids = {header[kind.party_field] for _, header, _ in parsed}
+    known_products = set(db.session.scalars(db.select(Product.id).where(Product.id.in_(product_ids))))
+    known_parties = set(db.session.scalars(db.select(kind.party.id).where(kind.party.id.in_(party_ids))))
+
+    valid = []
+    for index, header, items in parsed:
+        missing = [item['product_id'] for item in items if item['product_id'] not in known_products]
+        if header[kind.party_field] not in known_parties:
+            results[index] = {'index': index, 'success': False, 'error': f'{kind.party_field} غير موجود'}
+        elif missing:
+            results[index] = {'index': index, 'success': False, 'error': f'منتجات غير موجودة: {missing}'}
+        else:
+            valid.append((index, header, items))
+
+    for start in range(0, len(valid), chunk_size):
+        commit_invoice_chunk(kind, valid[start:start + chunk_size], results)
+
+    succeeded = sum(1 for result in results if result['success'])
+    return jsonify({
+        'success': succeeded == len(results),
+        'created': succeeded,
+        'failed': len(results) - succeeded,
+        'results': results,
+    })
+
+
+@app.route('/api/sales/bulk', methods=['POST'])
+def bulk_add_sales():
+    return bulk_ingest(SALE_KIND)
+
+
+@app.route('/api/purchases/bulk', methods=['POST'])
+def bulk_add_purchases():
+    return bulk_ingest(PURCHASE_KIND)
+
+# ===========================================
+# الترحيل المجمّع للطلبات المتزامنة (Group Commit)
+# ===========================================
+
+class GroupCommitWriter:
+    """
+    كاتب واحد في العملية يجمع فواتير الطلبات المتزامنة ويرحّلها في معاملة واحدة بـ commit واحد
+    (بدلاً من fsync وانتظار قفل الكتابة لكل فاتورة). الدفعة تضم ما ينتظر في الطابور، ثم ما يصل
+    خلال GROUP_COMMIT_WINDOW_MS، وبحد أقصى GROUP_COMMIT_MAX_BATCH فاتورة بترتيب الوصول.
+    إذا فشلت دفعة تُعاد فواتيرها فرادى حتى يحصل كل طلب على نتيجته أو خطئه هو فقط.
+    فواتير كل فرع تُرحَّل في معاملة على قاعدته.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, kind, header, items):
+        """إضافة فاتورة للدفعة التالية؛ يرجع Future بـ (المعرف، رقم الفاتورة) أو None إذا امتلأ الطابور"""
+        if self._queue.qsize() >= app.config['GROUP_COMMIT_MAX_PENDING']:
+            return None
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+                self._thread.start()
+        future = Future()
+        self._queue.put((current_branch(), kind, header, items, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        max_batch = app.config['GROUP_COMMIT_MAX_BATCH']
+        deadline = time.monotonic() + app.config['GROUP_COMMIT_WINDOW_MS'] / 1000
+        while len(batch) < max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            # الطلبات التي انتهت مهلتها وسُحبت (cancel) لا تُرحَّل؛ البقية لا يمكن سحبها بعد الآن
+            batch = [entry for entry in self._next_batch() if entry[-1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                for branch in dict.fromkeys(entry[0] for entry in batch):
+                    with app.app_context():
+                        g.branch = branch
+                        for kind in (SALE_KIND, PURCHASE_KIND):
+                            entries = [entry for entry in batch if entry[:2] == (branch, kind)]
+                            if entries:
+                                self._commit(kind, entries)
+            except Exception as error:
+                # الكاتب لا يتوقف، وكل طلب لم يحصل على نتيجته يحصل على الخطأ
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def _commit(self, kind, entries):
+        try:
+            created, events = ingest_invoice_chunk(kind, [
+                (index, header, items) for index, (_, _, header, items, _) in enumerate(entries)
+            ])
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            if len(entries) == 1:
+                entries[0][-1].set_exception(error)
+                return
+            for entry in entries:
+                self._commit(kind, [entry])
+            return
+        for (invoice_id, invoice_number), (*_, future) in zip(created, entries):
+            future.set_result((invoice_id, invoice_number))
+        publish_write_events(events)
+
+
+group_commit_writer = GroupCommitWriter()
+
+
+def group_commit_post(kind, data):
+    """
+    ترحيل فاتورة الطلب عبر الكاتب المجمّع وإرجاع نفس استجابة المسار المباشر،
+    أو None إذا كان الطابور ممتلئاً (فيرحّلها المسار المباشر بنفسه).
+    """
+    try:
+        header, items = parse_invoice_payload(kind, data)
+    except InvoiceDataError as error:
+        return jsonify({'success': False, 'error': str(error)}), 400
+    future = group_commit_writer.submit(kind, header, items)
+    if future is None:
+        return None
+    timeout = app.config['GROUP_COMMIT_TIMEOUT_MS'] / 1000
+    try:
+        invoice_id, _ = future.result(timeout=timeout)
+    except FutureTimeoutError:
+        # لم يبدأ الكاتب بها بعد: تُسحب وتُرحَّل مباشرة
+        if future.cancel():
+            return None
+        # الكاتب يرحّلها الآن: انتظار مهلة أخرى ثم خطأ (قد تكون رُحِّلت؛ لا تُعاد دون التحقق)
+        try:
+            invoice_id, _ = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            return jsonify({'success': False, 'error': 'انتهت مهلة ترحيل الفاتورة؛ تحقق من القائمة قبل إعادة الإرسال'}), 504
+    return jsonify({'success': True, 'invoice': db.session.get(kind.invoice, invoice_id).to_dict()})
+
+# ===========================================
+# API - المدفوعات وتخصيصها على الفواتير
+# ===========================================
+
+PAYMENT_TYPES = {'customers': SALE_KIND, 'suppliers': PURCHASE_KIND}
+# فرق المبالغ الذي يُعتبر صفراً (أخطاء التقريب في الأعداد العشرية)
+MONEY_EPSILON = 0.005
+
+
+class PaymentDataError(ValueError):
+    """بيانات دفعة غير صالحة في الاستلام المجمّع"""
+
+
+def payment_kind():
+    """نوع المدفوعات من المعامل type (customers أو suppliers)"""
+    party_type = request.args.get('type', 'customers')
+    if party_type not in PAYMENT_TYPES:
+        raise QueryArgumentError('type يجب أن يكون customers أو suppliers')
+    return PAYMENT_TYPES[party_type]
+
+
+def parse_payment_payload(kind, data):
+    """تحويل بيانات دفعة واحدة إلى صف Payment"""
+    try:
+        row = {
+            'kind': kind.name,
+            'party_id': int(data[kind.party_field]),
+            'date': datetime.strptime(data['date'], '%Y-%m-%d').date() if data.get('date') else date.today(),
+            'amount': float(data['amount']),
+            'reference': str(data['reference']) if data.get('reference') else None,
+            'method': data.get('method', 'bank'),
+            'notes': data.get('notes'),
+        }
+    except KeyError as error:
+        raise PaymentDataError(f'حقل مطلوب غير موجود: {error.args[0]}')
+    except (TypeError, ValueError, AttributeError) as error:
+        raise PaymentDataError(f'بيانات الدفعة غير صالحة: {error}')
+    if row['amount'] <= 0:
+        raise PaymentDataError('مبلغ الدفعة يجب أن يكون أكبر من صفر')
+    row['unallocated'] = row['amount']
+    return row
+
+
+def open_invoice_ranges(kind, party_ids):
+    """
+    الفواتير المفتوحة لكل طرف كنطاقات متتالية [start, end) من المتبقي بترتيب (التاريخ، المعرف)،
+    محسوبة بدالة نافذة على الفهرس الجزئي للفواتير المفتوحة.
+    """
+    invoice_model = kind.invoice
+    party_column = getattr(invoice_model, kind.party_field)
+    end = db.func.sum(invoice_model.remaining).over(
+        partition_by=party_column, order_by=(invoice_model.date, invoice_model.id)
+    )
+    return db.select(
+        invoice_model.id.label('invoice_id'),
+        invoice_model.date.label('day'),
+        party_column.label('party_id'),
+        (end - invoice_model.remaining).label('start'),
+        end.label('end'),
+    ).where(above_zero(invoice_model.remaining), party_column.in_(party_ids)).cte('open_invoices')
+
+
+def payment_ranges(payment_ids):
+    """الدفعات الجديدة لكل طرف كنطاقات متتالية [start, end) بترتيب تسجيلها"""
+    end = db.func.sum(Payment.amount).over(partition_by=Payment.party_id, order_by=Payment.id)
+    return db.select(
+        Payment.id.label('payment_id'),
+        Payment.party_id.label('party_id'),
+        (end - Payment.amount).label('start'),
+        end.label('end'),
+    ).where(Payment.id.in_(payment_ids)).cte('new_payments')
+
+
+def allocate_payments(kind, payment_ids, party_ids):
+    """
+    تخصيص دفعات جديدة على الفواتير المفتوحة، الأقدم أولاً، بعبارات SQL على المجموعة كاملة:
+    التخصيص = تقاطع نطاق الدفعة مع نطاق الفاتورة لنفس الطرف، ثم تحديث المتبقي والحالة
+    للفواتير والمبلغ غير المخصص للدفعات وتجميعات التقارير.
+    """
+    # صفوف الأطراف مقفلة (في PostgreSQL) حتى لا ترى دفعتان متزامنتان لنفس الطرف نفس المتبقي؛
+    # بترتيب المعرف حتى لا تتقاطع أقفال الدفعات
+    db.session.execute(
+        db.select(kind.party.id).where(kind.party.id.in_(party_ids)).order_by(kind.party.id).with_for_update()
+    )
+    invoices = open_invoice_ranges(kind, party_ids)
+    payments = payment_ranges(payment_ids)
+    overlap = db.case((payments.c.end < invoices.c.end, payments.c.end), else_=invoices.c.end) - \
+        db.case((payments.c.start > invoices.c.start, payments.c.start), else_=invoices.c.start)
+    matches = db.select(
+        payments.c.payment_id, db.literal(kind.name), invoices.c.invoice_id, overlap,
+    ).join(invoices, db.and_(
+        payments.c.party_id == invoices.c.party_id,
+        payments.c.start < invoices.c.end - MONEY_EPSILON,
+        invoices.c.start < payments.c.end - MONEY_EPSILON,
+    ))
+    db.session.execute(
+        db.insert(PaymentAllocation).from_select(['payment_id', 'kind', 'invoice_id', 'amount'], matches)
+    )
+
+    allocations = PaymentAllocation.__table__
+    batch = db.and_(allocations.c.kind == kind.name, allocations.c.payment_id.in_(payment_ids))
+
+    table = kind.invoice.__table__
+    allocated = db.select(db.func.sum(allocations.c.amount)) \
+        .where(batch, allocations.c.invoice_id == table.c.id).scalar_subquery()
+    left = table.c.remaining - allocated
+    db.session.execute(
+        table.update()
+        .where(table.c.id.in_(db.select(allocations.c.invoice_id).where(batch)))
+        .values(
+            paid=db.func.coalesce(table.c.paid, 0.0) + allocated,
+            remaining=db.case((left <= MONEY_EPSILON, 0.0), else_=left),
+            status=db.case((left <= MONEY_EPSILON, 'completed'), else_='partial'),
+        )
+    )
+
+    payment_table = Payment.__table__
+    applied = db.select(db.func.coalesce(db.func.sum(allocations.c.amount), 0.0)) \
+        .where(allocations.c.payment_id == payment_table.c.id).scalar_subquery()
+    db.session.execute(
+        payment_table.update()
+        .where(payment_table.c.id.in_(payment_ids))
+        .values(unallocated=payment_table.c.amount - applied)
+    )
+
+    # المدفوع والمتبقي في التجميع اليومي على يوم الفاتورة
+    invoice_model = kind.invoice
+    party_column = getattr(invoice_model, kind.party_field)
+    paid = db.func.sum(PaymentAllocation.amount)
+    merge_rollup_rows(PartyDailyRollup.__table__, db.select(
+        db.literal(kind.name).label('kind'),
+        invoice_model.date.label('day'),
+        party_column.label('party_id'),
+        db.literal(0).label('invoices'),
+        db.literal(0.0).label('revenue'),
+        db.literal(0.0).label('cost'),
+        db.literal(0.0).label('discount'),
+        paid.label('paid'),
+        (-paid).label('remaining'),
+    ).select_from(PaymentAllocation)
+        .join(invoice_model, PaymentAllocation.invoice_id == invoice_model.id)
+        .where(PaymentAllocation.kind == kind.name, PaymentAllocation.payment_id.in_(payment_ids))
+        .group_by(invoice_model.date, party_column), ('kind', 'day', 'party_id'))
+
+
+def record_payments(kind, rows):
+    """
+    تسجيل دفعات صالحة في معاملة واحدة: إدخالها دفعة واحدة ثم تخصيصها وتحديث أرصدة الأطراف.
+    يرجع قائمة (المعرف، المبلغ غير المخصص) بنفس الترتيب.
+    """
+    payment_ids = db.session.scalars(
+        db.insert(Payment).returning(Payment.id, sort_by_parameter_order=True), rows
+    ).all()
+    balance_deltas = {}
+    for row in rows:
+        balance_deltas[row['party_id']] = balance_deltas.get(row['party_id'], 0.0) - row['amount']
+    allocate_payments(kind, payment_ids, list(balance_deltas))
+    apply_balance_deltas(kind, balance_deltas)
+    bump_versions(kind.invoice, kind.party, Payment)
+    unallocated = dict(db.session.execute(
+        db.select(Payment.id, Payment.unallocated).where(Payment.id.in_(payment_ids))
+    ).all())
+    return [(payment_id, unallocated[payment_id]) for payment_id in payment_ids]
+
+
+@app.route('/api/payments', methods=['POST'])
+def add_payment():
+    kind = payment_kind()
+    try:
+        row = parse_payment_payload(kind, request.get_json(silent=True) or {})
+    except PaymentDataError as error:
+        return jsonify({'success': False, 'error': str(error)}), 400
+    db.get_or_404(kind.party, row['party_id'])
+    try:
+        (payment_id, _), = record_payments(kind, [row])
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': 'مرجع الدفعة مسجل من قبل'}), 409
+    payment = db.session.get(Payment, payment_id)
+    allocations = PaymentAllocation.query.filter_by(payment_id=payment_id).order_by(PaymentAllocation.id).all()
+    return jsonify({
+        'success': True,
+        'payment': payment.to_dict(),
+        'allocations': [{'invoice_id': a.invoice_id, 'amount': a.amount} for a in allocations],
+    })
+
+
+@app.route('/api/payments/bulk', methods=['POST'])
+def bulk_add_payments():
+    """
+    استلام ملف دفعات (مثل كشف البنك) وتخصيص كل دفعة على أقدم فواتير الطرف المفتوحة.
+    كل دفعة من PAYMENT_CHUNK_SIZE إيصال تُسجَّل في معاملة واحدة.
+    """
+    kind = payment_kind()
+    data = request.get_json(silent=True) or {}
+    payloads = data.get('payments')
+    if not isinstance(payloads, list):
+        raise QueryArgumentError('يجب إرسال قائمة الدفعات في الحقل payments')
+    if len(payloads) > app.config['BULK_MAX_PAYMENTS']:
+        raise QueryArgumentError(f"الحد الأقصى للدفعات في الطلب الواحد {app.config['BULK_MAX_PAYMENTS']}")
+    chunk_size = parse_int_arg('chunk_size') or app.config['PAYMENT_CHUNK_SIZE']
+    if chunk_size < 1:
+        raise QueryArgumentError('chunk_size يجب أن يكون أكبر من صفر')
+
+    results = [None] * len(payloads)
+    parsed = []
+    for index, payload in enumerate(payloads):
+        try:
+            parsed.append((index, parse_payment_payload(kind, payload)))
+        except PaymentDataError as error:
+            results[index] = {'index': index, 'success': False, 'error': str(error)}
+
+    # استعلام واحد لكل من الأطراف والمراجع المسجلة من قبل
+    party_ids = {row['party_id'] for _, row in parsed}
+    references = {row['reference'] for _, row in parsed if row['reference']}
+    known_parties = set(db.session.scalars(db.select(kind.party.id).where(kind.party.id.in_(party_ids))))
+    seen_references = set(db.session.scalars(
+        db.select(Payment.reference).where(Payment.kind == kind.name, Payment.reference.in_(references))
+    ))
+
+    valid = []
+    for index, row in parsed:
+        if row['party_id'] not in known_parties:
+            results[index] = {'index': index, 'success': False, 'error': f'{kind.party_field} غير موجود'}
+        elif row['reference'] in seen_references:
+            results[index] = {'index': index, 'success': False, 'error': 'مرجع الدفعة مسجل من قبل'}
+        else:
+            if row['reference']:
+                seen_references.add(row['reference'])
+            valid.append((index, row))
+
+    for start in range(0, len(valid), chunk_size):
+        chunk = valid[start:start + chunk_size]
+        try:
+            recorded = record_payments(kind, [row for _, row in chunk])
+            db.session.commit()
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            for index, _ in chunk:
+                results[index] = {'index': index, 'success': False, 'error': f'فشل حفظ الدفعة: {error.__class__.__name__}'}
+            continue
+        for (payment_id, unallocated), (index, row) in zip(recorded, chunk):
+            results[index] = {
+                'index': index, 'success': True, 'id': payment_id,
+                'allocated': row['amount'] - unallocated, 'unallocated': unallocated,
+            }
+
+    succeeded = sum(1 for result in results if result['success'])
+    return jsonify({
+        'success': succeeded == len(results),
+        'created': succeeded,
+        'failed': len(results) - succeeded,
+        'results': results,
+    })
+
+# ===========================================
+# API - تصدير الفواتير (NDJSON / CSV)
+# ===========================================
+
+def invoice_lines_select(kind):
+    """استعلام مسطح: صف لكل عنصر فاتورة مع بيانات رأس الفاتورة والطرف والمنتج"""
+    invoice_model, item_model, party_model = kind.invoice, kind.item, kind.party
+    party_column = getattr(invoice_model, kind.party_field)
+    return db.select(
+        invoice_model.id.label('invoice_id'),
+        invoice_model.invoice_number,
+        invoice_model.date,
+        party_column.label(kind.party_field),
+        party_model.name.label(kind.party_field.replace('_id', '_name')),
+        invoice_model.status,
+        invoice_model.subtotal,
+        invoice_model.discount_total,
+        invoice_model.tax_total,
+        invoice_model.total.label('invoice_total'),
+        invoice_model.paid,
+        invoice_model.remaining,
+        item_model.id.label('item_id'),
+        item_model.product_id,
+        Product.name.label('product_name'),
+        item_model.quantity,
+        getattr(item_model, kind.amount_field),
+        item_model.discount,
+        item_model.total.label('item_total'),
+    ).select_from(invoice_model) \
+        .outerjoin(party_model, party_column == party_model.id) \
+        .outerjoin(item_model, item_model.invoice_id == invoice_model.id) \
+        .outerjoin(Product, item_model.product_id == Product.id) \
+        .order_by(invoice_model.id, item_model.id)
+
+
+def export_response(statement, filename):
+    """بث نتيجة الاستعلام كـ NDJSON أو CSV على دفعات دون تحميلها كاملة في الذاكرة"""
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        raise QueryArgumentError('صيغة التصدير يجب أن تكون ndjson أو csv')
+    statement = statement.execution_options(yield_per=app.config['EXPORT_CHUNK_SIZE'])
+
+    def generate_ndjson():
+        result = db.session.execute(statement)
+        for rows in result.partitions():
+            yield ''.join(
+                json.dumps(row_for_export(row), ensure_ascii=False) + '\n'
+                for row in rows
+            )
+
+    def generate_csv():
+        result = db.session.execute(statement)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # BOM حتى يتعرف Excel على النص العربي بترميز UTF-8
+        writer.writerow(result.keys())
+        yield '\ufeff' + buffer.getvalue()
+        for rows in result.partitions():
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(row_for_export(row).values() for row in rows)
+            yield buffer.getvalue()
+
+    if export_format == 'csv':
+        generator, mimetype = generate_csv, 'text/csv'
+    else:
+        generator, mimetype = generate_ndjson, 'application/x-ndjson'
+    response = Response(stream_with_context(generator()), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}.{export_format}'
+    return response
+
+
+def row_for_export(row):
+    """تحويل صف النتيجة إلى قاموس قابل للتحويل إلى JSON"""
+    data = row._asdict()
+    data['date'] = data['date'].strftime('%Y-%m-%d')
+    return data
+
+
+def export_invoices(kind, filename):
+    """تصدير فواتير النوع بالتصفية (مع الأرشيف إذا طلبت الفترة تواريخ مؤرشفة)"""
+    kind = invoices_for_range(kind, parse_date_arg('date_from'), parse_date_arg('date_to'))
+    statement = filter_invoices(invoice_lines_select(kind), kind.invoice, kind.party_field)
+    return export_response(statement, filename)
+
+
+@app.route('/api/sales/export', methods=['GET'])
+def export_sales():
+    return export_invoices(SALE_KIND, 'sales')
+
+
+@app.route('/api/purchases/export', methods=['GET'])
+def export_purchases():
+    return export_invoices(PURCHASE_KIND, 'purchases')
+
+# ===========================================
+# API - المزامنة التزايدية
+# ===========================================
+
+# اسم كل كيان في استجابة المزامنة ونموذجه
+SYNC_ENTITIES = {
+    'customers': Customer, 'suppliers': Supplier, 'products': Product,
+    'sales': SaleInvoice, 'purchases': PurchaseInvoice,
+}
+SYNC_NAMES = {model: name for name, model in SYNC_ENTITIES.items()}
+SYNC_INVOICE_KINDS = {SaleInvoice: SALE_KIND, PurchaseInvoice: PURCHASE_KIND}
+# أكبر row_version بين سجلات الحذف المحذوفة: الرموز الأقدم منه تحتاج تحميلاً كاملاً
+SYNC_HORIZON = 'sync_horizon'
+
+
+def record_tombstones(model, ids):
+    """تسجيل حذف صفوف model في نفس معاملة الحذف"""
+    db.session.execute(db.insert(SyncTombstone), [
+        {'entity': SYNC_NAMES[model], 'entity_id': entity_id} for entity_id in ids
+    ])
+
+
+def counter_value(name):
+    """قيمة عداد في جدول TableVersion (0 إن لم يوجد)"""
+    return db.session.scalar(db.select(TableVersion.version).where(TableVersion.name == name)) or 0
+
+
+def sync_rows(model, since, limit):
+    """صفوف model المضافة أو المعدلة بعد الإصدار since بشكل to_dict، من فهرس row_version"""
+    kind = SYNC_INVOICE_KINDS.get(model)
+    fields = list(LIGHT_COLUMNS[model])
+    statement = invoice_light_select(kind, fields) if kind else light_select(model, fields)
+    rows = light_fetch(
+        statement.where(model.row_version > since).order_by(model.row_version, model.id).limit(limit)
+    )
+    items = invoice_items(kind, [row.id for row in rows]) if kind else None
+    return light_dicts(rows, fields, items)
+
+
+@app.route('/api/sync', methods=['GET'])
+@conditional_get(*SYNC_ENTITIES.values())
+def sync_changes():
+    """
+    التغييرات منذ رمز المزامنة since: الصفوف المضافة أو المعدلة ومعرفات المحذوفة لكل كيان.
+    reset = true (بدون since، أو رمز أقدم من سجلات الحذف المحفوظة، أو تغييرات أكثر من
+    SYNC_MAX_CHANGES) يعني: حمّل القوائم كاملة ثم تابع المزامنة من token المرجَع.
+    """
+    token = counter_value(ROW_VERSION_COUNTER)
+    reset = jsonify({'token': encode_cursor([token]), 'reset': True})
+    if not request.args.get('since'):
+        return reset
+    values = decode_cursor(request.args['since'])
+    if len(values) != 1 or not isinstance(values[0], int):
+        raise QueryArgumentError('رمز المزامنة غير صالح')
+    since = values[0]
+    # رمز من قاعدة بيانات أخرى (أُعيد إنشاؤها) أو أقدم من سجلات الحذف المحفوظة
+    if since > token or since < counter_value(SYNC_HORIZON):
+        return reset
+
+    budget = app.config['SYNC_MAX_CHANGES']
+    changes = {}
+    for name, model in SYNC_ENTITIES.items():
+        changes[name] = sync_rows(model, since, budget + 1)
+        budget -= len(changes[name])
+        if budget < 0:
+            return reset
+    tombstones = db.session.execute(
+        db.select(SyncTombstone.entity, SyncTombstone.entity_id)
+        .where(SyncTombstone.row_version > since)
+        .order_by(SyncTombstone.row_version, SyncTombstone.id)
+        .limit(budget + 1)
+    ).all()
+    if len(tombstones) > budget:
+        return reset
+
+    # صف أُعيد إنشاؤه بنفس المعرف بعد حذفه يظهر في changes فلا يُرسل حذفه
+    changed = {(name, row['id']) for name, rows in changes.items() for row in rows}
+    deleted = {name: [] for name in SYNC_ENTITIES}
+    for entity, entity_id in tombstones:
+        if (entity, entity_id) not in changed:
+            deleted[entity].append(entity_id)
+    return jsonify({'token': encode_cursor([token]), 'reset': False, 'changes': changes, 'deleted': deleted})
+
+
+def prune_tombstones(before):
+    """حذف سجلات الحذف الأقدم من before وتقديم أفق المزامنة إلى أكبر إصدار محذوف"""
+    horizon = db.session.scalar(
+        db.select(db.func.max(SyncTombstone.row_version)).where(SyncTombstone.deleted_date < before)
+    )
+    if horizon is None:
+        return 0
+    pruned = db.session.execute(db.delete(SyncTombstone).where(SyncTombstone.row_version <= horizon)).rowcount
+    db.session.merge(TableVersion(name=SYNC_HORIZON, version=max(horizon, counter_value(SYNC_HORIZON))))
+    # الاستجابات المحفوظة لرموز أصبحت أقدم من الأفق لم تعد صالحة
+    bump_versions(*SYNC_ENTITIES.values())
+    db.session.commit()
+    return pruned
+
+
+@app.cli.command('prune-tombstones')
+@click.option('--days', type=int, default=30, show_default=True, help='عمر سجلات الحذف المحفوظة بالأيام')
+def prune_tombstones_command(days):
+    """حذف سجلات الحذف القديمة؛ العملاء الذين لم يتزامنوا منذ days يوماً يعيدون التحميل الكامل"""
+    pruned = prune_tombstones(datetime.utcnow() - timedelta(days=days))
+    click.echo(f'✅ تم حذف {pruned} سجل حذف')
+
+# ===========================================
+# أرشفة الفواتير المكتملة القديمة
+# ===========================================
+
+def archived_until(kind):
+    """تاريخ أحدث فاتورة مؤرشفة من النوع (None إذا كان الأرشيف فارغاً)"""
+    return db.session.scalar(db.select(db.func.max(ARCHIVE_TABLES[kind.invoice].c.date)))
+
+
+def invoices_for_range(kind, date_from=None, date_to=None):
+    """
+    الجداول الحالية وحدها افتراضياً، أو كامل السجل مع الأرشيف إذا طلبت الفترة تواريخ مؤرشفة
+    (فترة بلا date_from تمتد إلى أول السجل).
+    """
+    if date_from is None and date_to is None:
+        return kind
+    until = archived_until(kind)
+    if until is None or (date_from is not None and date_from > until):
+        return kind
+    return invoice_history(kind)
+
+
+def archive_invoice_batch(kind, before, batch_size):
+    """
+    نقل دفعة من الفواتير المكتملة المسددة الأقدم من before مع عناصرها إلى الأرشيف في معاملة قصيرة.
+    يرجع عدد الفواتير المنقولة.
+    """
+    invoices, items = kind.invoice.__table__, kind.item.__table__
+    # أحدث فاتورة وصاحبة أحدث عنصر تبقيان: SQLite يعطي الصف الجديد أكبر معرف + 1،
+    # فلو أُرشف صاحب أكبر معرف لتكرر معرفه بين الجدول والأرشيف
+    newest_id = db.session.scalar(db.select(db.func.max(invoices.c.id)))
+    newest_item_owner = db.session.scalar(db.select(items.c.invoice_id).order_by(items.c.id.desc()).limit(1))
+    if newest_id is None:
+        return 0
+    statement = db.select(invoices.c.id).where(
+        invoices.c.status == 'completed',
+        invoices.c.remaining <= MONEY_EPSILON,
+        invoices.c.date < before,
+        invoices.c.id < newest_id,
+    ).order_by(invoices.c.id).limit(batch_size)
+    if newest_item_owner is not None:
+        statement = statement.where(invoices.c.id != newest_item_owner)
+    ids = db.session.scalars(statement).all()
+    if not ids:
+        return 0
+    for table, key in ((invoices, invoices.c.id), (items, items.c.invoice_id)):
+        archive = ARCHIVE_TABLES[kind.invoice if table is invoices else kind.item]
+        db.session.execute(archive.insert().from_select(
+            [column.name for column in table.columns], db.select(table).where(key.in_(ids))
+        ))
+    db.session.execute(items.delete().where(items.c.invoice_id.in_(ids)))
+    db.session.execute(invoices.delete().where(invoices.c.id.in_(ids)))
+    bump_versions(kind.invoice)
+    db.session.commit()
+    return len(ids)
+
+
+def archive_invoices(before, batch_size=None):
+    """
+    أرشفة الفواتير المكتملة الأقدم من before على دفعات (commit لكل دفعة فلا يطول قفل الكتابة).
+    الملخص والتجميعات اليومية لا تتغير، وإعادة بنائها تقرأ الأرشيف أيضاً. يرجع {النوع: العدد}.
+    """
+    batch_size = batch_size or app.config['ARCHIVE_BATCH_SIZE']
+    archived = {}
+    for kind in (SALE_KIND, PURCHASE_KIND):
+        archived[kind.name] = 0
+        while True:
+            moved = archive_invoice_batch(kind, before, batch_size)
+            if not moved:
+                break
+            archived[kind.name] += moved
+    return archived
+
+
+@app.cli.command('archive-invoices')
+@click.option('--days', type=int, default=365, show_default=True, help='أرشفة الفواتير المكتملة الأقدم من هذا العدد من الأيام')
+@click.option('--batch-size', type=int, help='عدد الفواتير في كل معاملة (افتراضياً ARCHIVE_BATCH_SIZE)')
+def archive_invoices_command(days, batch_size):
+    """نقل الفواتير المكتملة القديمة وعناصرها إلى جداول الأرشيف"""
+    archived = archive_invoices(date.today() - timedelta(days=days), batch_size)
+    click.echo(f"✅ تمت أرشفة {archived['sale']} فاتورة مبيعات و {archived['purchase']} فاتورة مشتريات")
+
+# ===========================================
+# API - التقارير (من التجميعات اليومية)
+# ===========================================
+
+REPORT_TYPES = {'sales': SALE_KIND, 'purchases': PURCHASE_KIND}
+REPORT_DEPENDENCIES = (SaleInvoice, PurchaseInvoice, Product, Customer, Supplier)
+
+
+def report_kind():
+    """نوع التقرير من المعامل type (sales أو purchases)"""
+    report_type = request.args.get('type', 'sales')
+    if report_type not in REPORT_TYPES:
+        raise QueryArgumentError('type يجب أن يكون sales أو purchases')
+    return REPORT_TYPES[report_type]
+
+
+def report_range():
+    """الفترة [date_from, date_to] كنطاق نصف مفتوح؛ افتراضياً آخر 30 يوماً"""
+    date_to = parse_date_arg('date_to') or date.today()
+    date_from = parse_date_arg('date_from') or date_to - timedelta(days=29)
+    if date_from > date_to:
+        raise QueryArgumentError('date_from يجب أن يكون قبل date_to')
+    return date_from, date_to + timedelta(days=1)
+
+
+def report_limit():
+    """عدد الصفوف في تقارير الأعلى (افتراضياً 10 وبحد أقصى 100)"""
+    limit = parse_int_arg('limit') or 10
+    if not 1 <= limit <= 100:
+        raise QueryArgumentError('limit يجب أن يكون بين 1 و 100')
+    return limit
+
+
+ROLLUP_MEASURES = {
+    ProductDailyRollup: ('quantity', 'revenue', 'cost', 'discount', 'lines'),
+    PartyDailyRollup: ('invoices', 'revenue', 'cost', 'discount', 'paid', 'remaining'),
+}
+
+
+def rollup_totals(model, kind):
+    """أعمدة المجاميع لجدول تجميع، مع الربح للمبيعات"""
+    names = ROLLUP_MEASURES[model]
+    columns = [db.func.sum(getattr(model, name)).label(name) for name in names]
+    if kind is SALE_KIND:
+        columns.append((db.func.sum(model.revenue) - db.func.sum(model.cost)).label('profit'))
+    return columns
+
+
+def report_order(columns):
+    """اسم عمود ترتيب تقارير الأعلى من المعامل order_by"""
+    available = [column.name for column in columns]
+    order_by = request.args.get('order_by', 'profit' if 'profit' in available else 'cost')
+    if order_by not in available:
+        raise QueryArgumentError(f'order_by غير مدعوم: {order_by}')
+    return order_by
+
+
+def top_rollup_rows(model, kind, key_column, key_name, name_model, name_label):
+    """أعلى المنتجات/الأطراف في الفترة مع أسمائها"""
+    start, end = report_range()
+    totals = rollup_totals(model, kind)
+    order_by = report_order(totals)
+    grouped = db.select(key_column.label(key_name), *totals) \
+        .where(model.kind == kind.name, model.day >= start, model.day < end) \
+        .group_by(key_column) \
+        .order_by(db.desc(order_by), key_column).limit(report_limit()).subquery()
+    statement = db.select(grouped, db.func.coalesce(name_model.name, '').label(name_label)) \
+        .outerjoin(name_model, name_model.id == grouped.c[key_name]) \
+        .order_by(grouped.c[order_by].desc(), grouped.c[key_name])
+    return report_rows(statement)
+
+
+def report_rows(statement):
+    """تحويل نتيجة التقرير إلى قوائم JSON مع تنسيق التاريخ"""
+    rows = []
+    for row in db.session.execute(statement).mappings():
+        data = dict(row)
+        if 'day' in data:
+            data['date'] = data.pop('day').strftime('%Y-%m-%d')
+        rows.append(data)
+    return rows
+
+
+@app.route('/api/reports/daily', methods=['GET'])
+@conditional_get(*REPORT_DEPENDENCIES)
+def report_daily():
+    kind = report_kind()
+    start, end = report_range()
+    statement = db.select(PartyDailyRollup.day, *rollup_totals(PartyDailyRollup, kind)) \
+        .where(PartyDailyRollup.kind == kind.name, PartyDailyRollup.day >= start, PartyDailyRollup.day < end) \
+        .group_by(PartyDailyRollup.day).order_by(PartyDailyRollup.day)
+    return jsonify(report_rows(statement))
+
+
+@app.route('/api/reports/top-products', methods=['GET'])
+@conditional_get(*REPORT_DEPENDENCIES)
+def report_top_products():
+    kind = report_kind()
+    return jsonify(top_rollup_rows(
+        ProductDailyRollup, kind, ProductDailyRollup.product_id, 'product_id', Product, 'product_name'))
+
+
+@app.route('/api/reports/top-parties', methods=['GET'])
+@conditional_get(*REPORT_DEPENDENCIES)
+def report_top_parties():
+    kind = report_kind()
+    party_name = kind.party_field.replace('_id', '_name')
+    return jsonify(top_rollup_rows(
+        PartyDailyRollup, kind, PartyDailyRollup.party_id, kind.party_field, kind.party, party_name))
+
+
+@app.route('/api/reports/products/<int:product_id>', methods=['GET'])
+@conditional_get(*REPORT_DEPENDENCIES)
+def report_product_daily(product_id):
+    kind = report_kind()
+    start, end = report_range()
+    statement = db.select(ProductDailyRollup.day, *rollup_totals(ProductDailyRollup, kind)) \
+        .where(ProductDailyRollup.kind == kind.name, ProductDailyRollup.product_id == product_id,
+               ProductDailyRollup.day >= start, ProductDailyRollup.day < end) \
+        .group_by(ProductDailyRollup.day).order_by(ProductDailyRollup.day)
+    return jsonify(report_rows(statement))
+
+MARGIN_GROUPS = {
+    'product': lambda: (ProductDailyRollup.product_id, db.func.coalesce(Product.name, '').label('product_name')),
+    'category': lambda: (db.func.coalesce(Product.category, '').label('category'),),
+    'day': lambda: (ProductDailyRollup.day,),
+}
+
+
+@app.route('/api/reports/margins', methods=['GET'])
+@conditional_get(*REPORT_DEPENDENCIES)
+def report_margins():
+    """هامش الربح (المبيعات - تكلفة البضاعة المباعة) حسب المنتج أو الفئة أو اليوم"""
+    group_by = request.args.get('group_by', 'product')
+    if group_by not in MARGIN_GROUPS:
+        raise QueryArgumentError('group_by يجب أن يكون product أو category أو day')
+    start, end = report_range()
+    keys = MARGIN_GROUPS[group_by]()
+    statement = db.select(*keys, *rollup_totals(ProductDailyRollup, SALE_KIND)) \
+        .outerjoin(Product, Product.id == ProductDailyRollup.product_id) \
+        .where(ProductDailyRollup.kind == SALE_KIND.name, ProductDailyRollup.day >= start, ProductDailyRollup.day < end) \
+        .group_by(*keys).order_by(*keys)
+    rows = report_rows(statement)
+    for row in rows:
+        row['margin'] = round(row['profit'] / row['revenue'], 4) if row['revenue'] else None
+    return jsonify(rows)
+
+# ===========================================
+# API - كشوف الحساب وأعمار الديون
 # ===========================================
 
-@app.route('/api/purchases', methods=['GET'])
-def get_purchases():
-    purchases = PurchaseInvoice.query.all()
-    return jsonify([purchase.to_dict() for purchase in purchases])
+# فئات أعمار الديون: (اسم الفئة، أقصى عمر بالأيام)، وما بعد آخرها في days_over_90
+AGING_BUCKETS = (('days_0_30', 30), ('days_31_60', 60), ('days_61_90', 90))
+AGING_OVERDUE = 'days_over_90'
+AGING_TYPES = {'customers': SALE_KIND, 'suppliers': PURCHASE_KIND}
 
-@app.route('/api/purchases', methods=['POST'])
-def add_purchase():
-    data = request.get_json()
-    
-    # إنشاء رقم الفاتورة تلقائياً
-    last_invoice = PurchaseInvoice.query.order_by(PurchaseInvoice.id.desc()).first()
-    invoice_number = f"P-{datetime.now().strftime('%Y%m%d')}-{last_invoice.id + 1 if last_invoice else 1:04d}"
-    
-    purchase_invoice = PurchaseInvoice(
-        supplier_id=data['supplier_id'],
-        invoice_number=invoice_number,
-        date=datetime.strptime(data['date'], '%Y-%m-%d').date(),
-        subtotal=float(data['subtotal']),
-        discount_total=float(data.get('discount_total', 0.0)),
-        tax_total=float(data.get('tax_total', 0.0)),
-        total=float(data['total']),
-        paid=float(data.get('paid', 0.0)),
-        remaining=float(data['remaining']),
-        status=data.get('status', 'partial')
+
+def aging_select(kind, as_of):
+    """
+    أعمار المبالغ المتبقية لكل عميل/مورد في تاريخ as_of بتجميع واحد
+    يقرأ الفهرس الجزئي للفواتير المفتوحة فقط (ix_*_invoice_open).
+    """
+    invoice_model = kind.invoice
+    party_column = getattr(invoice_model, kind.party_field)
+    columns, newer = [], None
+    for name, days in AGING_BUCKETS:
+        oldest = as_of - timedelta(days=days)
+        in_bucket = invoice_model.date >= oldest
+        if newer is not None:
+            in_bucket = db.and_(in_bucket, invoice_model.date < newer)
+        columns.append(db.func.sum(db.case((in_bucket, invoice_model.remaining), else_=0.0)).label(name))
+        newer = oldest
+    columns.append(
+        db.func.sum(db.case((invoice_model.date < newer, invoice_model.remaining), else_=0.0)).label(AGING_OVERDUE)
     )
-    
-    db.session.add(purchase_invoice)
-    db.session.flush()  # للحصول على ID الفاتورة
-    
-    # إضافة عناصر الفاتورة
-    for item_data in data['items']:
-        purchase_item = PurchaseItem(
-            invoice_id=purchase_invoice.id,
-            product_id=item_data['product_id'],
-            quantity=int(item_data['quantity']),
-            cost=float(item_data['cost']),
-            discount=float(item_data.get('discount', 0.0)),
-            total=float(item_data['total'])
-        )
-        db.session.add(purchase_item)
-        
-        # تحديث كمية المنتج (زيادة المخزون)
-        product = Product.query.get(item_data['product_id'])
-        if product:
-            product.quantity += int(item_data['quantity'])
-    
-    # تحديث رصيد المورد
-    supplier = Supplier.query.get(data['supplier_id'])
-    if supplier:
-        supplier.balance += float(data['remaining'])
-    
-    db.session.commit()
-    
-    return jsonify({'success': True, 'invoice': purchase_invoice.to_dict()})
+    return db.select(
+        party_column.label(kind.party_field),
+        db.func.count(invoice_model.id).label('invoices'),
+        db.func.sum(invoice_model.remaining).label('total'),
+        *columns,
+    ).where(above_zero(invoice_model.remaining), invoice_model.date <= as_of).group_by(party_column)
+
+
+def aging_totals(rows):
+    """مجموع كل فئة عبر جميع الصفوف"""
+    names = ['invoices', 'total'] + [name for name, _ in AGING_BUCKETS] + [AGING_OVERDUE]
+    return {name: sum(row[name] for row in rows) for name in names}
+
+
+@app.route('/api/aging', methods=['GET'])
+@conditional_get(SaleInvoice, PurchaseInvoice, Customer, Supplier)
+def aging_report():
+    party_type = request.args.get('type', 'customers')
+    if party_type not in AGING_TYPES:
+        raise QueryArgumentError('type يجب أن يكون customers أو suppliers')
+    kind = AGING_TYPES[party_type]
+    as_of = parse_date_arg('as_of') or date.today()
+    grouped = aging_select(kind, as_of).subquery()
+    party_name = kind.party_field.replace('_id', '_name')
+    statement = db.select(grouped, db.func.coalesce(kind.party.name, '').label(party_name)) \
+        .outerjoin(kind.party, kind.party.id == grouped.c[kind.party_field]) \
+        .order_by(grouped.c[kind.party_field])
+    rows = [dict(row) for row in db.session.execute(statement).mappings()]
+    return jsonify({
+        'type': party_type,
+        'as_of': as_of.strftime('%Y-%m-%d'),
+        'totals': aging_totals(rows),
+        'parties': rows,
+    })
+
+
+def party_statement(kind, party_id):
+    """
+    كشف حساب عميل/مورد: رصيد أول المدة، ثم فواتير الفترة ودفعاتها برصيد تراكمي، وأعمار المتبقي.
+    المدفوع في سطر الفاتورة هو المدفوع عند إنشائها؛ الدفعات اللاحقة تظهر في أسطر مستقلة بتاريخها.
+    """
+    party = db.get_or_404(kind.party, party_id)
+    date_from = parse_date_arg('date_from')
+    date_to = parse_date_arg('date_to') or date.today()
+    # رصيد أول المدة يجمع كل ما قبل date_from، فالكشف يقرأ الأرشيف إن وُجد
+    invoice_model = invoices_for_range(kind, None, date_to).invoice
+    party_column = getattr(invoice_model, kind.party_field)
+    allocated = db.select(db.func.coalesce(db.func.sum(PaymentAllocation.amount), 0.0)).where(
+        PaymentAllocation.kind == kind.name, PaymentAllocation.invoice_id == invoice_model.id
+    ).scalar_subquery()
+    paid_on_invoice = db.func.coalesce(invoice_model.paid, 0.0) - allocated
+    party_payments = db.and_(Payment.kind == kind.name, Payment.party_id == party_id)
+
+    opening_balance = 0.0
+    if date_from is not None:
+        opening_balance = (db.session.scalar(
+            db.select(db.func.sum(invoice_model.total - paid_on_invoice))
+            .where(party_column == party_id, invoice_model.date < date_from)
+        ) or 0.0) - (db.session.scalar(
+            db.select(db.func.sum(Payment.amount)).where(party_payments, Payment.date < date_from)
+        ) or 0.0)
+
+    invoices_query = db.select(
+        invoice_model.id, invoice_model.invoice_number, invoice_model.date, invoice_model.total,
+        paid_on_invoice.label('paid'), invoice_model.remaining, invoice_model.status,
+    ).where(party_column == party_id, invoice_model.date <= date_to)
+    payments_query = db.select(Payment).where(party_payments, Payment.date <= date_to)
+    if date_from is not None:
+        invoices_query = invoices_query.where(invoice_model.date >= date_from)
+        payments_query = payments_query.where(Payment.date >= date_from)
+
+    entries = [(row.date, 0, row.id, row) for row in db.session.execute(invoices_query)]
+    entries += [(payment.date, 1, payment.id, payment) for payment in db.session.scalars(payments_query)]
+    lines, balance = [], opening_balance
+    for entry_date, entry_type, _, row in sorted(entries, key=lambda entry: entry[:3]):
+        if entry_type == 0:
+            balance += row.total - row.paid
+            lines.append({
+                'type': 'invoice',
+                'invoice_id': row.id,
+                'invoice_number': row.invoice_number,
+                'date': entry_date.strftime('%Y-%m-%d'),
+                'total': row.total,
+                'paid': row.paid,
+                'remaining': row.remaining,
+                'status': row.status,
+                'balance': balance,
+            })
+        else:
+            balance -= row.amount
+            lines.append({
+                'type': 'payment',
+                'payment_id': row.id,
+                'reference': row.reference,
+                'date': entry_date.strftime('%Y-%m-%d'),
+                'amount': row.amount,
+                'unallocated': row.unallocated,
+                'balance': balance,
+            })
+
+    # الأرشيف لا يحوي متبقياً، فالأعمار من الجداول الحالية وفهرسها الجزئي
+    aging = db.session.execute(
+        aging_select(kind, date_to).where(getattr(kind.invoice, kind.party_field) == party_id)
+    ).mappings().first()
+    return jsonify({
+        kind.party_field.replace('_id', ''): party.to_dict(),
+        'date_from': date_from.strftime('%Y-%m-%d') if date_from else None,
+        'date_to': date_to.strftime('%Y-%m-%d'),
+        'opening_balance': opening_balance,
+        'closing_balance': balance,
+        'lines': lines,
+        'aging': aging_totals([aging] if aging else []),
+    })
+
+
+@app.route('/api/customers/<int:customer_id>/statement', methods=['GET'])
+@conditional_get(SaleInvoice, Customer, Payment)
+def customer_statement(customer_id):
+    return party_statement(SALE_KIND, customer_id)
+
+
+@app.route('/api/suppliers/<int:supplier_id>/statement', methods=['GET'])
+@conditional_get(PurchaseInvoice, Supplier, Payment)
+def supplier_statement(supplier_id):
+    return party_statement(PURCHASE_KIND, supplier_id)
+
+# ===========================================
+# API - المخزون
+# ===========================================
+
+# القيم الافتراضية لاقتراحات إعادة الطلب (قابلة للتغيير بمعاملات الطلب)
+REORDER_DEFAULTS = {'window': 90, 'lead_time': 7, 'review_days': 14, 'service_level': 0.95}
+
+# سرعة المبيعات المحسوبة لكل (فترة، إصدار جدول المبيعات): تبقى صالحة حتى تُسجَّل مبيعات جديدة
+velocity_cache = ResponseCache()
+
+
+def sales_velocity(start, days):
+    """
+    متوسط المبيعات اليومية وانحرافها المعياري لكل منتج في الأيام [start, start + days)
+    من استعلام تجميعي واحد (كمية كل منتج في كل يوم) وحسابات NumPy على المصفوفات كاملة؛
+    الأيام بلا مبيعات تُحسب أصفاراً. يرجع (معرفات المنتجات مرتبة، المتوسط، الانحراف).
+    """
+    import numpy as np
+
+    key = (current_branch(), start, days, table_versions((SaleInvoice,)))
+    cached = velocity_cache.get(key)
+    if cached is not None:
+        return cached
+    end = start + timedelta(days=days)
+    sales = invoices_for_range(SALE_KIND, start, end)
+    rows = db.session.execute(
+        db.select(sales.item.product_id, db.func.sum(sales.item.quantity))
+        .join(sales.invoice, sales.item.invoice_id == sales.invoice.id)
+        .where(sales.invoice.date >= start, sales.invoice.date < end)
+        .group_by(sales.item.product_id, sales.invoice.date)
+    ).all()
+    # فك الأعمدة بـ zip أسرع بكثير من np.array على كائنات Row
+    sold, quantities = zip(*rows) if rows else ((), ())
+    quantities = np.array(quantities, dtype=np.float64)
+    product_ids, positions = np.unique(np.array(sold, dtype=np.int64), return_inverse=True)
+    totals = np.bincount(positions, weights=quantities, minlength=len(product_ids))
+    squares = np.bincount(positions, weights=quantities ** 2, minlength=len(product_ids))
+    mean = totals / days
+    std = np.sqrt(np.maximum(squares / days - mean ** 2, 0.0))
+    result = (product_ids, mean, std)
+    velocity_cache.put(key, result, 16)
+    return result
+
+
+def reorder_argument(name, minimum, maximum, parse=parse_int_arg):
+    """معامل اقتراحات إعادة الطلب مع القيمة الافتراضية والتحقق من المدى"""
+    value = parse(name)
+    if value is None:
+        return REORDER_DEFAULTS[name]
+    if not minimum <= value <= maximum:
+        raise QueryArgumentError(f'{name} يجب أن يكون بين {minimum} و {maximum}')
+    return value
+
+
+@app.route('/api/inventory/reorder', methods=['GET'])
+@conditional_get(SaleInvoice, Product)
+def inventory_reorder():
+    """
+    اقتراحات إعادة الطلب من سرعة المبيعات في آخر window يوماً:
+    نقطة إعادة الطلب = المبيعات خلال مدة التوريد + مخزون أمان (z × الانحراف × √مدة التوريد)،
+    وكمية الطلب = ما يرفع المخزون إلى نقطة إعادة الطلب + مبيعات فترة المراجعة.
+    """
+    import numpy as np
+
+    window = reorder_argument('window', 7, 730)
+    lead_time = reorder_argument('lead_time', 0, 365)
+    review_days = reorder_argument('review_days', 0, 365)
+    service_level = reorder_argument('service_level', 0.5, 0.999, parse=parse_float_arg)
+    include_all = request.args.get('all') in ('1', 'true')
+    z = statistics.NormalDist().inv_cdf(service_level)
+
+    start = date.today() + timedelta(days=1) - timedelta(days=window)
+    sold_ids, mean, std = sales_velocity(start, window)
+
+    products = db.session.execute(
+        db.select(Product.id, Product.name, Product.code, Product.quantity, Product.min_stock).order_by(Product.id)
+    ).all()
+    if not products:
+        return jsonify([])
+    product_ids = np.fromiter((row.id for row in products), dtype=np.int64, count=len(products))
+    quantity = np.fromiter((row.quantity or 0 for row in products), dtype=np.float64, count=len(products))
+
+    # مواءمة المنتجات المباعة مع كل المنتجات (المنتج بلا مبيعات سرعته صفر)
+    velocity = np.zeros(len(products))
+    deviation = np.zeros(len(products))
+    positions = np.searchsorted(sold_ids, product_ids)
+    found = positions < len(sold_ids)
+    found[found] = sold_ids[positions[found]] == product_ids[found]
+    velocity[found] = mean[positions[found]]
+    deviation[found] = std[positions[found]]
+
+    reorder_point = np.ceil(velocity * lead_time + z * deviation * np.sqrt(lead_time))
+    order_up_to = reorder_point + velocity * review_days
+    reorder_quantity = np.where(
+        (quantity <= reorder_point) & (velocity > 0), np.maximum(np.ceil(order_up_to - quantity), 0), 0
+    )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days_of_cover = np.where(velocity > 0, np.maximum(quantity, 0) / velocity, np.inf)
+
+    selected = np.arange(len(products)) if include_all else np.flatnonzero(reorder_quantity > 0)
+    selected = selected[np.argsort(days_of_cover[selected], kind='stable')]
+    return jsonify([{
+        'product_id': int(product_ids[index]),
+        'product_name': products[index].name,
+        'code': products[index].code,
+        'quantity': int(quantity[index]),
+        'min_stock': products[index].min_stock,
+        'daily_velocity': round(float(velocity[index]), 4),
+        'daily_std': round(float(deviation[index]), 4),
+        'days_of_cover': round(float(days_of_cover[index]), 1) if np.isfinite(days_of_cover[index]) else None,
+        'suggested_min_stock': int(reorder_point[index]),
+        'reorder_quantity': int(reorder_quantity[index]),
+    } for index in selected.tolist()])
+
+
+@app.route('/api/inventory/as-of', methods=['GET'])
+@conditional_get(Product, SaleInvoice, PurchaseInvoice)
+def inventory_as_of():
+    """رصيد المخزون وقيمته بالتكلفة لكل منتج في نهاية يوم date (افتراضياً اليوم)"""
+    day = parse_date_arg('date') or date.today()
+    snapshot_date = latest_snapshot_date(day)
+    balances = stock_balances_select(day, snapshot_date)
+    product_id = parse_int_arg('product_id')
+    if product_id is not None:
+        balances = balances.having(db.literal_column('product_id') == product_id)
+    balances = balances.subquery()
+    statement = db.select(
+        balances.c.product_id,
+        db.func.coalesce(Product.name, '').label('product_name'),
+        Product.code.label('code'),
+        balances.c.quantity,
+        balances.c.value,
+    ).outerjoin(Product, Product.id == balances.c.product_id) \
+        .where(db.or_(balances.c.quantity != 0, db.func.abs(balances.c.value) > MONEY_EPSILON)) \
+        .order_by(balances.c.product_id)
+    rows = [dict(row) for row in db.session.execute(statement).mappings()]
+    return jsonify({
+        'date': day.strftime('%Y-%m-%d'),
+        'snapshot_date': snapshot_date.strftime('%Y-%m-%d') if snapshot_date else None,
+        'total_quantity': sum(row['quantity'] for row in rows),
+        'total_value': sum(row['value'] for row in rows),
+        'products': rows,
+    })
 
 # ===========================================
 # API - إحصائيات لوحة التحكم
 # ===========================================
 
+# جداول مؤشرات لوحة التحكم: ETag لـ /api/dashboard واستطلاع كتابات العمليات الأخرى (event_poller)
+DASHBOARD_MODELS = (SaleInvoice, PurchaseInvoice, Customer, Supplier, Product, DashboardSummary)
+
+
 @app.route('/api/dashboard')
+@conditional_get(*DASHBOARD_MODELS)
 def dashboard_data():
-    # إجمالي المبيعات
-    total_sales = db.session.query(db.func.sum(SaleInvoice.total)).scalar() or 0
-    
-    # إجمالي المشتريات
-    total_purchases = db.session.query(db.func.sum(PurchaseInvoice.total)).scalar() or 0
-    
-    # إجمالي العملاء
-    total_customers = Customer.query.count()
-    
-    # إجمالي الموردين
-    total_suppliers = Supplier.query.count()
-    
-    # إجمالي المنتجات
-    total_products = Product.query.count()
-    
-    # أقل من المخزون الأدنى
-    low_stock = Product.query.filter(Product.quantity <= Product.min_stock).count()
-    
     # فواتير المبيعات الأخيرة (10 فواتير)
-    recent_sales = SaleInvoice.query.order_by(SaleInvoice.created_date.desc()).limit(10).all()
+    recent_sales = sale_invoices_query().order_by(SaleInvoice.created_date.desc()).limit(10).all()
     recent_sales_data = [sale.to_dict() for sale in recent_sales]
     
-    # البيانات للشهر الحالي
-    today = date.today()
-    current_month = today.month
-    current_year = today.year
-    
-    monthly_sales = db.session.query(db.func.sum(SaleInvoice.total)).filter(
-        db.extract('month', SaleInvoice.date) == current_month,
-        db.extract('year', SaleInvoice.date) == current_year
-    ).scalar() or 0
+    return jsonify(dict(dashboard_totals(), recent_sales=recent_sales_data))
+
+
+def dashboard_totals():
+    """مؤشرات لوحة التحكم من جدول الملخص: الإجمالي الكلي وإجمالي الشهر الحالي في قراءة واحدة"""
+    current_month = date.today().strftime('%Y-%m')
+    rows = DashboardSummary.query.filter(DashboardSummary.period.in_(['', current_month])).all()
+    summary = {(row.metric, row.period): row.value for row in rows}
     
-    monthly_purchases = db.session.query(db.func.sum(PurchaseInvoice.total)).filter(
-        db.extract('month', PurchaseInvoice.date) == current_month,
-        db.extract('year', PurchaseInvoice.date) == current_year
-    ).scalar() or 0
+    total_sales = summary.get(('sales_total', ''), 0)
+    total_purchases = summary.get(('purchases_total', ''), 0)
+    cost_of_sales = summary.get((COGS_METRIC, ''), 0)
     
-    return jsonify({
+    return {
         'total_sales': total_sales,
         'total_purchases': total_purchases,
-        'total_customers': total_customers,
-        'total_suppliers': total_suppliers,
-        'total_products': total_products,
-        'low_stock': low_stock,
-        'monthly_sales': monthly_sales,
-        'monthly_purchases': monthly_purchases,
-        'recent_sales': recent_sales_data,
-        'profit': total_sales - total_purchases
+        'total_customers': int(summary.get(('customers', ''), 0)),
+        'total_suppliers': int(summary.get(('suppliers', ''), 0)),
+        'total_products': int(summary.get(('products', ''), 0)),
+        'low_stock': int(summary.get(('low_stock', ''), 0)),
+        'monthly_sales': summary.get(('sales_total', current_month), 0),
+        'monthly_purchases': summary.get(('purchases_total', current_month), 0),
+        'cost_of_sales': cost_of_sales,
+        # إجمالي الربح = المبيعات - تكلفة البضاعة المباعة (وليس المشتريات)
+        'profit': total_sales - cost_of_sales
+    }
+
+# ===========================================
+# بث الأحداث للوحة التحكم (Server-Sent Events)
+# ===========================================
+
+class EventSubscriber:
+    """
+    طابور أحداث مشترك واحد محدود بـ max_size مفتاح: الحدث الجديد يحل محل المعلّق بنفس
+    (الاسم، المفتاح)، وإذا تجاوز العميل البطيء الحد تُحذف أحداثه ويُرسل له resync واحد.
+    """
+
+    def __init__(self, max_size, branch=None):
+        self.max_size = max_size
+        self.branch = branch
+        self.dropped = 0
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+
+    def put(self, events):
+        with self._condition:
+            for name, key, data in events:
+                self._pending.pop((name, key), None)
+                self._pending[(name, key)] = data
+            if len(self._pending) > self.max_size:
+                self.dropped += len(self._pending)
+                self._pending.clear()
+                self._pending[('resync', '')] = {}
+            self._condition.notify()
+
+    def get(self, timeout):
+        """الأحداث المعلّقة [(الاسم، البيانات)] أو [] إذا انقضت المهلة دون أحداث"""
+        with self._condition:
+            if not self._pending:
+                self._condition.wait(timeout)
+            events = [(name, data) for (name, _), data in self._pending.items()]
+            self._pending.clear()
+            return events
+
+
+class EventBroker:
+    """توزيع الأحداث على المشتركين داخل العملية نفسها؛ كتابات العمليات الأخرى تصل عبر event_poller"""
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, max_size, branch=None, limit=None):
+        """None إذا وصل عدد المشتركين إلى limit (الفحص والإضافة تحت نفس القفل)"""
+        subscriber = EventSubscriber(max_size, branch)
+        with self._lock:
+            if limit is not None and len(self._subscribers) >= limit:
+                return None
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def branches(self):
+        """الفروع التي لها مشتركون الآن"""
+        with self._lock:
+            return {subscriber.branch for subscriber in self._subscribers}
+
+    def publish(self, events, branch=None):
+        """توزيع الأحداث على مشتركي الفرع الذي حدثت فيه الكتابة فقط"""
+        with self._lock:
+            subscribers = [subscriber for subscriber in self._subscribers if subscriber.branch == branch]
+        for subscriber in subscribers:
+            subscriber.put(events)
+
+
+event_broker = EventBroker()
+
+
+class EventPoller:
+    """
+    قناة مشتركة بين العمليات عبر جدول الإصدارات: كل EVENTS_POLL_SECONDS تُقرأ أرقام إصدار
+    جداول لوحة التحكم لكل فرع له مشتركون، وإذا زادت أكثر من كتابات هذه العملية (التي بُثت
+    فوراً بتفاصيلها) يُرسل resync لمشتركي الفرع فيعيدون تحميل /api/dashboard.
+    """
+
+    def __init__(self):
+        self._seen = {}
+        self._local = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, branch):
+        """بدء الاستطلاع (مرة في العملية) وقراءة أساس الفرع قبل أول اشتراك فيه"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='event-poller', daemon=True)
+                self._thread.start()
+            watched = branch in self._seen
+        if not watched:
+            self.poll(branch)
+
+    def count_local(self, bumped, step):
+        """كتابات هذه العملية [(الفرع، الجدول)]: step=1 قبل commit و -1 إذا تراجعت المعاملة"""
+        with self._lock:
+            for branch, name in bumped:
+                if branch in self._seen:
+                    key = (branch, name)
+                    self._local[key] = self._local.get(key, 0) + step
+
+    def poll(self, branch):
+        """قراءة واحدة لأرقام الإصدار؛ True إذا كتبت عملية أخرى في الفرع منذ القراءة السابقة"""
+        with app.app_context():
+            g.branch = branch
+            versions = dict(zip((model.__tablename__ for model in DASHBOARD_MODELS), table_versions(DASHBOARD_MODELS)))
+        with self._lock:
+            seen = self._seen.setdefault(branch, {})
+            changed = False
+            for name, version in versions.items():
+                if name not in seen:
+                    seen[name] = version
+                    continue
+                # أول كتابة تنشئ الصف برقم مشتق من الوقت: تُعد زيادة واحدة
+                delta = version - seen[name] if seen[name] else int(version > 0)
+                remote = delta - self._local.get((branch, name), 0)
+                # سالب: commit محلي لم يظهر بعد، فتبقى القراءة السابقة أساساً
+                if remote < 0:
+                    continue
+                seen[name] = version
+                self._local.pop((branch, name), None)
+                changed = changed or remote > 0
+            return changed
+
+    def forget(self, branch):
+        with self._lock:
+            self._seen.pop(branch, None)
+            for key in [key for key in self._local if key[0] == branch]:
+                del self._local[key]
+
+    def _run(self):
+        while True:
+            time.sleep(app.config['EVENTS_POLL_SECONDS'])
+            watched = event_broker.branches()
+            for branch in set(self._seen) - watched:
+                self.forget(branch)
+            for branch in watched:
+                try:
+                    self.publish_changes(branch)
+                except SQLAlchemyError:
+                    # قاعدة الفرع غير متاحة مؤقتاً: المحاولة في الدورة التالية
+                    continue
+
+    def publish_changes(self, branch):
+        if self.poll(branch):
+            event_broker.publish([('resync', '', {})], branch)
+
+
+event_poller = EventPoller()
+
+
+@event.listens_for(BranchSession, 'before_commit')
+def count_local_versions(session):
+    bumped = session.info.pop('bumped_versions', None)
+    if bumped:
+        session.info['committing_versions'] = bumped
+        event_poller.count_local(bumped, 1)
+
+
+@event.listens_for(BranchSession, 'after_commit')
+def forget_committed_versions(session):
+    session.info.pop('committing_versions', None)
+
+
+@event.listens_for(BranchSession, 'after_rollback')
+def uncount_rolled_back_versions(session):
+    session.info.pop('bumped_versions', None)
+    bumped = session.info.pop('committing_versions', None)
+    if bumped:
+        event_poller.count_local(bumped, -1)
+
+
+def limit_event_subscribers(threads):
+    """
+    كل اشتراك SSE يحجز خيطاً طوال الاتصال في الخوادم المتزامنة (gthread و waitress): يُقصر
+    EVENTS_MAX_SUBSCRIBERS على نصف خيوط العملية حتى يبقى الباقي للطلبات العادية
+    """
+    app.config['EVENTS_MAX_SUBSCRIBERS'] = min(app.config['EVENTS_MAX_SUBSCRIBERS'], max(1, threads // 2))
+
+
+def invoice_event(kind, invoice):
+    """حدث فاتورة جديدة: بيانات الرأس المختصرة فقط"""
+    return ('invoice', f'{kind.name}-{invoice.id}', {
+        'kind': kind.name,
+        'id': invoice.id,
+        'invoice_number': invoice.invoice_number,
+        kind.party_field: getattr(invoice, kind.party_field),
+        'date': invoice.date.strftime('%Y-%m-%d'),
+        'total': invoice.total,
+        'remaining': invoice.remaining,
     })
 
+
+def stock_events(before, after):
+    """أحداث مستوى المخزون لكل منتج، و low_stock للمنتجات التي عبرت الحد الأدنى في هذه الكتابة"""
+    events = []
+    for product_id, level in after.items():
+        data = {'product_id': product_id, 'quantity': level[0], 'min_stock': level[1], 'low': is_low_stock(level)}
+        events.append(('stock', product_id, data))
+        if product_id in before and is_low_stock(before[product_id]) != data['low']:
+            events.append(('low_stock', product_id, data))
+    return events
+
+
+def publish_write_events(events):
+    """نشر أحداث عملية كتابة بعد commit مع مؤشرات لوحة التحكم الجديدة؛ لا شيء دون مشتركين"""
+    if not event_broker.subscriber_count():
+        return
+    event_broker.publish([*events, ('summary', '', dashboard_totals())], current_branch())
+
+
+@app.route('/api/events')
+def dashboard_events():
+    """
+    بث SSE لتغييرات لوحة التحكم: invoice و summary و stock و low_stock، و resync عندما تفوت
+    العميلَ أحداث أو تكتب عملية أخرى (يعيد تحميل /api/dashboard). المشترك الخامل ينتظر دون
+    استعلام (event_poller يستعلم مرة لكل فرع في العملية)، مع نبضة
+    تعليق كل EVENTS_HEARTBEAT_SECONDS لاكتشاف الاتصالات المغلقة.
+    """
+    event_poller.watch(current_branch())
+    # المولّد يعمل بعد انتهاء الطلب، فيُحجز الاشتراك هنا بفرع الطلب
+    subscriber = event_broker.subscribe(app.config['EVENTS_QUEUE_SIZE'], current_branch(),
+                                        app.config['EVENTS_MAX_SUBSCRIBERS'])
+    if subscriber is None:
+        return jsonify({'success': False, 'error': 'عدد المشتركين في الأحداث وصل للحد الأقصى'}), 503
+    heartbeat = app.config['EVENTS_HEARTBEAT_SECONDS']
+
+    def generate():
+        yield 'retry: 5000\n\n'
+        while True:
+            events = subscriber.get(heartbeat)
+            if not events:
+                yield ': ping\n\n'
+                continue
+            yield ''.join(
+                f"event: {name}\ndata: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n"
+                for name, data in events
+            )
+
+    response = Response(generate(), mimetype='text/event-stream')
+    # الخادم يغلق الاستجابة عند انقطاع العميل، حتى لو لم يبدأ المولّد
+    response.call_on_close(lambda: event_broker.unsubscribe(subscriber))
+    response.headers['Cache-Control'] = 'no-cache'
+    # منع التخزين المؤقت في nginx حتى تصل الأحداث فوراً
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# ===========================================
+# الفروع: قاعدة لكل فرع وتقارير موحدة
+# ===========================================
+
+class UnknownBranchError(LookupError):
+    """فرع غير معرّف في BRANCH_DATABASES"""
+
+
+@app.errorhandler(UnknownBranchError)
+def handle_unknown_branch(error):
+    return jsonify({'success': False, 'error': str(error)}), 404
+
+
+@app.before_request
+def select_branch():
+    """اختيار قاعدة الطلب من الترويسة X-Branch أو المعامل branch (وإلا DEFAULT_BRANCH)"""
+    branch = request.headers.get('X-Branch') or request.args.get('branch') or app.config['DEFAULT_BRANCH']
+    if branch is not None and branch not in app.config['BRANCH_DATABASES']:
+        raise UnknownBranchError(f'فرع غير معروف: {branch}')
+    g.branch = branch
+
+
+# الخيوط تُنشأ عند الحاجة؛ كل استعلام فرع ينتظر قاعدته دون حجز GIL
+@lru_cache(maxsize=None)
+def branch_executor():
+    """مجمع خيوط الفروع، يُنشأ عند أول تقرير موحد بعد create_app() فيأخذ BRANCH_WORKERS منه"""
+    return ThreadPoolExecutor(max_workers=app.config['BRANCH_WORKERS'], thread_name_prefix='branch')
+
+
+def fan_out(function, *args):
+    """
+    تشغيل function(*args) على كل فرع بالتوازي، كلٌّ في سياق تطبيق وجلسة على قاعدته،
+    فيستغرق التقرير الموحد زمن أبطأ فرع لا مجموع الأزمنة. يرجع {الفرع: النتيجة}.
+    """
+    branches = list(app.config['BRANCH_DATABASES'])
+    if not branches:
+        raise UnknownBranchError('لا توجد فروع معرّفة (BRANCH_DATABASES)')
+
+    read_only = reads_from_replica()
+
+    def run(branch):
+        with app.app_context():
+            g.branch, g.read_only = branch, read_only
+            return function(*args)
+
+    return dict(zip(branches, branch_executor().map(run, branches)))
+
+
+def merge_branch_rows(partials, key, measures, branch_measure):
+    """
+    دمج الصفوف الجزئية من الفروع بالمفتاح key(row): جمع measures، مع قيمة branch_measure
+    لكل فرع في branches. الصف الناتج يأخذ بقية الحقول من أول فرع.
+    """
+    merged = {}
+    for branch, rows in partials.items():
+        for row in rows:
+            entry = merged.get(key(row))
+            if entry is None:
+                entry = merged[key(row)] = dict(row, **dict.fromkeys(measures, 0), branches={})
+            for name in measures:
+                entry[name] += row[name] or 0
+            entry['branches'][branch] = row[branch_measure]
+    return list(merged.values())
+
+
+def product_key(row):
+    """مفتاح المنتج بين الفروع: الكود، أو الاسم للمنتجات بلا كود"""
+    return row['code'] or row['name']
+
+
+def branch_product_sales(start, end):
+    """مجاميع مبيعات كل منتج في الفرع الحالي من التجميعات اليومية"""
+    statement = db.select(
+        Product.code, db.func.coalesce(Product.name, '').label('name'),
+        *rollup_totals(ProductDailyRollup, SALE_KIND),
+    ).select_from(ProductDailyRollup) \
+        .outerjoin(Product, Product.id == ProductDailyRollup.product_id) \
+        .where(ProductDailyRollup.kind == SALE_KIND.name, ProductDailyRollup.day >= start, ProductDailyRollup.day < end) \
+        .group_by(ProductDailyRollup.product_id, Product.code, Product.name)
+    return [dict(row) for row in db.session.execute(statement).mappings()]
+
+
+def branch_stock():
+    """كمية وقيمة مخزون كل منتج في الفرع الحالي"""
+    statement = db.select(
+        Product.code, Product.name, Product.quantity,
+        (Product.quantity * db.func.coalesce(Product.cost, 0.0)).label('value'),
+    )
+    return [dict(row) for row in db.session.execute(statement).mappings()]
+
+
+@app.route('/api/branches', methods=['GET'])
+def list_branches():
+    return jsonify({'branches': list(app.config['BRANCH_DATABASES']), 'current': current_branch()})
+
+
+@app.route('/api/consolidated/dashboard', methods=['GET'])
+def consolidated_dashboard():
+    """مؤشرات لوحة التحكم لكل فرع ومجموعها"""
+    partials = fan_out(dashboard_totals)
+    names = next(iter(partials.values())).keys()
+    total = {name: sum(totals[name] for totals in partials.values()) for name in names}
+    return jsonify({'total': total, 'branches': partials})
+
+
+@app.route('/api/consolidated/sales-by-product', methods=['GET'])
+def consolidated_sales_by_product():
+    """مبيعات كل منتج (بالكود) في كل الفروع، مرتبة بـ order_by وبحد limit"""
+    start, end = report_range()
+    order_by = report_order(rollup_totals(ProductDailyRollup, SALE_KIND))
+    limit = report_limit()
+    measures = (*ROLLUP_MEASURES[ProductDailyRollup], 'profit')
+    rows = merge_branch_rows(fan_out(branch_product_sales, start, end), product_key, measures, 'quantity')
+    rows.sort(key=lambda row: (-row[order_by], product_key(row)))
+    return jsonify(rows[:limit])
+
+
+@app.route('/api/consolidated/stock', methods=['GET'])
+def consolidated_stock():
+    """مخزون كل منتج (بالكود) في كل الفروع مع كمية كل فرع"""
+    rows = merge_branch_rows(fan_out(branch_stock), product_key, ('quantity', 'value'), 'quantity')
+    rows.sort(key=product_key)
+    return jsonify(rows)
+
+# ===========================================
+# توجيه القراءة: طلبات GET إلى قاعدة القراءة والكتابة إلى الرئيسية
+# ===========================================
+
+# نهاية مهلة read-your-writes للعميل (طابع زمني بالثواني)
+READ_PRIMARY_COOKIE = 'read_primary_until'
+
+
+def read_databases_enabled():
+    """هل توجد قاعدة قراءة واحدة على الأقل في SQLALCHEMY_BINDS"""
+    return any(key.startswith(READ_BIND_PREFIX) for key in app.config['SQLALCHEMY_BINDS'])
+
+
+def read_primary_requested():
+    """هل طلب العميل القراءة من الرئيسية: الترويسة X-Read-Primary: 1 أو كتابة حديثة منه"""
+    if request.headers.get('X-Read-Primary') == '1':
+        return True
+    try:
+        return float(request.cookies.get(READ_PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+@app.before_request
+def select_read_database():
+    """
+    طلبات GET/HEAD تقرأ من قاعدة القراءة فلا تنافس الترحيل على اتصالات الرئيسية وأقفالها،
+    إلا إذا كتب العميل للتو فيقرأ من الرئيسية ليرى ما كتبه رغم تأخر النسخة المتماثلة
+    """
+    g.read_only = request.method in ('GET', 'HEAD') and not read_primary_requested()
+
+
+@app.after_request
+def remember_recent_write(response):
+    """بعد كتابة ناجحة: قراءات العميل التالية من الرئيسية لمدة READ_YOUR_WRITES_SECONDS"""
+    seconds = app.config['READ_YOUR_WRITES_SECONDS']
+    if request.method in ('POST', 'PUT', 'PATCH', 'DELETE') and response.status_code < 400 \
+            and seconds > 0 and read_databases_enabled():
+        response.set_cookie(READ_PRIMARY_COOKIE, f'{time.time() + seconds:.3f}', max_age=seconds,
+                            httponly=True, samesite='Lax')
+    return response
+
+# ===========================================
+# الفهارس وخطط الاستعلامات
+# ===========================================
+
+def ensure_columns(engine):
+    """إضافة الأعمدة الجديدة (القابلة لـ NULL) إلى جداول موجودة؛ create_all لا يعدّل الجداول القائمة"""
+    inspector = inspect(engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as connection:
+                connection.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+
+def ensure_indexes(engine):
+    """إنشاء الفهارس الناقصة في قاعدة بيانات موجودة (create_all لا يضيفها لجداول قائمة)"""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+def hot_queries():
+    """الاستعلامات الأكثر تكراراً في المسارات الساخنة، ويجب أن تخدمها الفهارس"""
+    today = date.today()
+    queries = {}
+    for kind in (SALE_KIND, PURCHASE_KIND):
+        invoice_model, item_model = kind.invoice, kind.item
+        name = invoice_model.__tablename__
+        party_column = getattr(invoice_model, kind.party_field)
+        queries[f'{name}_page_by_date'] = db.select(invoice_model).where(
+            db.tuple_(invoice_model.date, invoice_model.id) < (today, 1)
+        ).order_by(invoice_model.date.desc(), invoice_model.id.desc()).limit(50)
+        queries[f'{name}_month_range'] = db.select(db.func.sum(invoice_model.total)).where(
+            invoice_model.date >= today.replace(day=1), invoice_model.date < today
+        )
+        queries[f'{name}_by_party'] = db.select(invoice_model).where(
+            party_column == 1, invoice_model.date >= today
+        ).order_by(invoice_model.date)
+        queries[f'{name}_by_status'] = db.select(invoice_model).where(
+            invoice_model.status == 'partial', invoice_model.id > 1
+        ).order_by(invoice_model.id).limit(50)
+        queries[f'{name}_recent'] = db.select(invoice_model).order_by(
+            invoice_model.created_date.desc()
+        ).limit(10)
+        queries[f'{item_model.__tablename__}_by_invoice'] = db.select(item_model).where(
+            item_model.invoice_id.in_([1, 2, 3])
+        )
+        queries[f'{item_model.__tablename__}_by_product'] = db.select(item_model).where(
+            item_model.product_id == 1
+        )
+    for kind in map(invoice_history, (SALE_KIND, PURCHASE_KIND)):
+        # قراءة فترة مؤرشفة: الشرط يُدفع إلى طرفي UNION ALL فيستخدم كل طرف فهرسه
+        invoice_model, item_model = kind.invoice, kind.item
+        queries[f'{kind.name}_history_range'] = db.select(invoice_model).where(
+            invoice_model.date >= today - timedelta(days=30), invoice_model.date < today
+        ).order_by(invoice_model.id).limit(50)
+        queries[f'{kind.name}_history_by_party'] = db.select(invoice_model).where(
+            getattr(invoice_model, kind.party_field) == 1, invoice_model.date < today
+        )
+        queries[f'{kind.name}_history_items'] = db.select(item_model).where(
+            item_model.invoice_id.in_([1, 2, 3])
+        )
+    queries['product_by_category'] = db.select(Product).where(
+        Product.category == 'x', Product.id > 1
+    ).order_by(Product.id).limit(50)
+    queries['product_low_stock'] = db.select(db.func.count(Product.id)).where(
+        Product.quantity <= Product.min_stock
+    )
+    for model in (Customer, Supplier):
+        queries[f'{model.__tablename__}_by_status'] = db.select(model).where(
+            model.status == 'active', model.id > 1
+        ).order_by(model.id).limit(50)
+    queries['dashboard_summary'] = db.select(DashboardSummary).where(
+        DashboardSummary.period.in_(['', today.strftime('%Y-%m')])
+    )
+    for kind in (SALE_KIND, PURCHASE_KIND):
+        party_column = getattr(kind.invoice, kind.party_field)
+        queries[f'{kind.invoice.__tablename__}_aging'] = aging_select(kind, today)
+        queries[f'{kind.invoice.__tablename__}_party_aging'] = aging_select(kind, today).where(party_column == 1)
+    snapshot_date = today.replace(day=1) - timedelta(days=1)
+    queries['stock_as_of'] = stock_balances_select(today, snapshot_date)
+    queries['stock_product_history'] = db.select(StockMovement).where(
+        StockMovement.product_id == 1, StockMovement.date <= today
+    ).order_by(StockMovement.date)
+    queries['cost_layer_open'] = db.select(CostLayer).where(
+        CostLayer.product_id.in_([1, 2]), above_zero(CostLayer.remaining)
+    ).order_by(CostLayer.product_id, CostLayer.id)
+    for model in (*SYNC_ENTITIES.values(), SyncTombstone):
+        queries[f'{model.__tablename__}_sync'] = db.select(model).where(
+            model.row_version > 1
+        ).order_by(model.row_version, model.id).limit(50)
+    for model, key_column in ((ProductDailyRollup, ProductDailyRollup.product_id),
+                              (PartyDailyRollup, PartyDailyRollup.party_id)):
+        queries[f'{model.__tablename__}_range'] = db.select(model.day, db.func.sum(model.revenue)).where(
+            model.kind == 'sale', model.day >= today - timedelta(days=30), model.day < today
+        ).group_by(model.day)
+        queries[f'{model.__tablename__}_series'] = db.select(model).where(
+            model.kind == 'sale', key_column == 1, model.day >= today - timedelta(days=30)
+        )
+    return queries
+
+
+def query_plan_problems():
+    """
+    تشغيل EXPLAIN QUERY PLAN (SQLite) على الاستعلامات الساخنة.
+    يرجع قائمة (اسم الاستعلام، سطر الخطة) لكل مسح كامل لجدول دون فهرس.
+    """
+    bind = db.session.get_bind()
+    if bind.dialect.name != 'sqlite':
+        return []
+    connection = db.session.connection()
+    problems = []
+    for name, statement in hot_queries().items():
+        compiled = statement.compile(dialect=bind.dialect, compile_kwargs={'render_postcompile': True})
+        # الخطة لا تعتمد على القيم الفعلية للمعاملات
+        parameters = (None,) * len(compiled.positiontup or ())
+        plan = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', parameters).all()
+        for row in plan:
+            detail = row[-1]
+            # مسح نتيجة استعلام فرعي (UNION وغيره) ليس مسحاً لجدول
+            if detail.startswith('SCAN ') and ' USING ' not in detail and \
+                    detail.split()[1] in db.metadata.tables:
+                problems.append((name, detail))
+    return problems
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """التحقق من أن الاستعلامات الساخنة لا تتحول إلى مسح كامل للجداول"""
+    problems = query_plan_problems()
+    for name, detail in problems:
+        click.echo(f'❌ {name}: {detail}')
+    if problems:
+        raise SystemExit(1)
+    click.echo('✅ جميع الاستعلامات الساخنة تستخدم الفهارس')
+
 # ===========================================
 # تهيئة قاعدة البيانات
 # ===========================================
 
-def init_database():
+def create_tables():
+    """إنشاء الجداول والأعمدة والفهارس الناقصة في قاعدة الفرع الحالي"""
+    engine = db.session.get_bind()
+    db.metadata.create_all(engine)
+    ensure_columns(engine)
+    ensure_indexes(engine)
+
+
+def init_database(sample_data=True):
+    """تهيئة القاعدة الرئيسية وقاعدة كل فرع في BRANCH_DATABASES"""
+    for branch in (None, *app.config['BRANCH_DATABASES']):
+        g.branch = branch
+        init_branch_database(sample_data)
+        db.session.remove()
+    g.pop('branch')
+
+
+@app.cli.command('init-db')
+@click.option('--sample-data', is_flag=True, help='إضافة عملاء وموردين ومنتجات تجريبية للقواعد الفارغة')
+def init_database_command(sample_data):
+    """إنشاء الجداول والفهارس الناقصة وبناء الجداول المشتقة (مرة عند النشر لا عند كل تشغيل)"""
+    init_database(sample_data)
+    click.echo('✅ تمت تهيئة قاعدة البيانات')
+
+
+def init_branch_database(sample_data=True):
     """إنشاء الجداول وإضافة البيانات التجريبية"""
-    db.create_all()
+    create_tables()
     
     # إضافة بيانات تجريبية إذا لم تكن موجودة
-    if Customer.query.count() == 0:
+    if sample_data and Customer.query.count() == 0:
         sample_customers = [
             Customer(name="أحمد محمد علي", phone="01012345678", address="القاهرة، مصر الجديدة"),
             Customer(name="فاطمة أحمد حسن", phone="01098765432", address="الإسكندرية، محطة الرمل"),
@@ -583,8 +4399,67 @@ def init_database():
         
         db.session.commit()
         print("✅ تم إنشاء قاعدة البيانات وإضافة البيانات التجريبية")
+    
+    # بناء فهرس البحث لقواعد البيانات الموجودة قبل إضافته: كل فهرس على حدة
+    stale = stale_search_indexes() if search_enabled() else []
+    if stale:
+        rebuild_search_index(stale)
+    
+    # بناء ملخص لوحة التحكم لقواعد البيانات الموجودة قبل إضافته
+    if DashboardSummary.query.first() is None:
+        rebuild_dashboard_summary()
+        bump_versions(Customer, Supplier, Product, SaleInvoice, PurchaseInvoice)
+        db.session.commit()
+    
+    # طبقات التكلفة لقواعد البيانات الموجودة قبل إضافتها (وللبيانات التجريبية)
+    if CostLayer.query.first() is None and (
+            SaleItem.query.filter(SaleItem.cost.is_(None)).first() is not None
+            or Product.query.filter(Product.quantity > 0).first() is not None):
+        rebuild_cost_layers()
+        rebuild_rollups()
+        rebuild_dashboard_summary()
+    
+    # سجل حركات المخزون لقواعد البيانات السابقة له، ثم لقطات الأشهر المنتهية
+    if StockMovement.query.first() is None and Product.query.first() is not None:
+        rebuild_stock_ledger()
+    take_stock_snapshots()
+
+
+# ===========================================
+# إنشاء التطبيق
+# ===========================================
+
+def create_app(config=None):
+    """
+    إعداد التطبيق الوحيد في الوحدة (لا يُنشئ تطبيقاً جديداً؛ المسارات مسجلة على app):
+    قاعدة البيانات من DATABASE_URL و BRANCH_DATABASES (راجع config.py)، ثم أي مفتاح من
+    متغيرات البيئة FLASK_<المفتاح> (مثل FLASK_GROUP_COMMIT_WINDOW_MS=5)، ثم config.
+    لا يتصل بقاعدة البيانات ولا ينشئ الجداول (flask init-db). أول استدعاء يحدث عند استيراد
+    الوحدة؛ الاستدعاءات التالية ترجع نفس التطبيق وتطبق config، وترفع RuntimeError إذا تغيرت
+    إعدادات قاعدة البيانات بعد ربط المحركات.
+    """
+    config = config or {}
+    if 'sqlalchemy' not in app.extensions:
+        app.config.update(database_config())
+        app.config.from_prefixed_env()
+        app.config.update(config)
+        db.init_app(app)
+        return app
+    requested = dict(database_config(), **{key: value for key, value in config.items() if key.startswith('SQLALCHEMY_')})
+    changed = sorted(key for key, value in requested.items() if app.config.get(key) != value)
+    if changed:
+        raise RuntimeError(f'create_app() يعيد إعداد نفس التطبيق؛ لا يمكن تغيير {", ".join(changed)} بعد ربط قاعدة البيانات')
+    app.config.update(config)
+    return app
+
+
+# app مُعدّ عند الاستيراد حتى تعمل أوامر flask --app app (init-db و rebuild-summary ...)؛
+# لذلك يُضبط DATABASE_URL و BRANCH_DATABASES قبل استيراد app
+create_app()
+
 
 if __name__ == '__main__':
+    # خادم التطوير؛ للإنتاج: gunicorn -c gunicorn.conf.py wsgi:app (راجع wsgi.py)
     with app.app_context():
         init_database()
     
@@ -0,0 +1,632 @@
+#!/usr/bin/env python3
+"""
+قياسات أداء نظام المحاسبة
+كل قياس يعمل على قاعدة SQLite مؤقتة جديدة (أو على --database-url) ويطبع الأزمنة
+
+    python benchmark.py payments --receipts 10000
+    python benchmark.py reorder --products 100000
+    python benchmark.py read --rows 50000
+    python benchmark.py sync --rows 50000 --changes 100
+    python benchmark.py events --subscribers 500
+    python benchmark.py group-commit --invoices 2000 --threads 32
+    python benchmark.py archive --rows 200000 --chunk-size 500
+    python benchmark.py branches --branches 4 --products 20000 --latency-ms 0
+    python benchmark.py read-routing --rows 4000 --chunk-size 100 --threads 16 --invoices 50 --latency-ms 50
+    python benchmark.py cold-start --rows 20000
+"""
+
+import argparse
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import date, timedelta
+
+
+def report(name, count, elapsed):
+    """طباعة الزمن الكلي والمعدل في الثانية"""
+    print(f'{name}: {count} في {elapsed:.2f} ث ({count / elapsed:,.0f}/ث)')
+
+
+# ===========================================
+# استلام المدفوعات المجمّع
+# ===========================================
+
+def seed_open_invoices(customers, invoices_per_customer):
+    """إضافة عملاء وفواتير مبيعات مفتوحة مباشرة بعبارات إدخال مجمّعة"""
+    from app import db, Customer, SaleInvoice
+
+    today = date.today()
+    db.session.execute(db.insert(Customer), [
+        {'name': f'عميل {index}', 'balance': 0.0} for index in range(customers)
+    ])
+    rows, balances = [], {}
+    for customer_id in range(1, customers + 1):
+        for number in range(invoices_per_customer):
+            total = float(random.randint(100, 2000))
+            rows.append({
+                'customer_id': customer_id,
+                'invoice_number': f'B-{customer_id}-{number}',
+                'date': today - timedelta(days=random.randint(0, 150)),
+                'subtotal': total, 'total': total, 'paid': 0.0, 'remaining': total,
+                'status': 'partial',
+            })
+            balances[customer_id] = balances.get(customer_id, 0.0) + total
+    db.session.execute(db.insert(SaleInvoice), rows)
+    db.session.execute(
+        db.update(Customer),
+        [{'id': customer_id, 'balance': amount} for customer_id, amount in balances.items()],
+    )
+    db.session.commit()
+    return len(rows)
+
+
+def bench_payments(args):
+    """ملف بنك من args.receipts إيصال يُخصَّص على الفواتير المفتوحة عبر /api/payments/bulk"""
+    from app import create_app, db, Payment, PaymentAllocation
+    app = create_app()
+
+    with app.app_context():
+        db.create_all()
+        invoices = seed_open_invoices(args.customers, args.invoices_per_customer)
+        payments = [{
+            'customer_id': random.randint(1, args.customers),
+            'amount': float(random.randint(50, 1500)),
+            'date': date.today().strftime('%Y-%m-%d'),
+            'reference': f'BANK-{index}',
+        } for index in range(args.receipts)]
+        print(f'{args.customers} عميل، {invoices} فاتورة مفتوحة')
+
+        client = app.test_client()
+        start = time.perf_counter()
+        response = client.post(f'/api/payments/bulk?chunk_size={args.chunk_size}', json={'payments': payments})
+        elapsed = time.perf_counter() - start
+        result = response.get_json()
+        assert response.status_code == 200 and result['created'] == args.receipts, result.get('failed')
+        report('استلام الدفعات', args.receipts, elapsed)
+        print(f'التخصيصات: {PaymentAllocation.query.count()}، '
+              f'غير مخصص: {db.session.scalar(db.select(db.func.sum(Payment.unallocated))):,.2f}')
+
+
+# ===========================================
+# اقتراحات إعادة الطلب
+# ===========================================
+
+def seed_sales_history(products, lines, days):
+    """إضافة منتجات وبنود مبيعات موزعة عشوائياً على آخر days يوماً بإدخال مجمّع"""
+    from app import db, Customer, Product, SaleInvoice, SaleItem
+
+    today = date.today()
+    db.session.add(Customer(name='عميل'))
+    db.session.execute(db.insert(Product), [{
+        'name': f'منتج {index}', 'code': f'SKU{index:06d}', 'price': 10.0, 'cost': 6.0,
+        'quantity': random.randint(0, 500), 'min_stock': 5,
+    } for index in range(products)])
+    db.session.execute(db.insert(SaleInvoice), [{
+        'customer_id': 1, 'invoice_number': f'B-{offset}', 'date': today - timedelta(days=offset),
+        'subtotal': 0.0, 'total': 0.0, 'paid': 0.0, 'remaining': 0.0, 'status': 'completed',
+    } for offset in range(days)])
+    db.session.execute(db.insert(SaleItem), [{
+        'invoice_id': random.randint(1, days), 'product_id': random.randint(1, products),
+        'quantity': random.randint(1, 5), 'price': 10.0, 'total': 10.0, 'cost': 6.0,
+    } for _ in range(lines)])
+    db.session.commit()
+
+
+def bench_reorder(args):
+    """/api/inventory/reorder على args.products منتج: أول طلب (حساب السرعة) ثم طلب من الذاكرة"""
+    from app import create_app, db, response_cache
+    app = create_app()
+
+    with app.app_context():
+        db.create_all()
+        seed_sales_history(args.products, args.sale_lines, 90)
+        print(f'{args.products} منتج، {args.sale_lines} بند مبيعات')
+        client = app.test_client()
+        for label, url in [('أول طلب', '/api/inventory/reorder'),
+                           ('سرعة محفوظة', '/api/inventory/reorder?lead_time=10')]:
+            response_cache.clear()
+            start = time.perf_counter()
+            response = client.get(url)
+            elapsed = time.perf_counter() - start
+            assert response.status_code == 200
+            print(f'{label}: {elapsed:.2f} ث ({len(response.get_json())} اقتراح)')
+
+
+# ===========================================
+# القراءة الخفيفة للقوائم
+# ===========================================
+
+def seed_list_rows(rows):
+    """إضافة rows منتجاً و rows/2 فاتورة مبيعات ببندين لكل منها"""
+    from app import db, Customer, Product, SaleInvoice, SaleItem
+
+    today = date.today()
+    db.session.add(Customer(name='عميل'))
+    db.session.execute(db.insert(Product), [{
+        'name': f'منتج {index}', 'code': f'SKU{index:06d}', 'price': 10.0, 'cost': 6.0,
+        'quantity': index % 500, 'min_stock': 5, 'category': 'عام',
+    } for index in range(rows)])
+    invoices = rows // 2
+    db.session.execute(db.insert(SaleInvoice), [{
+        'customer_id': 1, 'invoice_number': f'B-{index}', 'date': today - timedelta(days=index % 365),
+        'subtotal': 20.0, 'total': 20.0, 'paid': 0.0, 'remaining': 20.0, 'status': 'partial',
+    } for index in range(invoices)])
+    db.session.execute(db.insert(SaleItem), [{
+        'invoice_id': index // 2 + 1, 'product_id': random.randint(1, rows),
+        'quantity': 1, 'price': 10.0, 'total': 10.0, 'cost': 6.0,
+    } for index in range(invoices * 2)])
+    db.session.commit()
+    return invoices
+
+
+def bench_read(args):
+    """زمن الصف في /api/products و /api/sales: كائنات ORM + to_dict مقابل Core + صفوف مضغوطة"""
+    from app import create_app, db, response_cache, sale_invoices_query, Product, SaleInvoice
+    app = create_app()
+
+    with app.app_context():
+        db.create_all()
+        invoices = seed_list_rows(args.rows)
+        print(f'{args.rows} منتج، {invoices} فاتورة مبيعات')
+
+        def orm_products():
+            return app.json.response([row.to_dict() for row in Product.query.order_by(Product.id)])
+
+        def orm_sales():
+            return app.json.response([row.to_dict() for row in sale_invoices_query().order_by(SaleInvoice.id)])
+
+        client = app.test_client()
+        for label, url, orm, count in [('المنتجات', '/api/products', orm_products, args.rows),
+                                       ('المبيعات', '/api/sales', orm_sales, invoices)]:
+            with app.test_request_context():
+                start = time.perf_counter()
+                expected = orm().get_data()
+                orm_elapsed = time.perf_counter() - start
+            db.session.remove()
+            timings = []
+            for fast_json in (False, True):
+                app.config['FAST_JSON'] = fast_json
+                response_cache.clear()
+                start = time.perf_counter()
+                response = client.get(url)
+                timings.append(time.perf_counter() - start)
+                assert response.status_code == 200
+                assert (response.data == expected) if not fast_json else len(response.get_json()) == count
+            app.config['FAST_JSON'] = False
+            print(f'{label}: ORM {orm_elapsed / count * 1e6:.1f} µs/صف، '
+                  f'Core {timings[0] / count * 1e6:.1f} µs/صف، '
+                  f'Core+orjson {timings[1] / count * 1e6:.1f} µs/صف')
+
+
+# ===========================================
+# المزامنة التزايدية
+# ===========================================
+
+def bench_sync(args):
+    """حجم وزمن /api/sync بعد args.changes فاتورة مقابل إعادة تحميل كل القوائم"""
+    from app import create_app, db, response_cache, SYNC_ENTITIES
+    app = create_app()
+
+    with app.app_context():
+        db.create_all()
+        invoices = seed_list_rows(args.rows)
+        print(f'{args.rows} منتج، {invoices} فاتورة مبيعات')
+        client = app.test_client()
+        token = client.get('/api/sync').get_json()['token']
+        for _ in range(args.changes):
+            product_id = random.randint(1, args.rows)
+            client.post('/api/sales', json={
+                'customer_id': 1, 'date': date.today().strftime('%Y-%m-%d'),
+                'items': [{'product_id': product_id, 'quantity': 1, 'price': 10.0, 'total': 10.0}],
+                'subtotal': 10.0, 'total': 10.0, 'paid': 10.0, 'remaining': 0.0, 'status': 'completed',
+            })
+
+        response_cache.clear()
+        start = time.perf_counter()
+        response = client.get(f'/api/sync?since={token}')
+        elapsed = time.perf_counter() - start
+        result = response.get_json()
+        assert not result['reset'] and len(result['changes']['sales']) == args.changes
+        # إعادة التحميل الكامل: كل صفوف القوائم دون التقسيم الافتراضي إلى صفحات
+        app.config['API_PAGE_SIZE'] = None
+        full = sum(len(client.get(f'/api/{name}').data) for name in SYNC_ENTITIES)
+        print(f'المزامنة بعد {args.changes} فاتورة: {len(response.data) / 1024:,.1f} KB في {elapsed * 1000:.0f} ms، '
+              f'إعادة التحميل الكامل: {full / 1024 / 1024:,.1f} MB')
+
+
+# ===========================================
+# بث الأحداث
+# ===========================================
+
+def bench_events(args):
+    """تكلفة args.subscribers لوحة تحكم مفتوحة: وقت المعالج وهي خاملة، وزمن البيع مع التوزيع عليها"""
+    import threading
+    from app import create_app, db, event_broker, Customer, Product
+    app = create_app()
+
+    def sale(product_id):
+        return {
+            'customer_id': 1, 'date': date.today().strftime('%Y-%m-%d'),
+            'items': [{'product_id': product_id, 'quantity': 1, 'price': 10.0, 'total': 10.0}],
+            'subtotal': 10.0, 'total': 10.0, 'paid': 10.0, 'remaining': 0.0, 'status': 'completed',
+        }
+
+    with app.app_context():
+        db.create_all()
+        db.session.add(Customer(name='عميل'))
+        db.session.add_all([Product(name=f'منتج {index}', code=f'P{index}', price=10.0, cost=6.0,
+                                    quantity=100000, min_stock=5) for index in range(100)])
+        db.session.commit()
+        client = app.test_client()
+
+        def post_sales():
+            start = time.perf_counter()
+            for index in range(args.changes):
+                assert client.post('/api/sales', json=sale(index % 100 + 1)).status_code == 200
+            return (time.perf_counter() - start) / args.changes * 1000
+
+        baseline = post_sales()
+        stop, received = threading.Event(), []
+
+        def dashboard():
+            subscriber = event_broker.subscribe(app.config['EVENTS_QUEUE_SIZE'])
+            while not stop.is_set():
+                received.extend(subscriber.get(0.5))
+            event_broker.unsubscribe(subscriber)
+
+        threads = [threading.Thread(target=dashboard) for _ in range(args.subscribers)]
+        for thread in threads:
+            thread.start()
+        while event_broker.subscriber_count() < args.subscribers:
+            time.sleep(0.01)
+        cpu = time.process_time()
+        time.sleep(2)
+        idle_cpu = time.process_time() - cpu
+        fanned = post_sales()
+        stop.set()
+        for thread in threads:
+            thread.join()
+        print(f'{args.subscribers} مشترك خامل: {idle_cpu * 1000:.0f} ms معالج في 2 ث (بدون استعلامات)')
+        print(f'زمن البيع: {baseline:.2f} ms بدون مشتركين، {fanned:.2f} ms مع التوزيع '
+              f'({len(received)} حدث مستلم)')
+
+
+# ===========================================
+# الترحيل المجمّع (Group Commit)
+# ===========================================
+
+def bench_group_commit(args):
+    """فواتير/ث من args.threads خيط متزامن: commit لكل طلب مقابل GROUP_COMMIT"""
+    import threading
+    from sqlalchemy import event
+    from app import create_app, db, Customer, Product
+    app = create_app()
+
+    with app.app_context():
+        db.create_all()
+        db.session.add(Customer(name='عميل'))
+        db.session.add_all([Product(name=f'منتج {index}', code=f'P{index}', price=10.0, cost=6.0,
+                                    quantity=10 ** 7, min_stock=5) for index in range(100)])
+        db.session.commit()
+        commits = []
+        event.listen(db.engine, 'commit', lambda connection: commits.append(1))
+
+    def post_sales(index):
+        client = app.test_client()
+        for number in range(args.invoices // args.threads):
+            try:
+                response = client.post('/api/sales', json={
+                    'customer_id': 1, 'date': date.today().strftime('%Y-%m-%d'),
+                    'items': [{'product_id': (index + number) % 100 + 1, 'quantity': 1, 'price': 10.0, 'total': 10.0}],
+                    'subtotal': 10.0, 'total': 10.0, 'paid': 10.0, 'remaining': 0.0, 'status': 'completed',
+                })
+                failed = response.status_code != 200
+            except Exception:
+                # "database is locked" بعد busy_timeout عند تزاحم الكتّاب
+                failed = True
+            if failed:
+                failures.append(1)
+
+    app.logger.disabled = True
+    for grouped in (False, True):
+        app.config['GROUP_COMMIT'] = grouped
+        commits.clear()
+        failures = []
+        threads = [threading.Thread(target=post_sales, args=(index,)) for index in range(args.threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        count = args.invoices // args.threads * args.threads - len(failures)
+        report('مجمّع' if grouped else 'commit لكل طلب', count, time.perf_counter() - start)
+        print(f'  عدد commit: {len(commits)}، فشل: {len(failures)}')
+
+
+# ===========================================
+# أرشفة الفواتير المكتملة
+# ===========================================
+
+def bench_archive(args):
+    """أرشفة args.rows فاتورة مكتملة على 5 سنوات: زمن كل دفعة (مدة قفل الكتابة) وقراءة فترة مؤرشفة"""
+    from app import create_app, db, response_cache, archive_invoice_batch, Customer, Product, SaleInvoice, SaleItem, SALE_KIND
+    app = create_app()
+
+    today = date.today()
+    with app.app_context():
+        db.create_all()
+        db.session.add(Customer(name='عميل'))
+        db.session.add(Product(name='منتج', code='P1', price=10.0, cost=6.0, quantity=10, min_stock=5))
+        db.session.execute(db.insert(SaleInvoice), [{
+            'customer_id': 1, 'invoice_number': f'B-{index}', 'date': today - timedelta(days=5 * 365 - index * 5 * 365 // args.rows),
+            'subtotal': 20.0, 'total': 20.0, 'paid': 20.0, 'remaining': 0.0, 'status': 'completed',
+        } for index in range(args.rows)])
+        db.session.execute(db.insert(SaleItem), [{
+            'invoice_id': index // 2 + 1, 'product_id': 1, 'quantity': 1, 'price': 10.0, 'total': 10.0, 'cost': 6.0,
+        } for index in range(args.rows * 2)])
+        db.session.commit()
+        client = app.test_client()
+        old_range = f'/api/sales?date_from={today.year - 4}-01-01&date_to={today.year - 4}-01-31'
+        recent = f'/api/sales?date_from={today - timedelta(days=30)}&limit=50'
+
+        def timed(url):
+            # الطلب الثاني بعد تسخين الذاكرة
+            for _ in range(2):
+                response_cache.clear()
+                start = time.perf_counter()
+                response = client.get(url)
+                elapsed = time.perf_counter() - start
+            assert response.status_code == 200
+            return elapsed * 1000, len(response.get_json())
+
+        before = [timed(url) for url in (recent, old_range)]
+        batches, archived, start = [], 0, time.perf_counter()
+        while True:
+            batch_start = time.perf_counter()
+            moved = archive_invoice_batch(SALE_KIND, today - timedelta(days=365), args.chunk_size)
+            if not moved:
+                break
+            archived += moved
+            batches.append(time.perf_counter() - batch_start)
+        report('أرشفة', archived, time.perf_counter() - start)
+        print(f'  {len(batches)} دفعة × {args.chunk_size}: أطول معاملة {max(batches) * 1000:.1f} ms')
+        after = [timed(url) for url in (recent, old_range)]
+        for label, (old_ms, old_rows), (new_ms, new_rows) in zip(('آخر 30 يوماً', 'شهر مؤرشف'), before, after):
+            print(f'{label}: {old_ms:.1f} ms قبل الأرشفة، {new_ms:.1f} ms بعدها ({old_rows}/{new_rows} فاتورة)')
+
+
+# ===========================================
+# الفروع والتقارير الموحدة
+# ===========================================
+
+def bench_branches(args):
+    """
+    تقرير مبيعات المنتجات الموحد على args.branches فرع: مقارنة بزمن كل فرع ومجموعها.
+    --latency-ms يضيف انتظاراً لكل استعلام يحاكي قاعدة فرع بعيدة على الشبكة.
+    """
+    directory = os.path.dirname(os.environ['DATABASE_URL'][len('sqlite:///'):])
+    names = [f'b{index}' for index in range(args.branches)]
+    # يجب ضبط BRANCH_DATABASES قبل استيراد app
+    os.environ['BRANCH_DATABASES'] = ','.join(
+        f"{name}=sqlite:///{os.path.join(directory, name + '.db')}" for name in names
+    )
+    from flask import g
+    from sqlalchemy import event
+    from app import create_app, db, create_tables, branch_product_sales, Product, ProductDailyRollup
+    app = create_app()
+
+    today = date.today()
+    days = 30
+    with app.app_context():
+        for name in names:
+            g.branch = name
+            create_tables()
+            db.session.execute(db.insert(Product), [{
+                'name': f'منتج {index}', 'code': f'SKU{index:06d}', 'price': 10.0, 'cost': 6.0, 'quantity': 100,
+            } for index in range(args.products)])
+            db.session.execute(db.insert(ProductDailyRollup), [{
+                'kind': 'sale', 'day': today - timedelta(days=day), 'product_id': product_id,
+                'quantity': 2, 'revenue': 20.0, 'cost': 12.0, 'discount': 0.0, 'lines': 1,
+            } for product_id in range(1, args.products + 1) for day in range(days)])
+            db.session.commit()
+            db.session.remove()
+        print(f'{args.branches} فرع × {args.products} منتج × {days} يوم، '
+              f'{len(os.sched_getaffinity(0))} معالج، تأخير الشبكة {args.latency_ms} ms')
+
+        for name in names:
+            event.listen(db.engines[f'branch:{name}'], 'before_cursor_execute',
+                         lambda *_: time.sleep(args.latency_ms / 1000))
+        start_day, end_day = today - timedelta(days=days - 1), today + timedelta(days=1)
+        branch_times = []
+        for name in names:
+            g.branch = name
+            start = time.perf_counter()
+            branch_product_sales(start_day, end_day)
+            branch_times.append(time.perf_counter() - start)
+            db.session.remove()
+        g.pop('branch')
+
+    client = app.test_client()
+    url = f'/api/consolidated/sales-by-product?date_from={start_day}&date_to={today}&limit=100'
+    client.get(url)
+    start = time.perf_counter()
+    assert client.get(url).status_code == 200
+    elapsed = time.perf_counter() - start
+    print(f'أبطأ فرع: {max(branch_times) * 1000:.0f} ms، مجموع الفروع: {sum(branch_times) * 1000:.0f} ms')
+    print(f'التقرير الموحد: {elapsed * 1000:.0f} ms')
+
+
+# ===========================================
+# توجيه القراءة (SQLITE_READ_ONLY)
+# ===========================================
+
+def bench_read_routing(args):
+    """
+    زمن ترحيل فاتورة بيع من خيط واحد: وحده، ثم مع args.threads خيط تصدير على القاعدة الرئيسية
+    (X-Read-Primary)، ثم مع نفس التصدير على اتصالات القراءة فقط.
+    --latency-ms تأخير العميل لكل دفعة يستلمها (عملاء بطيئون يحجزون اتصالاتهم أثناء التصدير).
+    """
+    import threading
+    os.environ['SQLITE_READ_ONLY'] = '1'
+    from app import create_app, db
+    app = create_app()
+
+    with app.app_context():
+        db.create_all()
+        invoices = seed_list_rows(args.rows)
+    print(f'{args.rows} منتج، {invoices} فاتورة مبيعات، {args.threads} خيط تقارير، '
+          f'{len(os.sched_getaffinity(0))} معالج')
+
+    def run_reports(headers, stop, counts):
+        client = app.test_client()
+        while not stop.is_set():
+            try:
+                response = client.get('/api/sales/export', headers=headers, buffered=False)
+                for _ in response.iter_encoded():
+                    # عميل بطيء يستلم التصدير دفعة دفعة: اتصال قاعدة البيانات محجوز طوال البث
+                    time.sleep(args.latency_ms / 1000)
+                response.close()
+                counts.append(1)
+            except Exception:
+                # انتهاء pool_timeout عند نفاد اتصالات المجمع
+                pass
+
+    app.config['EXPORT_CHUNK_SIZE'] = args.chunk_size
+    app.logger.disabled = True
+    for label, reporters, headers in [('الترحيل وحده', 0, {}),
+                                      ('مع تقارير على الرئيسية', args.threads, {'X-Read-Primary': '1'}),
+                                      ('مع تقارير على اتصالات القراءة', args.threads, {})]:
+        stop, counts = threading.Event(), []
+        threads = [threading.Thread(target=run_reports, args=(headers, stop, counts)) for _ in range(reporters)]
+        for thread in threads:
+            thread.start()
+        client = app.test_client()
+        latencies, failures = [], 0
+        for number in range(args.invoices):
+            start = time.perf_counter()
+            try:
+                response = client.post('/api/sales', json={
+                    'customer_id': 1, 'date': date.today().strftime('%Y-%m-%d'),
+                    'items': [{'product_id': number % args.rows + 1, 'quantity': 1, 'price': 10.0, 'total': 10.0}],
+                    'subtotal': 10.0, 'total': 10.0, 'paid': 10.0, 'remaining': 0.0, 'status': 'completed',
+                })
+                failures += response.status_code != 200
+            except Exception:
+                failures += 1
+            latencies.append(time.perf_counter() - start)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        quantiles = statistics.quantiles(latencies, n=100)
+        print(f'{label}: p50 {quantiles[49] * 1000:.1f} ms، p95 {quantiles[94] * 1000:.1f} ms، '
+              f'أقصى {max(latencies) * 1000:.1f} ms، فشل {failures}، تقارير منجزة {len(counts)}')
+
+
+# ===========================================
+# زمن بدء التشغيل
+# ===========================================
+
+# خادم في عملية جديدة: init = التهيئة عند كل تشغيل كما في python app.py سابقاً، wsgi = نقطة الإنتاج
+COLD_START_SERVER = """
+import sys
+from werkzeug.serving import make_server
+if sys.argv[1] == 'init':
+    from app import create_app, init_database
+    app = create_app()
+    with app.app_context():
+        init_database(sample_data=False)
+else:
+    from wsgi import app
+make_server('127.0.0.1', int(sys.argv[2]), app, threaded=True).serve_forever()
+"""
+
+
+def first_response_time(mode, url_path, timeout=60):
+    """زمن الاستجابة الناجحة الأولى من خادم جديد منذ بدء عمليته"""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-c', COLD_START_SERVER, mode, str(port)],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}{url_path}') as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.005)
+        raise RuntimeError(f'لم يستجب الخادم ({mode}) خلال {timeout} ث')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def bench_cold_start(args):
+    """زمن أول استجابة ناجحة لـ /api/products من عملية جديدة: التهيئة عند التشغيل مقابل wsgi"""
+    from app import create_app, db, init_database
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+        invoices = seed_list_rows(args.rows)
+        init_database(sample_data=False)
+    print(f'{args.rows} منتج، {invoices} فاتورة مبيعات، {args.repeat} تشغيلات لكل طريقة')
+    for label, mode in [('init_database عند كل تشغيل', 'init'), ('wsgi (flask init-db مرة واحدة)', 'wsgi')]:
+        timings = [first_response_time(mode, '/api/products?limit=100') for _ in range(args.repeat)]
+        print(f'{label}: الوسيط {statistics.median(timings) * 1000:.0f} ms، '
+              f'الأدنى {min(timings) * 1000:.0f} ms، الأقصى {max(timings) * 1000:.0f} ms')
+
+
+BENCHMARKS = {
+    'payments': bench_payments,
+    'reorder': bench_reorder,
+    'read': bench_read,
+    'sync': bench_sync,
+    'events': bench_events,
+    'group-commit': bench_group_commit,
+    'archive': bench_archive,
+    'branches': bench_branches,
+    'read-routing': bench_read_routing,
+    'cold-start': bench_cold_start,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='قياسات أداء نظام المحاسبة')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--database-url', help='قاعدة بيانات القياس (افتراضياً ملف SQLite مؤقت)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--receipts', type=int, default=10000)
+    parser.add_argument('--customers', type=int, default=2000)
+    parser.add_argument('--invoices-per-customer', type=int, default=5)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=100000)
+    parser.add_argument('--sale-lines', type=int, default=500000)
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--changes', type=int, default=100)
+    parser.add_argument('--subscribers', type=int, default=500)
+    parser.add_argument('--invoices', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--branches', type=int, default=4)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        # يجب ضبط DATABASE_URL قبل استيراد app
+        os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+        BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+إعدادات قاعدة البيانات لنظام المحاسبة
+SQLite بوضع WAL افتراضياً، أو PostgreSQL عبر متغير البيئة DATABASE_URL،
+وقاعدة لكل فرع عبر BRANCH_DATABASES، واتصالات قراءة فقط لطلبات GET
+"""
+
+import os
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+
+DEFAULT_DATABASE_URL = 'sqlite:///accounting.db'
+# بادئة مفاتيح قواعد الفروع في SQLALCHEMY_BINDS
+BRANCH_BIND_PREFIX = 'branch:'
+# بادئة مفاتيح قواعد القراءة: 'read:' للقاعدة الرئيسية و 'read:branch:<الفرع>' لقواعد الفروع
+READ_BIND_PREFIX = 'read:'
+
+
+def env_int(name, default):
+    """قراءة رقم صحيح من متغيرات البيئة مع قيمة افتراضية"""
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+# إعدادات اتصال SQLite: WAL حتى لا يحجب القراء الكاتب، و busy_timeout بدلاً من "database is locked"
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': env_int('SQLITE_BUSY_TIMEOUT_MS', 5000),
+    # قيمة سالبة = الحجم بالكيلوبايت
+    'cache_size': -env_int('SQLITE_CACHE_SIZE_KB', 64000),
+    'mmap_size': env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+    'temp_store': 'MEMORY',
+}
+
+
+def normalize_url(url):
+    """تصحيح صيغة postgres:// القديمة"""
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def database_url():
+    """رابط قاعدة البيانات من DATABASE_URL"""
+    return normalize_url(os.environ.get('DATABASE_URL') or DEFAULT_DATABASE_URL)
+
+
+def branch_databases(variable='BRANCH_DATABASES'):
+    """{الفرع: رابط قاعدته} من BRANCH_DATABASES بصيغة cairo=sqlite:///cairo.db,alex=postgresql://..."""
+    branches = {}
+    for entry in os.environ.get(variable, '').split(','):
+        name, _, url = entry.partition('=')
+        if name.strip() and url.strip():
+            branches[name.strip()] = normalize_url(url.strip())
+    return branches
+
+
+def is_memory_sqlite(url):
+    """هل الرابط لقاعدة SQLite في الذاكرة"""
+    return url in ('sqlite://', 'sqlite:///:memory:') or 'mode=memory' in url
+
+
+def engine_options(url):
+    """خيارات محرك SQLAlchemy (حجم المجمع وغيرها) حسب نوع قاعدة البيانات"""
+    if url.startswith('sqlite'):
+        if is_memory_sqlite(url):
+            # Flask-SQLAlchemy يستخدم StaticPool لقاعدة الذاكرة
+            return {}
+        return {
+            'pool_size': env_int('DB_POOL_SIZE', 5),
+            'max_overflow': env_int('DB_MAX_OVERFLOW', 10),
+            'pool_timeout': env_int('DB_POOL_TIMEOUT', 30),
+            # المجمع يضمن استخدام الاتصال من خيط واحد في كل مرة
+            'connect_args': {'check_same_thread': False},
+        }
+    return {
+        'pool_pre_ping': True,
+        'pool_size': env_int('DB_POOL_SIZE', 10),
+        'max_overflow': env_int('DB_MAX_OVERFLOW', 5),
+        'pool_timeout': env_int('DB_POOL_TIMEOUT', 30),
+        'pool_recycle': env_int('DB_POOL_RECYCLE', 1800),
+    }
+
+
+def read_only_url(url):
+    """رابط اتصال SQLite للقراءة فقط لنفس الملف (file:...?mode=ro)، أو None لقاعدة الذاكرة وغير SQLite"""
+    parsed = make_url(url)
+    if parsed.get_backend_name() != 'sqlite' or is_memory_sqlite(url) or parsed.query:
+        return None
+    return f'{parsed.drivername}:///file:{parsed.database}?mode=ro&uri=true'
+
+
+def read_engine_options(url):
+    """خيارات محرك القراءة: نفس المجمع، ومعاملات PostgreSQL للقراءة فقط حتى لا يكتب طلب GET بالخطأ"""
+    options = engine_options(url)
+    if url.startswith('postgresql'):
+        options['connect_args'] = {'options': '-c default_transaction_read_only=on'}
+    return options
+
+
+def read_databases(url, branches):
+    """
+    {مفتاح قاعدة القراءة: رابطها}: نسخة متماثلة من READ_DATABASE_URL و BRANCH_READ_DATABASES،
+    وإلا اتصالات SQLite للقراءة فقط على نفس الملفات عند SQLITE_READ_ONLY=1
+    """
+    urls = {}
+    if os.environ.get('READ_DATABASE_URL'):
+        urls[READ_BIND_PREFIX] = normalize_url(os.environ['READ_DATABASE_URL'])
+    for name, replica_url in branch_databases('BRANCH_READ_DATABASES').items():
+        if name in branches:
+            urls[READ_BIND_PREFIX + BRANCH_BIND_PREFIX + name] = replica_url
+    if os.environ.get('SQLITE_READ_ONLY') == '1':
+        primaries = {'': url, **{BRANCH_BIND_PREFIX + name: branch_url for name, branch_url in branches.items()}}
+        for key, primary_url in primaries.items():
+            read_url = read_only_url(primary_url)
+            if read_url is not None:
+                urls.setdefault(READ_BIND_PREFIX + key, read_url)
+    return urls
+
+
+def database_config():
+    """إعدادات Flask-SQLAlchemy الخاصة بقاعدة البيانات"""
+    url = database_url()
+    branches = branch_databases()
+    return {
+        'SQLALCHEMY_DATABASE_URI': url,
+        'SQLALCHEMY_ENGINE_OPTIONS': engine_options(url),
+        'SQLALCHEMY_BINDS': {
+            BRANCH_BIND_PREFIX + name: dict(engine_options(branch_url), url=branch_url)
+            for name, branch_url in branches.items()
+        } | {
+            key: dict(read_engine_options(read_url), url=read_url)
+            for key, read_url in read_databases(url, branches).items()
+        },
+        'BRANCH_DATABASES': branches,
+        # الفرع الافتراضي للطلبات بلا X-Branch ولأوامر flask (None = القاعدة الرئيسية)
+        'DEFAULT_BRANCH': os.environ.get('BRANCH') or None,
+    }
+
+
+@event.listens_for(Engine, 'connect')
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """تطبيق إعدادات SQLite على كل اتصال جديد"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
@@ -0,0 +1,29 @@
+"""
+إعدادات gunicorn لنظام المحاسبة: gunicorn -c gunicorn.conf.py wsgi:app
+WEB_CONCURRENCY عدد العمليات، THREADS عدد الخيوط في كل عملية، PORT منفذ الاستماع
+عمال gthread فقط: التطبيق يستخدم خيوطاً حقيقية (الترحيل المجمّع ومجمع الفروع واستطلاع الأحداث)،
+وكل اتصال SSE يحجز خيطاً، فيُقصر عدد المشتركين على نصف THREADS في كل عامل
+"""
+
+import os
+
+from config import env_int
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{env_int('PORT', 5000)}"
+workers = env_int('WEB_CONCURRENCY', 2)
+threads = env_int('THREADS', 8)
+worker_class = 'gthread'
+# اتصالات SSE (/api/events) تبقى مفتوحة طويلاً: مهلة العامل لا تنطبق على خيوط gthread
+timeout = env_int('GUNICORN_TIMEOUT', 60)
+# استيراد التطبيق مرة في العملية الرئيسية ثم fork: العمال يبدؤون دون إعادة الاستيراد
+preload_app = True
+
+
+def post_fork(server, worker):
+    """كل عامل يفتح اتصالاته بنفسه بعد fork، ويقصر مشتركي SSE على نصف خيوطه"""
+    from app import app, db, limit_event_subscribers
+
+    limit_event_subscribers(server.cfg.threads)
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
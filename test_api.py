@@ -0,0 +1,1371 @@
+#!/usr/bin/env python3
+"""
+اختبارات واجهة API لنظام المحاسبة
+تعمل على قاعدة بيانات SQLite في الذاكرة
+"""
+
+import csv
+import io
+import json
+import os
+import subprocess
+import sys
+
+# لتشغيل الاختبارات على PostgreSQL: TEST_DATABASE_URL=postgresql://... pytest
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
+# قاعدتا فرعين في الذاكرة لاختبارات الفروع
+os.environ['BRANCH_DATABASES'] = 'north=sqlite://,south=sqlite://'
+
+import threading
+
+import pytest
+from datetime import date, datetime, timedelta
+from flask import g
+from sqlalchemy import event
+
+import config
+from app import (
+    create_app, db, Customer, Supplier, Product, DashboardSummary,
+    rebuild_dashboard_summary, rebuild_summary_command,
+    query_plan_problems, check_query_plans_command,
+    SaleInvoice, PurchaseInvoice, SALE_KIND, allocate_invoice_numbers, response_cache,
+    normalize_arabic, rebuild_search_index, init_branch_database,
+    ProductDailyRollup, PartyDailyRollup, rebuild_rollups,
+    SaleItem, CostLayer, rebuild_cost_layers, Payment, PaymentAllocation,
+    StockMovement, StockSnapshot, take_stock_snapshots, last_closed_month_end, rebuild_stock_ledger, velocity_cache,
+    prune_tombstones, EventSubscriber, event_broker, event_poller, limit_event_subscribers, TableVersion,
+    ARCHIVE_TABLES, archive_invoices, compute_dashboard_summary,
+    create_tables, fan_out, init_database_command, group_commit_writer,
+)
+
+app = create_app()
+
+
+@pytest.fixture
+def client():
+    """عميل اختبار مع قاعدة بيانات فارغة لكل اختبار"""
+    app.config['TESTING'] = True
+    response_cache.clear()
+    velocity_cache.clear()
+    with app.app_context():
+        db.create_all()
+        yield app.test_client()
+        db.session.remove()
+        db.drop_all()
+
+
+def seed_parties():
+    """إضافة عميل ومورد ومنتجين للاختبار"""
+    db.session.add_all([
+        Customer(name="أحمد محمد علي", phone="01012345678"),
+        Supplier(name="شركة الأهرام للتجارة", phone="01234567890"),
+        Product(name="كمبيوتر محمول", code="LAP001", price=15000.0, cost=12000.0, quantity=50, min_stock=2),
+        Product(name="ماوس لاسلكي", code="MOU001", price=200.0, cost=150.0, quantity=50, min_stock=10),
+    ])
+    db.session.commit()
+
+
+def sale_payload(day='2025-11-10', customer_id=1, paid=0.0, items=None):
+    """بيانات فاتورة مبيعات بسيطة"""
+    items = items or [{'product_id': 1, 'quantity': 1, 'price': 100.0, 'total': 100.0}]
+    total = sum(item['total'] for item in items)
+    return {
+        'customer_id': customer_id,
+        'date': day,
+        'items': items,
+        'subtotal': total,
+        'total': total,
+        'paid': paid,
+        'remaining': total - paid,
+        'status': 'completed' if paid >= total else 'partial',
+    }
+
+
+def purchase_payload(day='2025-11-10', supplier_id=1, paid=0.0, items=None):
+    """بيانات فاتورة مشتريات بسيطة"""
+    items = items or [{'product_id': 1, 'quantity': 1, 'cost': 80.0, 'total': 80.0}]
+    total = sum(item['total'] for item in items)
+    return {
+        'supplier_id': supplier_id,
+        'date': day,
+        'items': items,
+        'subtotal': total,
+        'total': total,
+        'paid': paid,
+        'remaining': total - paid,
+        'status': 'completed' if paid >= total else 'partial',
+    }
+
+
+# ===========================================
+# التقسيم إلى صفحات
+# ===========================================
+
+def test_list_without_limit_returns_everything(client):
+    seed_parties()
+    response = client.get('/api/products')
+    assert response.status_code == 200
+    assert [p['code'] for p in response.get_json()] == ['LAP001', 'MOU001']
+    assert 'X-Next-Cursor' not in response.headers
+
+
+def test_keyset_pagination_walks_all_pages(client):
+    db.session.add_all([Customer(name=f"عميل {i}") for i in range(7)])
+    db.session.commit()
+
+    seen, cursor = [], None
+    while True:
+        url = '/api/customers?limit=3' + (f'&after={cursor}' if cursor else '')
+        response = client.get(url)
+        seen.extend(c['id'] for c in response.get_json())
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+    assert seen == list(range(1, 8))
+
+
+def test_invoice_list_is_paged_by_default(client):
+    db.session.add_all([SaleInvoice(invoice_number=f'S{index}', subtotal=10.0, total=10.0, remaining=0.0)
+                        for index in range(app.config['API_PAGE_SIZE'] + 5)])
+    db.session.commit()
+
+    first = client.get('/api/sales')
+    assert len(first.get_json()) == app.config['API_PAGE_SIZE']
+    second = client.get(f"/api/sales?after={first.headers['X-Next-Cursor']}")
+    assert len(second.get_json()) == 5 and 'X-Next-Cursor' not in second.headers
+    assert client.get(f"/api/sales?limit={app.config['API_MAX_PAGE_SIZE'] + 1}").status_code == 400
+
+
+def test_sales_sorted_by_date_desc_with_filters(client):
+    seed_parties()
+    for day in ['2025-11-01', '2025-11-03', '2025-11-03', '2025-11-05', '2025-12-01']:
+        client.post('/api/sales', json=sale_payload(day=day))
+
+    first = client.get('/api/sales?sort=date&order=desc&limit=2&date_to=2025-11-30')
+    dates = [s['date'] for s in first.get_json()]
+    assert dates == ['2025-11-05', '2025-11-03']
+
+    second = client.get('/api/sales?sort=date&order=desc&limit=2&date_to=2025-11-30'
+                        f"&after={first.headers['X-Next-Cursor']}")
+    assert [s['date'] for s in second.get_json()] == ['2025-11-03', '2025-11-01']
+    assert 'X-Next-Cursor' not in second.headers
+
+
+@pytest.mark.parametrize('model, url', [
+    (Customer, '/api/customers'), (Supplier, '/api/suppliers'), (Product, '/api/products'),
+    (SaleInvoice, '/api/sales'), (PurchaseInvoice, '/api/purchases'),
+])
+def test_light_lists_match_to_dict_bytes(client, model, url):
+    seed_parties()
+    db.session.add(Customer(name="بدون هاتف", balance=12.5))
+    db.session.commit()
+    client.post('/api/sales', json=sale_payload(items=[
+        {'product_id': 1, 'quantity': 1, 'price': 100.0, 'total': 100.0},
+        {'product_id': 2, 'quantity': 3, 'price': 33.3, 'discount': 0.1, 'total': 99.9},
+    ]))
+    client.post('/api/sales', json=sale_payload(customer_id=2, day='2025-11-12', paid=100.0))
+    client.post('/api/purchases', json=purchase_payload())
+    db.session.expire_all()
+
+    with app.test_request_context():
+        expected = app.json.response([row.to_dict() for row in model.query.order_by(model.id)]).get_data()
+    assert client.get(url).data == expected
+
+
+def test_sparse_fields_and_fast_json(client):
+    seed_parties()
+    client.post('/api/sales', json=sale_payload())
+    client.post('/api/sales', json=sale_payload(day='2025-11-12'))
+
+    response = client.get('/api/products?fields=code,price')
+    assert response.get_json() == [{'code': 'LAP001', 'price': 15000.0}, {'code': 'MOU001', 'price': 200.0}]
+    # المؤشر يعمل حتى إذا لم تُطلب حقول الترتيب
+    first = client.get('/api/sales?fields=invoice_number&sort=date&limit=1')
+    assert list(first.get_json()[0]) == ['invoice_number']
+    second = client.get(f"/api/sales?fields=date&sort=date&limit=1&after={first.headers['X-Next-Cursor']}")
+    assert second.get_json() == [{'date': '2025-11-12'}]
+    assert client.get('/api/customers?fields=name,secret').status_code == 400
+    assert client.get('/api/customers?fields=,').status_code == 400
+
+    full = client.get('/api/sales').get_json()
+    app.config['FAST_JSON'] = True
+    try:
+        response_cache.clear()
+        assert json.loads(client.get('/api/sales').data) == full
+    finally:
+        app.config['FAST_JSON'] = False
+
+
+def test_invalid_pagination_arguments(client):
+    assert client.get('/api/sales?limit=0').status_code == 400
+    assert client.get('/api/sales?sort=total').status_code == 400
+    assert client.get('/api/sales?after=not-a-cursor').status_code == 400
+    assert client.get('/api/sales?date_from=10-11-2025').status_code == 400
+
+
+# ===========================================
+# عدد الاستعلامات (N+1)
+# ===========================================
+
+def capture_queries(client, url, headers=None, status=200):
+    """استعلامات SQL المنفذة أثناء طلب واحد"""
+    statements = []
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_execute)
+    try:
+        assert client.get(url, headers=headers or {}).status_code == status
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_execute)
+    return statements
+
+
+def count_queries(client, url):
+    """عدد استعلامات SQL المنفذة أثناء طلب واحد"""
+    return len(capture_queries(client, url))
+
+
+def test_invoice_lists_use_constant_number_of_queries(client):
+    seed_parties()
+    items = [
+        {'product_id': 1, 'quantity': 1, 'price': 100.0, 'total': 100.0},
+        {'product_id': 2, 'quantity': 2, 'price': 20.0, 'total': 40.0},
+    ]
+    purchase_items = [
+        {'product_id': 1, 'quantity': 1, 'cost': 80.0, 'total': 80.0},
+        {'product_id': 2, 'quantity': 2, 'cost': 10.0, 'total': 20.0},
+    ]
+
+    def post_batch(count):
+        for _ in range(count):
+            client.post('/api/sales', json=sale_payload(items=items))
+            client.post('/api/purchases', json=purchase_payload(items=purchase_items))
+        db.session.expire_all()
+
+    post_batch(2)
+    small = [count_queries(client, url) for url in ('/api/sales', '/api/purchases', '/api/dashboard')]
+    post_batch(10)
+    large = [count_queries(client, url) for url in ('/api/sales', '/api/purchases', '/api/dashboard')]
+    assert small == large
+
+
+# ===========================================
+# التصدير
+# ===========================================
+
+def test_export_sales_ndjson_has_one_row_per_line(client):
+    seed_parties()
+    items = [
+        {'product_id': 1, 'quantity': 1, 'price': 100.0, 'total': 100.0},
+        {'product_id': 2, 'quantity': 2, 'price': 20.0, 'total': 40.0},
+    ]
+    client.post('/api/sales', json=sale_payload(day='2025-11-01', items=items))
+    client.post('/api/sales', json=sale_payload(day='2025-12-01'))
+
+    response = client.get('/api/sales/export?date_to=2025-11-30')
+    assert response.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [(r['invoice_id'], r['product_name'], r['item_total']) for r in rows] == [
+        (1, 'كمبيوتر محمول', 100.0),
+        (1, 'ماوس لاسلكي', 40.0),
+    ]
+    assert rows[0]['customer_name'] == 'أحمد محمد علي'
+    assert rows[0]['date'] == '2025-11-01'
+
+
+def test_export_purchases_csv(client):
+    seed_parties()
+    app.config['EXPORT_CHUNK_SIZE'] = 2
+    try:
+        for _ in range(3):
+            client.post('/api/purchases', json=purchase_payload())
+        response = client.get('/api/purchases/export?format=csv')
+    finally:
+        app.config['EXPORT_CHUNK_SIZE'] = 1000
+    assert response.is_streamed
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True).lstrip('\ufeff'))))
+    assert len(rows) == 3
+    assert rows[0]['supplier_name'] == 'شركة الأهرام للتجارة'
+    assert rows[0]['cost'] == '80.0'
+    assert client.get('/api/purchases/export?format=xml').status_code == 400
+
+
+# ===========================================
+# الإدخال المجمّع
+# ===========================================
+
+def test_bulk_sales_reports_each_invoice(client):
+    seed_parties()
+    invoices = [
+        sale_payload(items=[{'product_id': 1, 'quantity': 2, 'price': 100.0, 'total': 200.0}]),
+        sale_payload(items=[{'product_id': 99, 'quantity': 1, 'price': 10.0, 'total': 10.0}]),
+        {'customer_id': 1, 'date': '2025-11-10'},
+        sale_payload(customer_id=42),
+        sale_payload(items=[
+            {'product_id': 1, 'quantity': 1, 'price': 100.0, 'total': 100.0},
+            {'product_id': 2, 'quantity': 3, 'price': 20.0, 'total': 60.0},
+        ]),
+        sale_payload(paid=100.0),
+    ]
+    response = client.post('/api/sales/bulk?chunk_size=2', json={'invoices': invoices})
+    body = response.get_json()
+    assert body['created'] == 3 and body['failed'] == 3
+    assert [r['success'] for r in body['results']] == [True, False, False, False, True, True]
+    assert len({r['invoice_number'] for r in body['results'] if r['success']}) == 3
+
+    db.session.expire_all()
+    assert db.session.get(Product, 1).quantity == 50 - 2 - 1 - 1
+    assert db.session.get(Product, 2).quantity == 50 - 3
+    assert db.session.get(Customer, 1).balance == 200.0 + 160.0
+    sales = client.get('/api/sales').get_json()
+    assert [len(s['items']) for s in sales] == [1, 2, 1]
+
+
+def test_bulk_chunk_failure_rejects_only_the_bad_invoice(client):
+    seed_parties()
+    oversold = sale_payload(items=[{'product_id': 2, 'quantity': 60, 'price': 1.0, 'total': 60.0}])
+    app.config['PREVENT_NEGATIVE_STOCK'] = True
+    try:
+        response = client.post('/api/sales/bulk', json={'invoices': [
+            sale_payload(), sale_payload(), oversold, sale_payload(),
+        ]})
+    finally:
+        app.config['PREVENT_NEGATIVE_STOCK'] = False
+    body = response.get_json()
+    assert body['created'] == 3 and body['failed'] == 1
+    assert [r['success'] for r in body['results']] == [True, True, False, True]
+    assert body['results'][2]['error'].endswith('[2]')
+    assert len({r['invoice_number'] for r in body['results'] if r['success']}) == 3
+    db.session.expire_all()
+    assert db.session.get(Product, 2).quantity == 50
+    assert len(client.get('/api/sales').get_json()) == 3
+
+
+def test_bulk_purchases_increase_stock(client):
+    seed_parties()
+    response = client.post('/api/purchases/bulk', json={'invoices': [purchase_payload()] * 4})
+    assert response.get_json()['created'] == 4
+    db.session.expire_all()
+    assert db.session.get(Product, 1).quantity == 54
+    assert db.session.get(Supplier, 1).balance == 320.0
+    assert client.post('/api/purchases/bulk', json={}).status_code == 400
+
+
+# ===========================================
+# ملخص لوحة التحكم
+# ===========================================
+
+def test_dashboard_summary_tracks_writes_without_drift(client):
+    this_month = date.today().strftime('%Y-%m-%d')
+    client.post('/api/customers', json={'name': 'عميل'})
+    client.post('/api/customers', json={'name': 'عميل مؤقت'})
+    client.delete('/api/customers/2')
+    client.post('/api/suppliers', json={'name': 'مورد'})
+    client.post('/api/products', json={'name': 'منتج', 'code': 'P1', 'price': 10, 'cost': 5,
+                                       'quantity': 6, 'min_stock': 5})
+    client.post('/api/products', json={'name': 'منتج 2', 'code': 'P2', 'price': 10, 'cost': 5,
+                                       'quantity': 1, 'min_stock': 5})
+    client.post('/api/sales', json=sale_payload(day=this_month, items=[
+        {'product_id': 1, 'quantity': 2, 'price': 10.0, 'total': 20.0}]))
+    client.post('/api/sales', json=sale_payload(day='2020-01-15'))
+    client.post('/api/purchases', json=purchase_payload(day=this_month, items=[
+        {'product_id': 2, 'quantity': 10, 'cost': 5.0, 'total': 50.0}]))
+    client.post('/api/sales/bulk', json={'invoices': [sale_payload(day=this_month, items=[
+        {'product_id': 2, 'quantity': 1, 'price': 10.0, 'total': 10.0}])]})
+
+    data = client.get('/api/dashboard').get_json()
+    assert data['total_customers'] == 1
+    assert data['total_suppliers'] == 1
+    assert data['total_products'] == 2
+    assert data['low_stock'] == 1
+    assert data['total_sales'] == 130.0
+    assert data['monthly_sales'] == 30.0
+    assert data['monthly_purchases'] == 50.0
+    assert data['cost_of_sales'] == 20.0
+    assert data['profit'] == 110.0
+    assert rebuild_dashboard_summary(write=False) == []
+
+
+def test_rebuild_summary_repairs_drift(client):
+    seed_parties()
+    assert ('customers', '', 0.0, 1) in rebuild_dashboard_summary(write=False)
+
+    runner = app.test_cli_runner()
+    assert runner.invoke(rebuild_summary_command, ['--check']).exit_code == 1
+    assert runner.invoke(rebuild_summary_command).exit_code == 0
+    assert rebuild_dashboard_summary(write=False) == []
+    assert db.session.get(DashboardSummary, ('', 'low_stock')) is not None
+    assert client.get('/api/dashboard').get_json()['total_products'] == 2
+
+
+def test_rebuild_summary_invalidates_dashboard_etag(client):
+    seed_parties()
+    rebuild_dashboard_summary()
+    response = client.get('/api/dashboard')
+    # انحراف في الملخص دون زيادة الإصدارات، ثم إصلاحه
+    db.session.execute(db.update(DashboardSummary).where(DashboardSummary.metric == 'products').values(value=99))
+    db.session.commit()
+    rebuild_dashboard_summary()
+
+    repaired = client.get('/api/dashboard', headers={'If-None-Match': response.headers['ETag']})
+    assert repaired.status_code == 200
+    assert repaired.get_json()['total_products'] == 2
+
+
+# ===========================================
+# الفهارس وخطط الاستعلامات
+# ===========================================
+
+def test_hot_queries_do_not_scan_tables(client):
+    assert query_plan_problems() == []
+    assert app.test_cli_runner().invoke(check_query_plans_command).exit_code == 0
+
+
+@pytest.mark.skipif(not os.environ['DATABASE_URL'].startswith('sqlite'), reason='EXPLAIN QUERY PLAN خاص بـ SQLite')
+def test_query_plan_check_detects_missing_index(client):
+    db.session.execute(db.text('DROP INDEX ix_sale_invoice_date_id'))
+    problems = dict(query_plan_problems())
+    assert problems['sale_invoice_page_by_date'].startswith('SCAN sale_invoice')
+
+
+def test_date_to_filter_is_inclusive(client):
+    seed_parties()
+    for day in ['2025-11-29', '2025-11-30', '2025-12-01']:
+        client.post('/api/sales', json=sale_payload(day=day))
+    sales = client.get('/api/sales?date_from=2025-11-30&date_to=2025-11-30').get_json()
+    assert [s['date'] for s in sales] == ['2025-11-30']
+
+
+# ===========================================
+# ترقيم الفواتير
+# ===========================================
+
+def test_invoice_numbers_continue_after_existing_numbers(client):
+    seed_parties()
+    today = datetime.now().strftime('%Y%m%d')
+    db.session.add(SaleInvoice(customer_id=1, invoice_number=f'S-{today}-0057',
+                               subtotal=1.0, total=1.0, remaining=0.0))
+    db.session.commit()
+
+    invoice = client.post('/api/sales', json=sale_payload()).get_json()['invoice']
+    assert invoice['invoice_number'] == f'S-{today}-0058'
+    assert allocate_invoice_numbers(SALE_KIND, 3) == [f'S-{today}-{n:04d}' for n in (59, 60, 61)]
+    purchase = client.post('/api/purchases', json=purchase_payload()).get_json()['invoice']
+    assert purchase['invoice_number'] == f'P-{today}-0001'
+
+
+# ===========================================
+# ترحيل المخزون والأرصدة
+# ===========================================
+
+def test_sale_updates_stock_and_balance(client):
+    seed_parties()
+    client.post('/api/sales', json=sale_payload(items=[
+        {'product_id': 1, 'quantity': 2, 'price': 100.0, 'total': 200.0},
+        {'product_id': 1, 'quantity': 3, 'price': 100.0, 'total': 300.0},
+    ], paid=100.0))
+    db.session.expire_all()
+    assert db.session.get(Product, 1).quantity == 45
+    assert db.session.get(Customer, 1).balance == 400.0
+
+
+def test_prevent_negative_stock_rejects_oversell(client):
+    seed_parties()
+    app.config['PREVENT_NEGATIVE_STOCK'] = True
+    try:
+        response = client.post('/api/sales', json=sale_payload(items=[
+            {'product_id': 1, 'quantity': 10, 'price': 1.0, 'total': 10.0},
+            {'product_id': 2, 'quantity': 51, 'price': 1.0, 'total': 51.0},
+        ]))
+        bulk = client.post('/api/sales/bulk', json={'invoices': [sale_payload(items=[
+            {'product_id': 2, 'quantity': 60, 'price': 1.0, 'total': 60.0}])]})
+    finally:
+        app.config['PREVENT_NEGATIVE_STOCK'] = False
+    assert response.status_code == 409
+    assert response.get_json()['product_ids'] == [2]
+    assert bulk.get_json()['failed'] == 1
+    db.session.expire_all()
+    assert db.session.get(Product, 1).quantity == 50
+    assert db.session.get(Customer, 1).balance == 0.0
+    assert client.get('/api/sales').get_json() == []
+
+
+# ===========================================
+# إعدادات قاعدة البيانات
+# ===========================================
+
+def test_sqlite_file_connections_use_wal_profile(tmp_path, monkeypatch):
+    from sqlalchemy import create_engine
+
+    url = f"sqlite:///{tmp_path / 'profile.db'}"
+    monkeypatch.setenv('DATABASE_URL', url)
+    settings = config.database_config()
+    assert settings['SQLALCHEMY_DATABASE_URI'] == url
+    engine = create_engine(url, **settings['SQLALCHEMY_ENGINE_OPTIONS'])
+    with engine.connect() as connection:
+        pragma = lambda name: connection.exec_driver_sql(f'PRAGMA {name}').scalar()
+        assert pragma('journal_mode') == 'wal'
+        assert pragma('synchronous') == 1
+        assert pragma('busy_timeout') == config.SQLITE_PRAGMAS['busy_timeout']
+    engine.dispose()
+
+
+def test_postgresql_url_gets_pooling_options(monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', 'postgres://user:secret@db:5432/accounting')
+    monkeypatch.setenv('DB_POOL_SIZE', '20')
+    settings = config.database_config()
+    assert settings['SQLALCHEMY_DATABASE_URI'].startswith('postgresql://')
+    options = settings['SQLALCHEMY_ENGINE_OPTIONS']
+    assert options['pool_pre_ping'] is True
+    assert options['pool_size'] == 20
+    assert config.engine_options('sqlite://') == {}
+
+
+# ===========================================
+# GET الشرطي (ETag)
+# ===========================================
+
+def test_etag_returns_304_without_reading_model_tables(client):
+    client.post('/api/products', json={'name': 'منتج', 'code': 'P1', 'price': 10, 'cost': 5})
+    first = client.get('/api/products')
+    etag = first.headers['ETag']
+
+    statements = capture_queries(client, '/api/products', {'If-None-Match': etag}, status=304)
+    assert len(statements) == 1 and 'table_version' in statements[0]
+
+    # الطلب المتكرر دون If-None-Match يُقدَّم من الذاكرة بنفس المحتوى
+    statements = capture_queries(client, '/api/products')
+    assert len(statements) == 1
+    assert client.get('/api/products').get_data() == first.get_data()
+
+
+def test_writes_change_etags_of_dependent_endpoints(client):
+    seed_parties()
+    products_etag = client.get('/api/products').headers['ETag']
+    sales_etag = client.get('/api/sales').headers['ETag']
+    suppliers_etag = client.get('/api/suppliers').headers['ETag']
+    assert client.get('/api/products?limit=1').headers['ETag'] != products_etag
+
+    client.post('/api/sales', json=sale_payload())
+    assert client.get('/api/products', headers={'If-None-Match': products_etag}).status_code == 200
+    assert client.get('/api/sales', headers={'If-None-Match': sales_etag}).status_code == 200
+    assert client.get('/api/suppliers', headers={'If-None-Match': suppliers_etag}).status_code == 304
+    assert len(client.get('/api/sales').get_json()) == 1
+
+
+# ===========================================
+# البحث
+# ===========================================
+
+def test_normalize_arabic():
+    assert normalize_arabic('إِسْلامٌ') == normalize_arabic('اسلام')
+    assert normalize_arabic('مكتبة') == 'مكتبه'
+    assert normalize_arabic('مستشفى') == 'مستشفي'
+    assert normalize_arabic('٠١٢٣') == '0123'
+
+
+@pytest.mark.skipif(not os.environ['DATABASE_URL'].startswith('sqlite'), reason='فهرس FTS5 خاص بـ SQLite')
+def test_product_search_follows_crud(client):
+    for name, code in [('شاشة كمبيوتر', 'MON001'), ('كمبيوتر محمول', 'LAP001'), ('مكتبة خشب', 'DSK001')]:
+        client.post('/api/products', json={'name': name, 'code': code, 'price': 1, 'cost': 1,
+                                           'category': 'إلكترونيات'})
+    search = lambda q: [p['code'] for p in client.get(f'/api/products/search?q={q}').get_json()]
+
+    assert sorted(search('كمبيوتر')) == ['LAP001', 'MON001']
+    assert search('كمبيو محم') == ['LAP001']
+    assert search('مكتبه') == ['DSK001']
+    assert search('الكترونيات') and len(search('الكترونيات')) == 3
+    assert search('DSK001')[0] == 'DSK001'
+    assert [p['code'] for p in client.get('/api/products/search?code=MON001').get_json()] == ['MON001']
+
+    client.put('/api/products/3', json={'name': 'طاولة', 'code': 'DSK001', 'price': 1, 'cost': 1})
+    assert search('مكتبة') == []
+    assert search('طاولة') == ['DSK001']
+    client.delete('/api/products/2')
+    assert search('كمبيوتر') == ['MON001']
+
+
+@pytest.mark.skipif(not os.environ['DATABASE_URL'].startswith('sqlite'), reason='فهرس FTS5 خاص بـ SQLite')
+def test_customer_search_and_rebuild(client):
+    seed_parties()
+    assert client.get('/api/customers/search?q=أحمد').get_json() == []
+    rebuild_search_index()
+    assert [c['id'] for c in client.get('/api/customers/search?q=احمد').get_json()] == [1]
+    assert [c['id'] for c in client.get('/api/customers/search?q=010123').get_json()] == [1]
+    client.post('/api/customers', json={'name': 'فاطمة حسن', 'phone': '01098765432'})
+    assert [c['name'] for c in client.get('/api/customers/search?q=فاطمه').get_json()] == ['فاطمة حسن']
+    assert client.get('/api/customers/search?q=x&limit=500').status_code == 400
+
+
+def test_init_backfills_each_search_index_separately(client):
+    seed_parties()
+    # قاعدة منتجاتها مفهرسة وعملاؤها لا
+    rebuild_search_index([Product])
+    assert client.get('/api/customers/search?q=احمد').get_json() == []
+    init_branch_database(sample_data=False)
+    assert [c['id'] for c in client.get('/api/customers/search?q=احمد').get_json()] == [1]
+    assert [p['code'] for p in client.get('/api/products/search?q=ماوس').get_json()] == ['MOU001']
+
+
+# ===========================================
+# التجميعات اليومية والتقارير
+# ===========================================
+
+def rollup_rows():
+    """كل صفوف جداول التجميع مرتبة للمقارنة"""
+    def rows(model):
+        columns = [column.name for column in model.__table__.columns]
+        return sorted(tuple(getattr(row, name) for name in columns) for row in model.query.all())
+    return rows(ProductDailyRollup), rows(PartyDailyRollup)
+
+
+def post_report_invoices(client):
+    seed_parties()
+    client.post('/api/sales', json=sale_payload(day='2025-11-01', paid=100.0))
+    client.post('/api/sales', json=sale_payload(day='2025-11-01', items=[
+        {'product_id': 1, 'quantity': 2, 'price': 100.0, 'total': 200.0},
+        {'product_id': 2, 'quantity': 3, 'price': 50.0, 'total': 150.0},
+    ]))
+    client.post('/api/sales/bulk', json={'invoices': [
+        sale_payload(day='2025-11-02', items=[{'product_id': 2, 'quantity': 10, 'price': 50.0, 'total': 500.0}]),
+    ]})
+    client.post('/api/purchases', json=purchase_payload(day='2025-11-02'))
+
+
+def test_daily_report_from_rollups(client):
+    post_report_invoices(client)
+    response = client.get('/api/reports/daily?date_from=2025-11-01&date_to=2025-11-30')
+    assert response.status_code == 200
+    days = {row['date']: row for row in response.get_json()}
+    assert sorted(days) == ['2025-11-01', '2025-11-02']
+    assert days['2025-11-01']['invoices'] == 2
+    assert days['2025-11-01']['revenue'] == 450.0
+    assert days['2025-11-01']['paid'] == 100.0
+    assert days['2025-11-01']['cost'] == 3 * 12000.0 + 3 * 150.0
+    assert days['2025-11-02']['revenue'] == 500.0
+
+    purchases = client.get('/api/reports/daily?type=purchases&date_from=2025-11-01&date_to=2025-11-30')
+    assert [(row['date'], row['cost']) for row in purchases.get_json()] == [('2025-11-02', 80.0)]
+    assert 'profit' not in purchases.get_json()[0]
+
+
+def test_top_products_and_parties(client):
+    post_report_invoices(client)
+    top = client.get('/api/reports/top-products?date_from=2025-11-01&date_to=2025-11-30&order_by=quantity')
+    rows = top.get_json()
+    assert [(row['product_id'], row['quantity']) for row in rows] == [(2, 13), (1, 3)]
+    assert rows[0]['product_name'] == "ماوس لاسلكي"
+
+    parties = client.get('/api/reports/top-parties?date_from=2025-11-01&date_to=2025-11-30').get_json()
+    assert parties == [{
+        'customer_id': 1, 'customer_name': "أحمد محمد علي", 'invoices': 3,
+        'revenue': 950.0, 'cost': 3 * 12000.0 + 13 * 150.0, 'discount': 0.0,
+        'paid': 100.0, 'remaining': 850.0, 'profit': 950.0 - (3 * 12000.0 + 13 * 150.0),
+    }]
+
+    series = client.get('/api/reports/products/2?date_from=2025-11-01&date_to=2025-11-30').get_json()
+    assert [(row['date'], row['quantity']) for row in series] == [('2025-11-01', 3), ('2025-11-02', 10)]
+
+    assert client.get('/api/reports/top-products?order_by=name').status_code == 400
+    assert client.get('/api/reports/daily?type=returns').status_code == 400
+
+
+def test_rebuild_rollups_matches_incremental_updates(client):
+    post_report_invoices(client)
+    incremental = rollup_rows()
+    assert incremental[0] and incremental[1]
+    rebuild_rollups()
+    assert rollup_rows() == incremental
+
+
+# ===========================================
+# تكلفة البضاعة المباعة (طبقات التكلفة)
+# ===========================================
+
+@pytest.fixture(params=['fifo', 'average'])
+def cost_method(request):
+    app.config['COST_METHOD'] = request.param
+    yield request.param
+    app.config['COST_METHOD'] = 'fifo'
+
+
+def post_cost_history(client):
+    """منتج برصيد 10 بتكلفة 5، شراء 10 بـ 8، بيع 15، شراء 5 بـ 10، بيع 10"""
+    client.post('/api/customers', json={'name': 'عميل'})
+    client.post('/api/suppliers', json={'name': 'مورد'})
+    client.post('/api/products', json={'name': 'منتج', 'code': 'P1', 'price': 20, 'cost': 5,
+                                       'quantity': 10, 'category': 'أدوات'})
+    client.post('/api/purchases', json=purchase_payload(day='2025-11-01', items=[
+        {'product_id': 1, 'quantity': 10, 'cost': 8.0, 'total': 80.0}]))
+    client.post('/api/sales', json=sale_payload(day='2025-11-02', items=[
+        {'product_id': 1, 'quantity': 15, 'price': 20.0, 'total': 300.0}]))
+    client.post('/api/purchases/bulk', json={'invoices': [purchase_payload(day='2025-11-03', items=[
+        {'product_id': 1, 'quantity': 5, 'cost': 10.0, 'total': 50.0}])]})
+    client.post('/api/sales/bulk', json={'invoices': [sale_payload(day='2025-11-04', items=[
+        {'product_id': 1, 'quantity': 10, 'price': 20.0, 'total': 200.0}])]})
+
+
+def cost_state():
+    """تكلفة بنود البيع والطبقات المفتوحة (دون المعرفات والتواريخ)"""
+    costs = [item.cost for item in SaleItem.query.order_by(SaleItem.id)]
+    layers = sorted(
+        (layer.product_id, layer.source, layer.remaining, round(layer.unit_cost, 6))
+        for layer in CostLayer.query.filter(CostLayer.remaining > 0)
+    )
+    return costs, layers
+
+
+def test_sales_record_cogs_from_cost_layers(client, cost_method):
+    post_cost_history(client)
+    costs, layers = cost_state()
+    if cost_method == 'fifo':
+        assert costs == [10 * 5.0 + 5 * 8.0, 5 * 8.0 + 5 * 10.0]
+        assert layers == []
+    else:
+        assert costs == [15 * 6.5, 10 * 8.25]
+        assert layers == []
+    assert db.session.get(Product, 1).quantity == 0
+
+    margins = client.get('/api/reports/margins?group_by=category&date_from=2025-11-01&date_to=2025-11-30')
+    row, = margins.get_json()
+    assert row['category'] == 'أدوات'
+    assert row['revenue'] == 500.0
+    assert row['cost'] == pytest.approx(sum(costs))
+    assert row['margin'] == round((500.0 - sum(costs)) / 500.0, 4)
+    assert client.get('/api/dashboard').get_json()['profit'] == pytest.approx(500.0 - sum(costs))
+
+
+def test_rebuild_cost_layers_replays_history(client, cost_method):
+    post_cost_history(client)
+    client.post('/api/purchases', json=purchase_payload(day='2025-11-05', items=[
+        {'product_id': 1, 'quantity': 4, 'cost': 9.0, 'total': 36.0}]))
+    incremental = cost_state()
+    assert incremental[1]
+
+    SaleItem.query.update({'cost': None})
+    db.session.commit()
+    assert rebuild_cost_layers() == 2
+    assert cost_state() == incremental
+
+
+# ===========================================
+# كشوف الحساب وأعمار الديون
+# ===========================================
+
+def test_aging_buckets_only_open_invoices(client):
+    seed_parties()
+    db.session.add(Customer(name="عميل بلا ديون"))
+    db.session.commit()
+    for day, paid in [('2025-11-30', 0.0), ('2025-11-01', 40.0), ('2025-10-01', 0.0),
+                      ('2025-09-01', 0.0), ('2025-06-01', 0.0), ('2025-06-02', 100.0)]:
+        client.post('/api/sales', json=sale_payload(day=day, paid=paid))
+    client.post('/api/sales', json=sale_payload(day='2025-12-05'))
+
+    data = client.get('/api/aging?as_of=2025-11-30').get_json()
+    row, = data['parties']
+    assert row['customer_id'] == 1
+    assert row['customer_name'] == "أحمد محمد علي"
+    assert (row['days_0_30'], row['days_31_60'], row['days_61_90'], row['days_over_90']) == \
+        (160.0, 100.0, 100.0, 100.0)
+    assert row['invoices'] == 5
+    assert data['totals']['total'] == 460.0
+    assert client.get('/api/aging?type=suppliers').get_json()['parties'] == []
+    assert client.get('/api/aging?type=products').status_code == 400
+
+
+def test_customer_statement_running_balance(client):
+    seed_parties()
+    client.post('/api/sales', json=sale_payload(day='2025-10-01', paid=30.0))
+    client.post('/api/sales', json=sale_payload(day='2025-11-01', paid=100.0))
+    client.post('/api/sales', json=sale_payload(day='2025-11-15', paid=20.0))
+
+    data = client.get('/api/customers/1/statement?date_from=2025-11-01&date_to=2025-11-30').get_json()
+    assert data['customer']['id'] == 1
+    assert data['opening_balance'] == 70.0
+    assert [(line['date'], line['balance']) for line in data['lines']] == \
+        [('2025-11-01', 70.0), ('2025-11-15', 150.0)]
+    assert data['closing_balance'] == 150.0
+    assert data['aging']['total'] == 150.0
+    assert data['aging']['days_0_30'] == 80.0
+
+    assert client.get('/api/suppliers/1/statement').get_json()['lines'] == []
+    assert client.get('/api/customers/99/statement').status_code == 404
+
+
+# ===========================================
+# المدفوعات وتخصيصها
+# ===========================================
+
+def test_bulk_payments_allocate_oldest_first(client):
+    seed_parties()
+    db.session.add(Customer(name="عميل ثانٍ"))
+    db.session.commit()
+    for day in ['2025-11-10', '2025-11-01', '2025-11-05']:
+        client.post('/api/sales', json=sale_payload(day=day))
+    client.post('/api/sales', json=sale_payload(day='2025-11-02', customer_id=2))
+
+    response = client.post('/api/payments/bulk?type=customers&chunk_size=2', json={'payments': [
+        {'customer_id': 1, 'amount': 150.0, 'date': '2025-11-20', 'reference': 'TRX-1'},
+        {'customer_id': 99, 'amount': 10.0, 'reference': 'TRX-2'},
+        {'customer_id': 1, 'amount': 30.0, 'date': '2025-11-21', 'reference': 'TRX-3'},
+        {'customer_id': 1, 'amount': 0},
+        {'customer_id': 2, 'amount': 40.0, 'date': '2025-11-21', 'reference': 'TRX-1'},
+        {'customer_id': 2, 'amount': 40.0, 'date': '2025-11-21', 'reference': 'TRX-4'},
+        {'customer_id': 1, 'amount': 200.0, 'date': '2025-11-22'},
+    ]}).get_json()
+    assert [r['success'] for r in response['results']] == [True, False, True, False, False, True, True]
+    assert [r.get('unallocated') for r in response['results'] if r['success']] == [0.0, 0.0, 0.0, 80.0]
+
+    invoices = {sale.date.isoformat(): (sale.paid, sale.remaining, sale.status)
+                for sale in SaleInvoice.query.filter_by(customer_id=1)}
+    assert invoices == {
+        '2025-11-01': (100.0, 0.0, 'completed'),
+        '2025-11-05': (100.0, 0.0, 'completed'),
+        '2025-11-10': (100.0, 0.0, 'completed'),
+    }
+    # الفواتير بالترتيب: 2 (1 نوفمبر)، 3 (5 نوفمبر)، 1 (10 نوفمبر)؛ والفاتورة 4 للعميل الثاني
+    assert sorted((a.payment_id, a.invoice_id, a.amount) for a in PaymentAllocation.query) == [
+        (1, 2, 100.0), (1, 3, 50.0), (2, 3, 30.0), (3, 4, 40.0), (4, 1, 100.0), (4, 3, 20.0),
+    ]
+    assert db.session.get(Customer, 1).balance == -80.0
+    assert db.session.get(Customer, 2).balance == 60.0
+
+    # إعادة رفع نفس الملف لا تكرر الدفعات
+    again = client.post('/api/payments/bulk', json={'payments': [
+        {'customer_id': 1, 'amount': 150.0, 'reference': 'TRX-1'}]}).get_json()
+    assert again['failed'] == 1
+    assert Payment.query.count() == 4
+
+
+def test_payment_updates_statement_aging_and_rollups(client):
+    seed_parties()
+    client.post('/api/sales', json=sale_payload(day='2025-11-01', paid=30.0))
+    client.post('/api/sales', json=sale_payload(day='2025-11-05'))
+    client.post('/api/purchases', json=purchase_payload(day='2025-11-03'))
+    incremental_before = rollup_rows()
+
+    response = client.post('/api/payments', json={'customer_id': 1, 'amount': 100.0, 'date': '2025-11-10'})
+    assert response.get_json()['allocations'] == [{'invoice_id': 1, 'amount': 70.0}, {'invoice_id': 2, 'amount': 30.0}]
+    supplier = client.post('/api/payments?type=suppliers', json={'supplier_id': 1, 'amount': 80.0, 'date': '2025-11-10'})
+    assert supplier.get_json()['allocations'] == [{'invoice_id': 1, 'amount': 80.0}]
+    assert db.session.get(Supplier, 1).balance == 0.0
+
+    statement = client.get('/api/customers/1/statement?date_from=2025-11-02&date_to=2025-11-30').get_json()
+    assert statement['opening_balance'] == 70.0
+    assert [(line['type'], line['balance']) for line in statement['lines']] == [('invoice', 170.0), ('payment', 70.0)]
+    assert statement['aging']['total'] == 70.0
+
+    aging = client.get('/api/aging?as_of=2025-11-30').get_json()
+    assert aging['totals']['total'] == 70.0
+
+    incremental = rollup_rows()
+    assert incremental != incremental_before
+    rebuild_rollups()
+    assert rollup_rows() == incremental
+
+
+# ===========================================
+# سجل حركات المخزون واللقطات
+# ===========================================
+
+def stock_as_of(client, day):
+    """(الكمية، القيمة، تاريخ اللقطة) للمنتج 1 في نهاية اليوم"""
+    data = client.get(f'/api/inventory/as-of?date={day}').get_json()
+    rows = [row for row in data['products'] if row['product_id'] == 1]
+    quantity, value = (rows[0]['quantity'], rows[0]['value']) if rows else (0, 0.0)
+    return quantity, round(value, 2), data['snapshot_date']
+
+
+def test_inventory_as_of_combines_snapshot_and_movements(client):
+    client.post('/api/customers', json={'name': 'عميل'})
+    client.post('/api/suppliers', json={'name': 'مورد'})
+    client.post('/api/products', json={'name': 'منتج', 'code': 'P1', 'price': 20, 'cost': 5, 'quantity': 0})
+    client.post('/api/purchases', json=purchase_payload(day='2025-01-10', items=[
+        {'product_id': 1, 'quantity': 10, 'cost': 8.0, 'total': 80.0}]))
+    client.post('/api/sales', json=sale_payload(day='2025-02-05', items=[
+        {'product_id': 1, 'quantity': 4, 'price': 20.0, 'total': 80.0}]))
+
+    # لقطات الأشهر المنتهية أُخذت تلقائياً مع أول حركة بعد انتهائها
+    assert db.session.get(StockSnapshot, (last_closed_month_end(), 1)).quantity == 6
+    assert take_stock_snapshots(until=date(2025, 2, 28)) == 0
+    assert stock_as_of(client, '2025-01-09') == (0, 0.0, None)
+    assert stock_as_of(client, '2025-01-31') == (10, 80.0, '2025-01-31')
+    assert stock_as_of(client, '2025-02-10') == (6, 48.0, '2025-01-31')
+
+    # فاتورة بتاريخ سابق للقطات تُضاف إليها
+    client.post('/api/purchases/bulk', json={'invoices': [purchase_payload(day='2025-01-20', items=[
+        {'product_id': 1, 'quantity': 5, 'cost': 10.0, 'total': 50.0}])]})
+    assert stock_as_of(client, '2025-01-31') == (15, 130.0, '2025-01-31')
+    assert stock_as_of(client, '2025-03-01') == (11, 98.0, '2025-02-28')
+    assert db.session.get(StockSnapshot, (date(2025, 2, 28), 1)).quantity == 11
+
+    # إعادة البناء من الفواتير تعطي نفس الأرصدة
+    rebuild_stock_ledger()
+    response_cache.clear()
+    assert stock_as_of(client, '2025-02-10')[:2] == (11, 98.0)
+
+    client.put('/api/products/1', json={'name': 'منتج', 'code': 'P1', 'price': 20, 'cost': 5, 'quantity': 9})
+    today = date.today().isoformat()
+    assert stock_as_of(client, today)[:2] == (9, 82.0)
+    assert db.session.get(Product, 1).quantity == 9
+
+
+def test_deleted_product_leaves_inventory(client):
+    client.post('/api/products', json={'name': 'منتج', 'code': 'P1', 'price': 20, 'cost': 5, 'quantity': 3})
+    today = date.today().isoformat()
+    assert stock_as_of(client, today)[:2] == (3, 15.0)
+    client.delete('/api/products/1')
+    assert stock_as_of(client, today)[:2] == (0, 0.0)
+    assert [m.source for m in StockMovement.query.order_by(StockMovement.id)] == ['opening', 'removal']
+
+
+# ===========================================
+# اقتراحات إعادة الطلب
+# ===========================================
+
+def test_reorder_suggestions_from_sales_velocity(client):
+    seed_parties()
+    db.session.add(Product(name="منتج راكد", code="IDLE", price=1.0, cost=1.0, quantity=0))
+    db.session.get(Product, 1).quantity = 35
+    db.session.get(Product, 2).quantity = 110
+    db.session.commit()
+    for offset in range(10):
+        day = (date.today() - timedelta(days=offset)).isoformat()
+        items = [{'product_id': 1, 'quantity': 3, 'price': 1.0, 'total': 3.0}]
+        if offset == 4:
+            items.append({'product_id': 2, 'quantity': 10, 'price': 1.0, 'total': 10.0})
+        client.post('/api/sales', json=sale_payload(day=day, items=items))
+
+    statements = capture_queries(client, '/api/inventory/reorder?window=10')
+    rows = client.get('/api/inventory/reorder?window=10').get_json()
+    assert [row['product_id'] for row in rows] == [1]
+    row = rows[0]
+    assert (row['quantity'], row['daily_velocity'], row['daily_std']) == (5, 3.0, 0.0)
+    assert row['suggested_min_stock'] == 21
+    assert row['reorder_quantity'] == 21 + 3 * 14 - 5
+    assert row['days_of_cover'] == 1.7
+
+    every = {row['product_id']: row for row in client.get('/api/inventory/reorder?window=10&all=1').get_json()}
+    assert (every[2]['daily_velocity'], every[2]['daily_std']) == (1.0, 3.0)
+    assert every[2]['suggested_min_stock'] == 21  # ceil(7 + 1.645 * 3 * sqrt(7))
+    assert every[2]['reorder_quantity'] == 0
+    assert every[3]['days_of_cover'] is None
+    assert client.get('/api/inventory/reorder?window=3').status_code == 400
+
+    # سرعة المبيعات محفوظة حتى تُسجَّل مبيعات جديدة
+    assert any('sale_item' in statement for statement in statements)
+    cached = capture_queries(client, '/api/inventory/reorder?window=10&lead_time=3')
+    assert not any('sale_item' in statement for statement in cached)
+    client.post('/api/sales', json=sale_payload(day=date.today().isoformat()))
+    refreshed = capture_queries(client, '/api/inventory/reorder?window=10&lead_time=3')
+    assert any('sale_item' in statement for statement in refreshed)
+
+
+# ===========================================
+# المزامنة التزايدية
+# ===========================================
+
+def sync(client, token):
+    response = client.get(f'/api/sync?since={token}')
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_sync_returns_only_rows_changed_since_token(client):
+    seed_parties()
+    start = client.get('/api/sync').get_json()
+    assert start['reset'] is True
+
+    client.post('/api/sales', json=sale_payload())
+    first = sync(client, start['token'])
+    assert first['reset'] is False
+    assert first['changes']['sales'] == client.get('/api/sales').get_json()
+    # البيع يعدّل رصيد العميل وكمية المنتج
+    assert [row['id'] for row in first['changes']['customers']] == [1]
+    assert [row['id'] for row in first['changes']['products']] == [1]
+    assert first['changes']['suppliers'] == first['changes']['purchases'] == []
+    assert sync(client, first['token'])['changes'] == {name: [] for name in first['changes']}
+
+    client.put('/api/products/2', json={'name': 'ماوس', 'code': 'MOU001', 'price': 210, 'cost': 150, 'quantity': 50})
+    added = client.post('/api/customers', json={'name': 'عميل مؤقت'}).get_json()['customer']
+    client.delete(f"/api/customers/{added['id']}")
+    second = sync(client, first['token'])
+    assert [row['price'] for row in second['changes']['products']] == [210.0]
+    assert second['changes']['customers'] == []
+    assert second['deleted']['customers'] == [added['id']]
+    assert sync(client, second['token'])['deleted']['customers'] == []
+
+
+def test_sync_asks_for_full_reload(client):
+    seed_parties()
+    token = client.get('/api/sync').get_json()['token']
+    client.delete('/api/products/2')
+    client.post('/api/customers', json={'name': 'عميل جديد'})
+
+    app.config['SYNC_MAX_CHANGES'] = 1
+    try:
+        assert sync(client, token)['reset'] is True
+    finally:
+        app.config['SYNC_MAX_CHANGES'] = 5000
+        response_cache.clear()
+    assert sync(client, token)['deleted']['products'] == [2]
+
+    # بعد حذف سجلات الحذف القديمة لا يمكن المزامنة من رمز أقدم منها
+    assert prune_tombstones(datetime.utcnow() + timedelta(days=1)) == 1
+    assert sync(client, token)['reset'] is True
+    latest = client.get('/api/sync').get_json()['token']
+    assert sync(client, latest)['reset'] is False
+    assert client.get('/api/sync?since=abc').status_code == 400
+
+
+# ===========================================
+# بث الأحداث (SSE)
+# ===========================================
+
+def test_event_subscriber_coalesces_and_drops():
+    subscriber = EventSubscriber(max_size=3)
+    subscriber.put([('stock', 1, {'quantity': 5}), ('stock', 2, {'quantity': 7})])
+    subscriber.put([('stock', 1, {'quantity': 4})])
+    assert subscriber.get(0) == [('stock', {'quantity': 7}), ('stock', {'quantity': 4})]
+    assert subscriber.get(0) == []
+
+    subscriber.put([('stock', product_id, {}) for product_id in range(5)])
+    assert subscriber.get(0) == [('resync', {})]
+    assert subscriber.dropped == 5
+
+
+def read_events(stream):
+    """قراءة دفعة الأحداث التالية من بث SSE إلى [(الاسم، البيانات)]"""
+    events = []
+    for block in next(stream).decode('utf-8').strip().split('\n\n'):
+        lines = dict(line.split(': ', 1) for line in block.split('\n'))
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+def test_events_stream_pushes_write_deltas(client):
+    seed_parties()
+    app.config['EVENTS_HEARTBEAT_SECONDS'] = 0.01
+    response = client.get('/api/events')
+    try:
+        assert response.mimetype == 'text/event-stream'
+        stream = iter(response.response)
+        assert next(stream) == b'retry: 5000\n\n'
+        assert next(stream) == b': ping\n\n'
+        assert event_broker.subscriber_count() == 1
+
+        # المنتج 2: الكمية 50 والحد الأدنى 10 -> البيع يجعله تحت الحد
+        client.post('/api/sales', json=sale_payload(items=[
+            {'product_id': 2, 'quantity': 45, 'price': 20.0, 'total': 900.0},
+        ]))
+        events = dict(read_events(stream))
+        assert events['invoice']['total'] == 900.0 and events['invoice']['customer_id'] == 1
+        assert events['stock'] == {'product_id': 2, 'quantity': 5, 'min_stock': 10, 'low': True}
+        assert events['low_stock'] == events['stock']
+        assert events['summary']['total_sales'] == 900.0 and events['summary']['low_stock'] == 1
+
+        client.put('/api/products/2', json={'name': 'ماوس', 'code': 'MOU001', 'price': 200, 'cost': 150,
+                                            'quantity': 30, 'min_stock': 10})
+        events = read_events(stream)
+        assert [name for name, _ in events] == ['stock', 'low_stock', 'summary']
+        assert events[1][1]['low'] is False and events[2][1]['low_stock'] == 0
+    finally:
+        response.close()
+        app.config['EVENTS_HEARTBEAT_SECONDS'] = 15
+    assert event_broker.subscriber_count() == 0
+
+
+def test_event_poller_resyncs_only_on_writes_from_other_processes(client):
+    seed_parties()
+    subscriber = event_broker.subscribe(app.config['EVENTS_QUEUE_SIZE'])
+    try:
+        # قاعدة الاختبار تُنشأ من جديد لكل اختبار: أساس جديد للاستطلاع
+        event_poller.forget(None)
+        event_poller.watch(None)
+        # كتابة هذه العملية: أحداثها تصل فوراً ولا يعيد الاستطلاع بثها
+        client.post('/api/sales', json=sale_payload())
+        assert 'invoice' in dict(subscriber.get(0))
+        event_poller.publish_changes(None)
+        assert subscriber.get(0) == []
+
+        # كتابة عامل آخر: رقم الإصدار يزيد دون bump_versions في هذه العملية
+        with app.app_context():
+            db.session.execute(db.update(TableVersion).where(TableVersion.name == 'sale_invoice')
+                               .values(version=TableVersion.version + 1))
+            db.session.commit()
+        event_poller.publish_changes(None)
+        assert subscriber.get(0) == [('resync', {})]
+    finally:
+        event_broker.unsubscribe(subscriber)
+        event_poller.forget(None)
+
+
+def test_events_subscriber_limit_is_reserved_per_request(client):
+    limit = app.config['EVENTS_MAX_SUBSCRIBERS']
+    limit_event_subscribers(4)
+    try:
+        assert app.config['EVENTS_MAX_SUBSCRIBERS'] == 2
+        # الاشتراك يُحجز عند الطلب لا عند أول قراءة من البث
+        first, second = client.get('/api/events'), client.get('/api/events')
+        assert event_broker.subscriber_count() == 2
+        response = client.get('/api/events')
+        assert response.status_code == 503 and response.get_json()['success'] is False
+        first.close()
+        third = client.get('/api/events')
+        assert third.status_code == 200
+        second.close()
+        third.close()
+    finally:
+        app.config['EVENTS_MAX_SUBSCRIBERS'] = limit
+    assert event_broker.subscriber_count() == 0
+
+
+# ===========================================
+# الترحيل المجمّع (Group Commit)
+# ===========================================
+
+def test_group_commit_sale_matches_direct_path(client):
+    seed_parties()
+    payload = sale_payload(items=[
+        {'product_id': 1, 'quantity': 2, 'price': 100.0, 'total': 200.0},
+        {'product_id': 2, 'quantity': 1, 'price': 20.0, 'discount': 1.0, 'total': 19.0},
+    ])
+    direct = client.post('/api/sales', json=payload).get_json()['invoice']
+    app.config['GROUP_COMMIT'] = True
+    try:
+        grouped = client.post('/api/sales', json=payload).get_json()['invoice']
+        invalid = client.post('/api/sales', json=dict(payload, total='abc'))
+    finally:
+        app.config['GROUP_COMMIT'] = False
+
+    assert grouped['id'] == direct['id'] + 1
+    for invoice in (direct, grouped):
+        invoice.pop('id'), invoice.pop('invoice_number')
+        for item in invoice['items']:
+            item.pop('id')
+    assert grouped == direct
+    assert invalid.status_code == 400
+    assert db.session.get(Product, 1).quantity == 46
+    assert db.session.get(Customer, 1).balance == 438.0
+
+
+def test_group_commit_timeout_falls_back_to_direct_path(client, monkeypatch):
+    import queue
+    seed_parties()
+    # كاتب متوقف: طابور جديد لا يقرؤه أحد وخيط "حي"
+    monkeypatch.setattr(group_commit_writer, '_queue', queue.Queue())
+    monkeypatch.setattr(group_commit_writer, '_thread', threading.current_thread())
+    app.config.update(GROUP_COMMIT=True, GROUP_COMMIT_TIMEOUT_MS=50)
+    try:
+        response = client.post('/api/sales', json=sale_payload())
+    finally:
+        app.config.update(GROUP_COMMIT=False, GROUP_COMMIT_TIMEOUT_MS=5000)
+
+    assert response.status_code == 200
+    stalled = group_commit_writer._queue.get_nowait()
+    assert stalled[-1].cancelled()
+    assert len(client.get('/api/sales').get_json()) == 1
+    assert db.session.get(Product, 1).quantity == 49
+
+
+# ===========================================
+# أرشفة الفواتير المكتملة القديمة
+# ===========================================
+
+def archive_snapshot(client):
+    """كل ما يجب ألا يتغير بالأرشفة: الملخص والتقارير والكشف وقوائم وتصدير الفترات المؤرشفة"""
+    return {
+        'summary': compute_dashboard_summary(),
+        'dashboard': client.get('/api/dashboard').get_json()['total_sales'],
+        'daily': client.get('/api/reports/daily?date_from=2023-01-01&date_to=2025-12-31').get_json(),
+        'statement': client.get('/api/customers/1/statement').get_json(),
+        'statement_2025': client.get('/api/customers/1/statement?date_from=2025-01-01').get_json(),
+        'sales_2023': client.get('/api/sales?date_from=2023-01-01&date_to=2023-12-31').get_json(),
+        'sales_until_2024': client.get('/api/sales?date_to=2024-12-31&sort=date&order=desc').get_json(),
+        'purchases_2023': client.get('/api/purchases?date_from=2023-01-01&date_to=2023-12-31').get_json(),
+        'export_2023': client.get('/api/sales/export?date_from=2023-01-01&date_to=2023-12-31').data,
+    }
+
+
+def test_archive_moves_old_completed_invoices_and_keeps_totals(client):
+    seed_parties()
+    client.post('/api/sales', json=sale_payload(day='2023-03-01', paid=100.0))
+    client.post('/api/sales', json=sale_payload(day='2023-06-01', paid=40.0))
+    client.post('/api/sales/bulk', json={'invoices': [
+        sale_payload(day='2024-02-01', paid=200.0, items=[
+            {'product_id': 2, 'quantity': 4, 'price': 50.0, 'total': 200.0}]),
+    ]})
+    client.post('/api/purchases', json=purchase_payload(day='2023-04-01', paid=80.0))
+    client.post('/api/sales', json=sale_payload(day='2025-11-10', paid=100.0))
+    client.post('/api/purchases', json=purchase_payload(day='2025-11-10'))
+    before = archive_snapshot(client)
+
+    assert archive_invoices(date(2025, 1, 1), batch_size=1) == {'sale': 2, 'purchase': 1}
+    response_cache.clear()
+
+    # الجداول الحالية: المفتوحة القديمة والحديثة فقط، والقوائم بلا فترة لا تقرأ الأرشيف
+    assert [sale['date'] for sale in client.get('/api/sales').get_json()] == ['2023-06-01', '2025-11-10']
+    assert [row.id for row in db.session.execute(db.select(ARCHIVE_TABLES[SaleInvoice].c.id))] == [1, 3]
+    assert db.session.execute(db.select(db.func.count()).select_from(ARCHIVE_TABLES[SaleItem])).scalar() == 2
+    assert len(client.get('/api/sales?date_from=2025-01-01').get_json()) == 1
+
+    assert archive_snapshot(client) == before
+    rollups = rollup_rows()
+    rebuild_rollups()
+    assert rollup_rows() == rollups
+    assert archive_invoices(date(2025, 1, 1)) == {'sale': 0, 'purchase': 0}
+
+
+def test_archive_keeps_newest_invoice_and_rebuilds_from_history(client):
+    seed_parties()
+    for day in ('2023-01-01', '2023-01-02'):
+        client.post('/api/sales', json=sale_payload(day=day, paid=100.0))
+
+    def ledger():
+        return sorted((row.product_id, row.date, row.quantity, row.value, row.source) for row in StockMovement.query)
+
+    rebuild_stock_ledger()
+    costs, movements = [item.cost for item in SaleItem.query], ledger()
+    # أحدث فاتورة تبقى حتى لا يعيد SQLite استخدام معرفها
+    assert archive_invoices(date(2025, 1, 1)) == {'sale': 1, 'purchase': 0}
+
+    SaleItem.query.update({'cost': None})
+    db.session.execute(ARCHIVE_TABLES[SaleItem].update().values(cost=None))
+    db.session.commit()
+    assert rebuild_cost_layers() == 2
+    archived_costs = db.session.scalars(db.select(ARCHIVE_TABLES[SaleItem].c.cost)).all()
+    assert archived_costs + [item.cost for item in SaleItem.query] == costs
+    rebuild_stock_ledger()
+    assert ledger() == movements
+
+    client.post('/api/sales', json=sale_payload(day='2025-11-10', paid=100.0))
+    assert [invoice.id for invoice in SaleInvoice.query.order_by(SaleInvoice.id)] == [2, 3]
+
+
+# ===========================================
+# الفروع: قاعدة لكل فرع وتقارير موحدة
+# ===========================================
+
+@pytest.fixture
+def branches(client):
+    """قاعدتا الفرعين north و south بنفس الجداول والبيانات الأولية"""
+    for branch in ('north', 'south'):
+        g.branch = branch
+        create_tables()
+        seed_parties()
+        db.session.remove()
+    g.pop('branch')
+    yield client
+    for branch in ('north', 'south'):
+        g.branch = branch
+        db.metadata.drop_all(db.session.get_bind())
+        db.session.remove()
+    g.pop('branch', None)
+
+
+def post_in_branch(client, branch, url, payload):
+    """طلب كتابة على قاعدة فرع؛ جلسة جديدة بعده لأن الاختبارات تتشارك سياق التطبيق"""
+    response = client.post(url, json=payload, headers={'X-Branch': branch})
+    db.session.remove()
+    return response
+
+
+def test_branch_routing_isolates_databases(branches):
+    subscriber = event_broker.subscribe(10, 'north')
+    try:
+        assert post_in_branch(branches, 'south', '/api/sales', sale_payload(items=[
+            {'product_id': 1, 'quantity': 3, 'price': 100.0, 'total': 300.0}])).status_code == 200
+        assert subscriber.get(0) == []
+        assert post_in_branch(branches, 'north', '/api/sales', sale_payload()).status_code == 200
+        assert {name for name, _ in subscriber.get(0)} >= {'invoice', 'summary'}
+    finally:
+        event_broker.unsubscribe(subscriber)
+
+    def products(branch):
+        response = branches.get(f'/api/products?branch={branch}&fields=code,quantity')
+        db.session.remove()
+        return response.get_json()
+
+    assert products('north')[0] == {'code': 'LAP001', 'quantity': 49}
+    assert products('south')[0] == {'code': 'LAP001', 'quantity': 47}
+    # القاعدة الرئيسية (بلا فرع) لم تتغير
+    assert branches.get('/api/sales').get_json() == []
+    assert branches.get('/api/sales', headers={'X-Branch': 'east'}).status_code == 404
+
+
+def test_consolidated_reports_merge_branches(branches):
+    today = date.today().strftime('%Y-%m-%d')
+    post_in_branch(branches, 'north', '/api/sales', sale_payload(day=today, items=[
+        {'product_id': 1, 'quantity': 2, 'price': 100.0, 'total': 200.0}]))
+    post_in_branch(branches, 'south', '/api/sales', sale_payload(day=today, items=[
+        {'product_id': 1, 'quantity': 1, 'price': 100.0, 'total': 100.0},
+        {'product_id': 2, 'quantity': 5, 'price': 20.0, 'total': 100.0}]))
+
+    dashboard = branches.get('/api/consolidated/dashboard').get_json()
+    assert dashboard['branches']['north']['total_sales'] == 200.0
+    assert dashboard['branches']['south']['total_sales'] == 200.0
+    assert dashboard['total']['total_sales'] == 400.0
+    assert dashboard['total']['cost_of_sales'] == 3 * 12000.0 + 5 * 150.0
+
+    rows = branches.get('/api/consolidated/sales-by-product?order_by=quantity').get_json()
+    assert [(row['code'], row['quantity'], row['revenue'], row['branches']) for row in rows] == [
+        ('MOU001', 5, 100.0, {'south': 5}),
+        ('LAP001', 3, 300.0, {'north': 2, 'south': 1}),
+    ]
+    stock = branches.get('/api/consolidated/stock').get_json()
+    assert [(row['code'], row['quantity'], row['branches']) for row in stock] == [
+        ('LAP001', 97, {'north': 48, 'south': 49}),
+        ('MOU001', 95, {'north': 50, 'south': 45}),
+    ]
+    assert branches.get('/api/branches').get_json() == {'branches': ['north', 'south'], 'current': None}
+
+
+def test_fan_out_queries_branches_in_parallel(branches):
+    # لو نُفِّذت الفروع واحداً بعد الآخر لانتهت مهلة الحاجز
+    barrier = threading.Barrier(2, timeout=5)
+
+    def count_products():
+        barrier.wait()
+        return db.session.scalar(db.select(db.func.count(Product.id)))
+
+    assert fan_out(count_products) == {'north': 2, 'south': 2}
+
+
+
+# ===========================================
+# تهيئة قاعدة البيانات (flask init-db)
+# ===========================================
+
+def test_create_app_rejects_database_changes_after_binding(monkeypatch):
+    assert create_app({'RESPONSE_CACHE_SIZE': 256}) is app
+    with pytest.raises(RuntimeError, match='SQLALCHEMY_DATABASE_URI'):
+        create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///other.db'})
+    monkeypatch.setenv('DATABASE_URL', 'sqlite:///other.db')
+    with pytest.raises(RuntimeError, match='SQLALCHEMY_DATABASE_URI'):
+        create_app()
+
+
+def test_cli_commands_work_with_module_app(tmp_path):
+    # flask --app app يكتشف app المعرف في الوحدة لا create_app، فيجب أن يكون مُعداً عند الاستيراد
+    environment = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp_path / 'cli.db'}", BRANCH_DATABASES='')
+    for command in (['init-db'], ['rebuild-summary']):
+        result = subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', *command],
+                                cwd=os.path.dirname(os.path.abspath(__file__)), env=environment,
+                                capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+
+
+def test_init_db_command_creates_schema_and_optional_sample_data(branches):
+    db.drop_all()
+    runner = app.test_cli_runner()
+    assert runner.invoke(init_database_command).exit_code == 0
+    assert Customer.query.count() == 0
+    for _ in range(2):
+        assert runner.invoke(init_database_command, ['--sample-data']).exit_code == 0
+    assert (Customer.query.count(), Supplier.query.count(), Product.query.count()) == (3, 2, 4)
+    assert branches.get('/api/dashboard').get_json()['total_products'] == 4
+    # قواعد الفروع التي بها بيانات لا تُضاف إليها البيانات التجريبية
+    response = branches.get('/api/products', headers={'X-Branch': 'north'})
+    assert [product['code'] for product in response.get_json()] == ['LAP001', 'MOU001']
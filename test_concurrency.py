@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+اختبارات التزامن لنظام المحاسبة
+عدة عمليات (processes) تكتب في نفس ملف SQLite كما يحدث مع عدة عمّال gunicorn
+"""
+
+import multiprocessing
+import os
+
+import pytest
+
+PROCESSES = 4
+INVOICES_PER_PROCESS = 40
+
+
+def run_workers(worker, database_url, *args):
+    """تشغيل worker في عدة عمليات منفصلة وإرجاع نتائجها"""
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(PROCESSES) as pool:
+        return pool.starmap(worker, [(database_url, *args)] * PROCESSES)
+
+
+def create_database(database_url):
+    """إنشاء الجداول وإضافة عميل ومورد ومنتج في قاعدة بيانات ملف"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+    from app import db, Customer, Supplier, Product
+
+    from config import engine_options
+
+    engine = create_engine(database_url, **engine_options(database_url))
+    db.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all([
+            Customer(name="عميل"),
+            Supplier(name="مورد"),
+            Product(name="منتج", code="P1", price=10.0, cost=5.0, quantity=100000, min_stock=5),
+        ])
+        session.commit()
+    return engine
+
+
+@pytest.fixture
+def database_url(tmp_path):
+    return f"sqlite:///{tmp_path / 'concurrency.db'}"
+
+
+# ===========================================
+# ترقيم الفواتير
+# ===========================================
+
+def post_sales_worker(database_url, count):
+    """ترحيل count فاتورة مبيعات وإرجاع (أرقام الفواتير، عدد الفشل)"""
+    os.environ['DATABASE_URL'] = database_url
+    from app import create_app
+    app = create_app()
+
+    numbers, failures = [], 0
+    client = app.test_client()
+    for index in range(count):
+        payload = {
+            'customer_id': 1,
+            'date': '2025-11-10',
+            'items': [{'product_id': 1, 'quantity': 1, 'price': 10.0, 'total': 10.0}],
+            'subtotal': 10.0, 'total': 10.0, 'paid': 10.0, 'remaining': 0.0,
+            'status': 'completed',
+        }
+        if index % 10 == 0:
+            response = client.post('/api/sales/bulk', json={'invoices': [payload] * 5})
+            results = response.get_json()['results'] if response.status_code == 200 else []
+            numbers.extend(r['invoice_number'] for r in results if r['success'])
+            failures += 5 - sum(1 for r in results if r['success'])
+            continue
+        try:
+            response = client.post('/api/sales', json=payload)
+        except Exception:
+            failures += 1
+            continue
+        if response.status_code != 200:
+            failures += 1
+            continue
+        numbers.append(response.get_json()['invoice']['invoice_number'])
+    return numbers, failures
+
+
+def test_invoice_numbers_unique_across_processes(database_url):
+    from sqlalchemy import text
+
+    engine = create_database(database_url)
+    results = run_workers(post_sales_worker, database_url, INVOICES_PER_PROCESS)
+
+    numbers = [number for process_numbers, _ in results for number in process_numbers]
+    assert sum(failures for _, failures in results) == 0
+    expected = PROCESSES * (INVOICES_PER_PROCESS + 4 * (INVOICES_PER_PROCESS // 10))
+    assert len(numbers) == expected
+    assert len(set(numbers)) == expected
+    with engine.connect() as connection:
+        assert connection.execute(text('SELECT last_value FROM invoice_sequence')).scalar() == expected
+
+
+# ===========================================
+# ترحيل المخزون والأرصدة
+# ===========================================
+
+def post_mixed_worker(database_url, count):
+    """ترحيل فواتير بيع وشراء متبادلة على نفس المنتج وإرجاع عدد الفشل"""
+    os.environ['DATABASE_URL'] = database_url
+    from app import create_app
+    app = create_app()
+
+    client = app.test_client()
+    failures = 0
+    for index in range(count):
+        if index % 2:
+            response = client.post('/api/purchases', json={
+                'supplier_id': 1, 'date': '2025-11-10',
+                'items': [{'product_id': 1, 'quantity': 3, 'cost': 5.0, 'total': 15.0}],
+                'subtotal': 15.0, 'total': 15.0, 'paid': 0.0, 'remaining': 15.0,
+            })
+        else:
+            response = client.post('/api/sales', json={
+                'customer_id': 1, 'date': '2025-11-10',
+                'items': [{'product_id': 1, 'quantity': 2, 'price': 10.0, 'total': 20.0}],
+                'subtotal': 20.0, 'total': 20.0, 'paid': 5.0, 'remaining': 15.0,
+            })
+        failures += response.status_code != 200
+    return failures
+
+
+def test_parallel_posting_keeps_stock_and_balances_exact(database_url):
+    from sqlalchemy import text
+
+    engine = create_database(database_url)
+    failures = run_workers(post_mixed_worker, database_url, INVOICES_PER_PROCESS)
+
+    assert sum(failures) == 0
+    sales = purchases = PROCESSES * INVOICES_PER_PROCESS // 2
+    with engine.connect() as connection:
+        quantity = connection.execute(text('SELECT quantity FROM product WHERE id = 1')).scalar()
+        customer_balance = connection.execute(text('SELECT balance FROM customer WHERE id = 1')).scalar()
+        supplier_balance = connection.execute(text('SELECT balance FROM supplier WHERE id = 1')).scalar()
+    assert quantity == 100000 - 2 * sales + 3 * purchases
+    assert customer_balance == 15.0 * sales
+    assert supplier_balance == 15.0 * purchases
+
+
+# ===========================================
+# الترحيل المجمّع (Group Commit)
+# ===========================================
+
+def group_commit_worker(database_url, threads, invoices_per_thread):
+    """ترحيل فواتير من عدة خيوط متزامنة بوضع GROUP_COMMIT وإرجاع (رموز الحالة، الأرقام، عدد commit)"""
+    import threading
+    os.environ['DATABASE_URL'] = database_url
+    from sqlalchemy import event
+    from app import create_app, db
+    app = create_app()
+
+    app.config.update(GROUP_COMMIT=True, GROUP_COMMIT_WINDOW_MS=20, PREVENT_NEGATIVE_STOCK=True)
+    commits = []
+    with app.app_context():
+        event.listen(db.engine, 'commit', lambda connection: commits.append(1))
+    statuses, numbers = [], []
+
+    def post(index):
+        client = app.test_client()
+        for number in range(invoices_per_thread):
+            # فاتورة واحدة تتجاوز المخزون: يجب أن تفشل وحدها دون بقية دفعتها
+            quantity = 10 ** 6 if (index, number) == (0, 0) else 1
+            response = client.post('/api/sales', json={
+                'customer_id': 1, 'date': '2025-11-10',
+                'items': [{'product_id': 1, 'quantity': quantity, 'price': 10.0, 'total': 10.0}],
+                'subtotal': 10.0, 'total': 10.0, 'paid': 0.0, 'remaining': 10.0,
+            })
+            statuses.append(response.status_code)
+            if response.status_code == 200:
+                numbers.append(response.get_json()['invoice']['invoice_number'])
+
+    workers = [threading.Thread(target=post, args=(index,)) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return statuses, numbers, len(commits)
+
+
+def test_group_commit_batches_concurrent_sales(database_url):
+    from sqlalchemy import text
+
+    engine = create_database(database_url)
+    threads, per_thread = 16, 5
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        statuses, numbers, commits = pool.apply(group_commit_worker, (database_url, threads, per_thread))
+
+    total = threads * per_thread
+    assert sorted(statuses) == [200] * (total - 1) + [409]
+    assert len(set(numbers)) == total - 1
+    # الفواتير المتزامنة تُرحَّل في دفعات: عدد commit أقل بكثير من عدد الفواتير
+    assert commits < total / 2
+    with engine.connect() as connection:
+        assert connection.execute(text('SELECT quantity FROM product WHERE id = 1')).scalar() == 100000 - (total - 1)
+        assert connection.execute(text('SELECT balance FROM customer WHERE id = 1')).scalar() == 10.0 * (total - 1)
+
+
+
+# ===========================================
+# توجيه القراءة إلى اتصالات القراءة فقط
+# ===========================================
+
+def read_routing_worker(database_url):
+    """تنفيذ قراءات وكتابة بوضع SQLITE_READ_ONLY وإرجاع القاعدة التي نفّذت كل طلب"""
+    os.environ.update(DATABASE_URL=database_url, SQLITE_READ_ONLY='1')
+    from sqlalchemy import event, text
+    from sqlalchemy.exc import OperationalError
+    from app import create_app, db
+    app = create_app()
+
+    used = []
+    with app.app_context():
+        for name, engine in (('primary', db.engine), ('read', db.engines['read:'])):
+            event.listen(engine, 'before_cursor_execute', lambda *args, name=name: used.append(name))
+
+    def databases(send):
+        used.clear()
+        response = send()
+        return response.status_code, sorted(set(used))
+
+    results = {}
+    client, other_client = app.test_client(), app.test_client()
+    results['get'] = databases(lambda: client.get('/api/sales'))
+    results['post'] = databases(lambda: client.post('/api/sales', json={
+        'customer_id': 1, 'date': '2025-11-10',
+        'items': [{'product_id': 1, 'quantity': 1, 'price': 10.0, 'total': 10.0}],
+        'subtotal': 10.0, 'total': 10.0, 'paid': 10.0, 'remaining': 0.0, 'status': 'completed',
+    }))
+    # نفس العميل بعد الكتابة يقرأ من الرئيسية، وأي عميل آخر من قاعدة القراءة ويرى الفاتورة أيضاً
+    results['read_your_writes'] = databases(lambda: client.get('/api/sales'))
+    results['other_client'] = databases(lambda: other_client.get('/api/sales'))
+    results['forced_primary'] = databases(lambda: other_client.get('/api/products', headers={'X-Read-Primary': '1'}))
+    results['invoices_seen'] = len(other_client.get('/api/sales').get_json())
+    with app.app_context():
+        try:
+            with db.engines['read:'].begin() as connection:
+                connection.execute(text("UPDATE product SET quantity = 0"))
+            results['read_only'] = False
+        except OperationalError:
+            results['read_only'] = True
+    return results
+
+
+def test_get_requests_read_from_read_only_connections(database_url):
+    create_database(database_url)
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        results = pool.apply(read_routing_worker, (database_url,))
+
+    assert results['get'] == (200, ['read'])
+    assert results['post'] == (200, ['primary'])
+    assert results['read_your_writes'] == (200, ['primary'])
+    assert results['other_client'] == (200, ['read'])
+    assert results['forced_primary'] == (200, ['primary'])
+    assert results['invoices_seen'] == 1
+    assert results['read_only']
+
+
+# ===========================================
+# تعديل كمية المنتج أثناء الترحيل
+# ===========================================
+
+def adjust_while_selling_worker(database_url, count):
+    """بيع وتعديل كمية نفس المنتج يدوياً بالتبادل وإرجاع عدد الفشل"""
+    os.environ['DATABASE_URL'] = database_url
+    from app import create_app
+    app = create_app()
+
+    client = app.test_client()
+    failures = 0
+    for index in range(count):
+        if index % 4 == 3:
+            response = client.put('/api/products/1', json={
+                'name': 'منتج', 'code': 'P1', 'price': 10.0, 'cost': 5.0, 'quantity': 100000 + index,
+            })
+        else:
+            response = client.post('/api/sales', json={
+                'customer_id': 1, 'date': '2025-11-10',
+                'items': [{'product_id': 1, 'quantity': 1, 'price': 10.0, 'total': 10.0}],
+                'subtotal': 10.0, 'total': 10.0, 'paid': 10.0, 'remaining': 0.0, 'status': 'completed',
+            })
+        failures += response.status_code != 200
+    return failures
+
+
+def test_manual_adjustments_keep_ledger_in_step_with_stock(database_url):
+    from sqlalchemy import text
+
+    engine = create_database(database_url)
+    failures = run_workers(adjust_while_selling_worker, database_url, INVOICES_PER_PROCESS)
+
+    assert sum(failures) == 0
+    with engine.connect() as connection:
+        quantity = connection.execute(text('SELECT quantity FROM product WHERE id = 1')).scalar()
+        movements = connection.execute(text('SELECT SUM(quantity) FROM stock_movement WHERE product_id = 1')).scalar()
+    # المنتج أُنشئ بـ 100000 دون حركة افتتاحية
+    assert 100000 + movements == quantity
+
+
+# ===========================================
+# تخصيص الدفعات المتزامنة لنفس العميل
+# ===========================================
+
+def pay_customer_worker(database_url, count):
+    """تسجيل count دفعة بقيمة 10 للعميل 1 في طلبات bulk من 5 دفعات وإرجاع عدد الفشل"""
+    os.environ['DATABASE_URL'] = database_url
+    from app import create_app
+    app = create_app()
+
+    client = app.test_client()
+    failures = 0
+    for _ in range(count // 5):
+        response = client.post('/api/payments/bulk?type=customers', json={'payments': [
+            {'customer_id': 1, 'date': '2025-11-10', 'amount': 10.0} for _ in range(5)
+        ]})
+        failures += response.status_code != 200
+    return failures
+
+
+def test_concurrent_payments_never_overpay_invoices(database_url):
+    from datetime import date
+    from sqlalchemy import text
+    from sqlalchemy.orm import Session
+    from app import SaleInvoice
+
+    engine = create_database(database_url)
+    with Session(engine) as session:
+        session.add_all([
+            SaleInvoice(customer_id=1, invoice_number=f'S{index}', date=date(2025, 10, index + 1),
+                        subtotal=100.0, total=100.0, paid=0.0, remaining=100.0, status='pending')
+            for index in range(20)
+        ])
+        session.commit()
+    # 4 عمليات × 60 × 10 = 2400 أكثر من المتبقي 2000
+    failures = run_workers(pay_customer_worker, database_url, 60)
+
+    assert sum(failures) == 0
+    with engine.connect() as connection:
+        overpaid = connection.execute(text(
+            'SELECT COUNT(*) FROM sale_invoice WHERE paid > total + 0.001 OR remaining < 0'
+        )).scalar()
+        allocated = connection.execute(text("SELECT SUM(amount) FROM payment_allocation WHERE kind = 'sale'")).scalar()
+        mismatched = connection.execute(text(
+            "SELECT COUNT(*) FROM sale_invoice WHERE ABS(paid - (SELECT COALESCE(SUM(amount), 0) FROM payment_allocation "
+            "WHERE kind = 'sale' AND invoice_id = sale_invoice.id)) > 0.001"
+        )).scalar()
+        unallocated = connection.execute(text('SELECT SUM(unallocated) FROM payment')).scalar()
+    assert overpaid == 0 and mismatched == 0
+    assert abs(allocated - 2000.0) < 0.001 and abs(unallocated - 400.0) < 0.001
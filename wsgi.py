@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""
+نقطة تشغيل الإنتاج لنظام المحاسبة
+
+    gunicorn -c gunicorn.conf.py wsgi:app    # Linux: عدة عمليات × عدة خيوط
+    python wsgi.py                           # waitress (Windows أو بدون gunicorn)
+
+الجداول والبيانات التجريبية لا تُنشأ عند التشغيل: flask init-db [--sample-data] مرة عند النشر
+"""
+
+import os
+
+from app import create_app, limit_event_subscribers
+from config import env_int
+
+app = create_app()
+
+
+if __name__ == '__main__':
+    from waitress import serve
+
+    threads = env_int('THREADS', 8)
+    limit_event_subscribers(threads)
+    serve(app, host=os.environ.get('HOST', '0.0.0.0'), port=env_int('PORT', 5000), threads=threads)